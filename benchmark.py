@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+''' Benchmarks of the cleaning pipeline on synthetic OSM data.
+
+The real extract can't be shipped with the project, so a deterministic
+generator writes an OSM XML file of any size (from a few MB to several GB)
+with the same kind of content: nodes and ways, addresses with messy street
+types, and postcode / city pairs with missing values, typos and special
+delivery postcodes, along with a matching La Poste reference file.
+
+Each stage (count_tags, shape_element, update_street_name, correct_pc_city,
+the indexed PostcodeCityResolver, process_map, and process_map_pbf on the
+same data converted to PBF) runs in its own process and is measured in 
+elements per second and peak resident memory. The results are compared with
+a stored baseline (benchmark_baseline.json), and the run fails if a stage is
+slower or bigger than the baseline beyond a tolerance.
+
+Usage: python benchmark.py [--size 10] [--stages ...] [--save-baseline]
+'''
+
+import argparse
+import json
+import os
+import random
+import resource
+import time
+from multiprocessing import Process, Queue
+from Queue import Empty
+from xml.sax.saxutils import quoteattr
+
+import clean_and_save_to_json as cleaning
+import osm_pbf
+
+# A. Synthetic data ============================================================
+
+# Street types as found in the data: expected ones, and the messy variants
+# corrected by street_mapping
+expected_types = [u"Rue", u"Avenue", u"Boulevard", u"Route", u"Place",
+                  u"Impasse", u"Allée", u"Chemin", u"Résidence", u"Square"]
+messy_types = [u"rue", u"allee", u"Allee", u"Residence", u"résidence",
+               u"C.C.", u"CCR", u"Centre commercial", u"Aérodrome - ",
+               u"hameau"]
+name_parts = [u"de la Paix", u"des Pins", u"Verte", u"du Parc",
+              u"du Général de Gaulle", u"de Paris", u"Jean Jaurès",
+              u"de la Gare", u"des Réservoirs", u"Hoche", u"de Satory",
+              u"du Maréchal Foch", u"des États Généraux", u"Carnot"]
+odd_streets = [u"Otis", u"Jean Macé", u"Élysée 2", u"Guyancourt"]
+
+# (postcode, city as written in the data, names in the reference file)
+cities = [(u'78000', u'Versailles', [u'VERSAILLES']),
+          (u'78150', u'Le Chesnay', [u'LE CHESNAY', u'ROCQUENCOURT']),
+          (u'78530', u'Buc', [u'BUC']),
+          (u'78350', u'Jouy-en-Josas', [u'JOUY EN JOSAS',
+                                        u'LES LOGES EN JOSAS']),
+          (u'78170', u'La Celle-Saint-Cloud', [u'LA CELLE ST CLOUD']),
+          (u'78380', u'Bougival', [u'BOUGIVAL']),
+          (u'78220', u'Viroflay', [u'VIROFLAY']),
+          (u'78210', u"Saint-Cyr-l'École", [u"ST CYR L ECOLE"]),
+          (u'78280', u'Guyancourt', [u'GUYANCOURT']),
+          (u'78100', u'Saint-Germain-en-Laye', [u'ST GERMAIN EN LAYE']),
+          (u'78160', u'Marly-le-Roi', [u'MARLY LE ROI']),
+          (u'78590', u'Noisy-le-Roi', [u'NOISY LE ROI', u'RENNEMOULIN'])]
+special_postcodes = [u'78101', u'78103', u'78884', u'92852']
+amenities = [u"fountain", u"restaurant", u"cafe", u"parking", u"bench",
+             u"school", u"pharmacy", u"toilets"]
+tourism = [u"attraction", u"artwork", u"museum", u"hotel", u"viewpoint"]
+highways = [u"residential", u"footway", u"service", u"primary", u"tertiary"]
+
+def street_name(rng):
+    ''' A street name, with a messy street type one time out of four. '''
+    if rng.random() < 0.05:
+        return rng.choice(odd_streets)
+    types = messy_types if rng.random() < 0.25 else expected_types
+    return rng.choice(types) + u" " + rng.choice(name_parts)
+
+def misspell(rng, city):
+    ''' Drops or doubles a letter, or changes the case. '''
+    i = rng.randrange(len(city))
+    return rng.choice([city[:i] + city[i + 1:], city[:i] + city[i] + city[i:],
+                       city.lower(), city.upper()])
+
+def postcode_city(rng):
+    ''' A (postcode, city) pair as found in the data, either possibly None.
+    '''
+    pc, city, names = rng.choice(cities)
+    draw = rng.random()
+    if draw < 0.60:
+        return pc, city
+    elif draw < 0.75:
+        return pc, misspell(rng, city)
+    elif draw < 0.85:
+        return pc, None
+    elif draw < 0.95 and city in cleaning.city_to_pc_map:  # Postcode deduced
+        return None, city                                   # from the city
+    return rng.choice(special_postcodes), None
+
+def tag(k, v):
+    return u'  <tag k={0} v={1}/>\n'.format(quoteattr(k), quoteattr(v))
+
+def node_tags(rng, i):
+    tags = []
+    if rng.random() < 0.15:
+        tags.append(tag(u"addr:street", street_name(rng)))
+        tags.append(tag(u"addr:housenumber", unicode(rng.randint(1, 200))))
+        pc, city = postcode_city(rng)
+        if pc is not None:
+            tags.append(tag(u"addr:postcode", pc))
+        if city is not None:
+            tags.append(tag(u"addr:city", city))
+    if rng.random() < 0.05:
+        tags.append(tag(u"amenity", rng.choice(amenities)))
+        tags.append(tag(u"name", u"Lieu {0}".format(i)))
+    if rng.random() < 0.02:
+        tags.append(tag(u"tourism", rng.choice(tourism)))
+    if rng.random() < 0.01:  # Ignored keys: problem chars, several colons
+        tags.append(tag(u"name:fr:old", u"x"))
+        tags.append(tag(u"bad key", u"x"))
+    return tags
+
+def generate_osm(path, size, seed = 0):
+    ''' Writes a deterministic synthetic OSM XML file of about size bytes:
+    nodes (80% of the file) then ways referencing them, and a relation.
+
+    In:
+        path (string): Path of the file to write
+        size (int): Target size in bytes
+        seed (int): Seed of the random generator
+    Out:
+        dict: Number of 'node', 'way' and 'relation' elements written
+    '''
+    rng = random.Random(seed)
+    counts = {'node': 0, 'way': 0, 'relation': 0}
+    with open(path, 'wb') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n'
+                ' <bounds minlat="48.76" minlon="2.02" maxlat="48.91" '
+                'maxlon="2.17"/>\n')
+        written = 0
+        while written < 0.8 * size:
+            i = counts['node'] + 1
+            lat = 48.76 + rng.random() * 0.15
+            lon = 2.02 + rng.random() * 0.15
+            uid = rng.randint(1, 500)
+            head = (u' <node id="{0}" visible="true" version="{1}" '
+                    u'changeset="{2}" timestamp="2013-08-03T16:43:42Z" '
+                    u'user="user{3}" uid="{3}" lat="{4:.7f}" lon="{5:.7f}"'
+                    .format(i, rng.randint(1, 5), rng.randint(1, 10 ** 7),
+                            uid, lat, lon))
+            tags = node_tags(rng, i)
+            if tags:
+                chunk = head + u'>\n' + u''.join(tags) + u' </node>\n'
+            else:
+                chunk = head + u'/>\n'
+            chunk = chunk.encode('utf-8')
+            f.write(chunk)
+            written += len(chunk)
+            counts['node'] += 1
+        n_nodes = counts['node']
+        while written < size:
+            i = 10 ** 8 + counts['way'] + 1
+            uid = rng.randint(1, 500)
+            start = rng.randint(1, n_nodes)
+            refs = [min(start + k, n_nodes) for k in range(rng.randint(2, 12))]
+            lines = [u' <way id="{0}" visible="true" version="1" changeset="9" '
+                     u'timestamp="2014-01-01T00:00:00Z" user="user{1}" '
+                     u'uid="{1}">\n'.format(i, uid)]
+            lines += [u'  <nd ref="{0}"/>\n'.format(r) for r in refs]
+            lines.append(tag(u"highway", rng.choice(highways)))
+            if rng.random() < 0.5:
+                lines.append(tag(u"name", street_name(rng)))
+            if rng.random() < 0.2:
+                lines.append(tag(u"addr:street", street_name(rng)))
+                pc, city = postcode_city(rng)
+                if pc is not None:
+                    lines.append(tag(u"addr:postcode", pc))
+                if city is not None:
+                    lines.append(tag(u"addr:city", city))
+            lines.append(u' </way>\n')
+            chunk = u''.join(lines).encode('utf-8')
+            f.write(chunk)
+            written += len(chunk)
+            counts['way'] += 1
+        f.write(' <relation id="1" version="1">\n'
+                '  <member type="way" ref="{0}" role="outer"/>\n'
+                ' </relation>\n</osm>\n'.format(10 ** 8 + 1))
+        counts['relation'] = 1
+    return counts
+
+def generate_reference(path, fillers = 39000):
+    ''' Writes a La Poste-like reference file with the cities of the
+    synthetic data, among fillers other communes (the real file has about
+    39,000 rows). '''
+    with open(path, 'wb') as f:
+        f.write(u'Code_commune_INSEE;Nom_commune;Code_postal;'
+                u'Libellé_acheminement;Ligne_5;coordonnees_gps\n'
+                .encode('utf-8'))
+        for pc, city, names in cities:
+            for name in names:
+                f.write(u'78000;{0};{1};{0};;\n'.format(name, pc)
+                        .encode('utf-8'))
+        for i in range(fillers):
+            pc = '{0:05d}'.format(1000 + i * 2)
+            f.write('{0:05d};COMMUNE {0};{1};COMMUNE {0};;\n'.format(i, pc))
+
+def sample_addresses(n, seed = 0):
+    ''' n street names and (postcode, city) pairs as found in the data. '''
+    rng = random.Random(seed)
+    streets = [street_name(rng) for _ in range(n)]
+    pairs = [pair for pair in (postcode_city(rng) for _ in range(2 * n))
+             if pair != (None, None)][:n]
+    return streets, pairs
+
+
+# B. Stages ====================================================================
+
+# Each stage does its setup (parsing the reference file, drawing addresses)
+# and returns the timed work, which returns the number of elements processed.
+
+def bench_count_tags(osm_file, reference_file):
+    def work():
+        tags = cleaning.count_tags(osm_file)
+        return sum(tags.get(t, 0) for t in ('node', 'way', 'relation'))
+    return work
+
+def bench_shape_element(osm_file, reference_file):
+    def work():
+        n = 0
+        for element in cleaning.iter_elements(osm_file):
+            if cleaning.shape_element(element) is not None:
+                n += 1
+        return n
+    return work
+
+def address_sample(osm_file):
+    ''' Sample size for the address stages: as many addresses as elements in
+    the file, within limits that keep the timings meaningful and the sample in
+    memory. '''
+    return max(10000, min(os.path.getsize(osm_file) // 200, 10 ** 6))
+
+def bench_update_street_name(osm_file, reference_file):
+    streets, pairs = sample_addresses(address_sample(osm_file))
+    def work():
+        for street in streets:
+            cleaning.update_street_name(street, cleaning.street_mapping)
+        return len(streets)
+    return work
+
+def bench_correct_pc_city(osm_file, reference_file):
+    ''' The original, unindexed correction. '''
+    reference = cleaning.parse_reference_file(reference_file)
+    streets, pairs = sample_addresses(address_sample(osm_file))
+    def work():
+        for pc, city in pairs:
+            cleaning.correct_pc_city(pc, city, reference)
+        return len(pairs)
+    return work
+
+def bench_resolver(osm_file, reference_file):
+    reference = cleaning.PostcodeCityResolver(
+        cleaning.parse_reference_file(reference_file))
+    streets, pairs = sample_addresses(address_sample(osm_file))
+    def work():
+        for pc, city in pairs:
+            reference.correct(pc, city)
+        return len(pairs)
+    return work
+
+def bench_process_map(osm_file, reference_file):
+    reference = cleaning.parse_reference_file(reference_file)
+    file_out = cleaning.output_path(osm_file)
+    def work():
+        cleaning.process_map(osm_file, reference, sample_size = 1)
+        with open(file_out) as f:
+            n = sum(1 for line in f)  # One document per line
+        os.remove(file_out)
+        return n
+    return work
+
+def pbf_path(osm_file):
+    ''' Path of the PBF version of the synthetic file, see main(). '''
+    return osm_file + '.pbf'
+
+def bench_process_map_pbf(osm_file, reference_file):
+    ''' process_map() reading the PBF version of the file, which gives the 
+    same documents (see iter_pbf_documents()). '''
+    return bench_process_map(pbf_path(osm_file), reference_file)
+
+stages = [('count_tags', bench_count_tags),
+          ('shape_element', bench_shape_element),
+          ('update_street_name', bench_update_street_name),
+          ('correct_pc_city', bench_correct_pc_city),
+          ('resolver', bench_resolver),
+          ('process_map', bench_process_map),
+          ('process_map_pbf', bench_process_map_pbf)]
+
+def run_stage(stage, osm_file, reference_file, results):
+    ''' Runs a stage in a child process, so that its peak memory is its own.
+    '''
+    work = dict(stages)[stage](osm_file, reference_file)
+    start, cpu_start = time.time(), time.clock()
+    n = work()
+    elapsed, cpu = time.time() - start, time.clock() - cpu_start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    results.put({'elements': n, 'seconds': elapsed, 'cpu_seconds': cpu,
+                 'rate': n / elapsed if elapsed else float('inf'),
+                 'peak_rss_mb': peak})
+
+def measure(stage, osm_file, reference_file):
+    ''' Returns the measures of a stage: number of 'elements', 'seconds', 
+    'cpu_seconds', 'rate' (elements/s) and 'peak_rss_mb'. '''
+    results = Queue()
+    p = Process(target = run_stage, args = (stage, osm_file, reference_file,
+                                            results))
+    p.start()
+    while True:
+        try:
+            result = results.get(timeout = 1)
+            break
+        except Empty:
+            if not p.is_alive():
+                raise RuntimeError('Stage {0} failed'.format(stage))
+    p.join()
+    return result
+
+
+# C. Baseline ==================================================================
+
+baseline_file = './benchmark_baseline.json'
+
+def compare(results, baseline, tolerance = 0.2):
+    ''' Returns the regressions of results against baseline (both keyed by
+    stage): stages slower, or with a higher peak memory, than the baseline by
+    more than tolerance (a fraction). '''
+    regressions = []
+    for stage, result in results.items():
+        if stage not in baseline:
+            continue
+        base = baseline[stage]
+        if result['rate'] < base['rate'] * (1 - tolerance):
+            regressions.append('{0}: {1:.0f} elements/s, baseline {2:.0f}'
+                               .format(stage, result['rate'], base['rate']))
+        if result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance):
+            regressions.append('{0}: {1:.1f} MB peak memory, baseline {2:.1f}'
+                               .format(stage, result['peak_rss_mb'],
+                                       base['peak_rss_mb']))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmarks of the '
+                                     'cleaning pipeline on synthetic data')
+    parser.add_argument('--size', type = int, default = 10,
+                        help = 'size of the synthetic OSM file, in MB')
+    parser.add_argument('--stages', nargs = '+', default = [s for s, f in
+                        stages], choices = [s for s, f in stages])
+    parser.add_argument('--dir', default = './benchmark_data',
+                        help = 'directory of the generated files')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--baseline', default = baseline_file)
+    parser.add_argument('--tolerance', type = float, default = 0.2)
+    parser.add_argument('--save-baseline', action = 'store_true',
+                        help = 'store these results as the new baseline')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.dir):
+        os.makedirs(args.dir)
+    osm_file = os.path.join(args.dir, 'synthetic_{0}MB_{1}.osm'.format(
+                            args.size, args.seed))
+    reference_file = os.path.join(args.dir, 'laposte_synthetic.csv')
+    if not os.path.exists(osm_file):  # Deterministic: generated once
+        print "Generating {0}...".format(osm_file)
+        generate_osm(osm_file, args.size << 20, args.seed)
+    if not os.path.exists(reference_file):
+        generate_reference(reference_file)
+    if ('process_map_pbf' in args.stages and 
+        not os.path.exists(pbf_path(osm_file))):
+        print "Converting {0} to PBF...".format(osm_file)
+        p = Process(target = osm_pbf.xml_to_pbf,  # Keeps the memory of the
+                    args = (osm_file, pbf_path(osm_file)))  # stages' forks
+        p.start()
+        p.join()
+
+    results = {}
+    for stage in args.stages:
+        results[stage] = result = measure(stage, osm_file, reference_file)
+        print "{0:<20} {1:>10} elements {2:>8.2f}s {3:>12.0f} elements/s " \
+              "{4:>8.1f} MB".format(stage, result['elements'],
+              result['seconds'], result['rate'], result['peak_rss_mb'])
+
+    key = '{0}MB'.format(args.size)  # Baselines by size of file
+    try:
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    except IOError:
+        baselines = {}
+    if args.save_baseline:
+        baselines.setdefault(key, {}).update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent = 2, sort_keys = True,
+                      separators = (',', ': '))
+        print "Baseline saved to {0}".format(args.baseline)
+        return
+    if key not in baselines:
+        print "No baseline for {0}: run with --save-baseline".format(key)
+        return
+    regressions = compare(results, baselines[key], args.tolerance)
+    for regression in regressions:
+        print "REGRESSION " + regression
+    if regressions:
+        raise SystemExit(1)
+    print "No regression against {0}".format(args.baseline)
+
+if __name__ == '__main__':
+    main()
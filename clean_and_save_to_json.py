@@ -6,10 +6,270 @@ import xml.etree.cElementTree as ET
 import pprint
 
 
-# A.1.a. Data tags =============================================================
+# A.0. Single-pass audit engine ===============================================
+
+import bz2
+import gzip
+import os
+import re
+from collections import deque
+from multiprocessing import Pool, cpu_count
+
+from osm_pbf import decode_block, iter_pbf_elements, map_blocks
 
 filename = './Versailles.osm/Versailles.osm'
 
+compressed_ext = ('.bz2', '.gz')  # Input files decompressed on the fly
+streamed_ext = compressed_ext + ('.pbf',)  # Input files that can only be read
+# from start to end (no byte offsets into XML data)
+
+bz2_stream_re = re.compile(r'BZh[1-9]1AY&SY')  # Regex for the start of a bz2
+# stream: magic number, block size, then the magic number of its first block
+
+def find_bz2_streams(filename, block_size = 1 << 20):
+    ''' Returns the byte offsets where each stream of a bz2 file starts. Files
+    compressed by pbzip2 or lbzip2 are made of many independent streams, which 
+    can be decompressed in parallel; other files have a single stream.
+    '''
+    offsets = []
+    with open(filename, 'rb') as f:
+        position = 0
+        tail = ''  # End of the previous block, in case a header spans two
+        for block in iter(lambda: f.read(block_size), ''):
+            data = tail + block
+            for m in bz2_stream_re.finditer(data):
+                offset = position - len(tail) + m.start()
+                if not offsets or offset > offsets[-1]:
+                    offsets.append(offset)
+            position += len(block)
+            tail = data[-9:]
+    return offsets
+
+def decompress_bz2_range(args):
+    ''' Decompresses all the bz2 streams found between two byte offsets of a 
+    file. Runs in a worker process.
+    In:
+        args (tuple): filename, start, end
+    Out:
+        string: Decompressed data
+    '''
+    filename, start, end = args
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    out = []
+    while data:
+        decompressor = bz2.BZ2Decompressor()
+        out.append(decompressor.decompress(data))
+        data = decompressor.unused_data  # Next stream, if any
+    return ''.join(out)
+
+def iter_bz2(filename, processes = None, task_size = 4 << 20):
+    ''' Decompresses a bz2 file, yielding the decompressed data in chunks. 
+    Multi-stream files are decompressed in parallel by a pool of worker 
+    processes, task_size compressed bytes at a time. Only a few tasks run ahead
+    of the consumer, so memory stays bounded. Single-stream files are 
+    decompressed sequentially.
+    '''
+    offsets = find_bz2_streams(filename)
+    if len(offsets) < 2:  # Nothing to parallelize
+        decompressor = bz2.BZ2Decompressor()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), ''):
+                while block:
+                    try:
+                        data = decompressor.decompress(block)
+                    except EOFError:  # The previous stream ended exactly at
+                                      # the end of the previous block
+                        decompressor = bz2.BZ2Decompressor()
+                        continue
+                    if data:
+                        yield data
+                    block = decompressor.unused_data
+                    if block:  # A new stream starts within this block
+                        decompressor = bz2.BZ2Decompressor()
+        return
+    offsets.append(os.path.getsize(filename))
+    tasks = []  # Group consecutive streams into tasks of about task_size
+    start = offsets[0]
+    for offset in offsets[1:]:
+        if offset - start >= task_size or offset == offsets[-1]:
+            tasks.append((filename, start, offset))
+            start = offset
+    processes = processes or cpu_count()
+    pool = Pool(processes)
+    try:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(decompress_bz2_range, (task,)))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+class ChunkReader(object):
+    ''' Minimal read-only file object over an iterator of strings, so that 
+    ET.iterparse can consume data produced on the fly. '''
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = ''
+        self.position = 0  # In the current chunk
+
+    def read(self, size = -1):
+        parts = []
+        while size != 0:
+            if self.position >= len(self.chunk):
+                try:
+                    self.chunk = next(self.chunks)
+                except StopIteration:
+                    break
+                self.position = 0
+                continue
+            if size < 0:
+                part = self.chunk[self.position:]
+            else:
+                part = self.chunk[self.position:self.position + size]
+                size -= len(part)
+            self.position += len(part)
+            parts.append(part)
+        return ''.join(parts)
+
+def open_input(filename):
+    ''' Returns an object that ET.iterparse can read the OSM data from: 
+    .bz2 and .gz files are decompressed on the fly, without being staged on 
+    disk. Other file names and file objects are returned as they are.
+    '''
+    if not isinstance(filename, basestring):
+        return filename
+    elif filename.endswith('.bz2'):
+        return ChunkReader(iter_bz2(filename))
+    elif filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return filename
+
+xml_parser = 'etree'  # 'etree' (cElementTree), 'lxml', or None for lxml when
+# it is installed. lxml parses large files faster, but costs about 7MB more of
+# resident memory, which matters more on small extracts.
+
+def get_iterparse(parser = None):
+    ''' Returns the name and the iterparse function of an XML parser (see
+    xml_parser). Both build elements with the same API: lxml parses faster, 
+    and can skip elements by tag name in C.
+    '''
+    if parser is None:
+        parser = xml_parser
+    if parser != 'etree':
+        try:
+            from lxml import etree
+            return 'lxml', etree.iterparse
+        except ImportError:
+            if parser == 'lxml':
+                raise
+    return 'etree', ET.iterparse
+
+def iter_elements(filename, tags = None, parser = None):
+    ''' Same as ET.iterparse with 'end' events, except that each top-level
+    element (node, way, relation...) is cleared and released from the root once
+    it has been yielded. Only the current element is held in memory, so memory
+    use stays flat whatever the size of the file.
+    In:
+        filename (string or file object): OSM XML file to parse, possibly 
+            compressed (see open_input()), or OSM PBF file (.pbf)
+        tags (tuple): If set, only the elements with these tag names are 
+            yielded, e.g. ('node', 'way'), which is much faster with lxml
+        parser (string): XML parser to use, see xml_parser
+    Out:
+        generator: Fully built XML elements, children before their parent
+    '''
+    if isinstance(filename, basestring) and filename.endswith('.pbf'):
+        for elem in iter_pbf_elements(filename):  # Same elements, decoded in
+            if tags is None or elem.tag in tags:  # parallel
+                yield elem
+        return
+    name, iterparse = get_iterparse(parser)
+    if name == 'lxml' and tags is not None:
+        for event, elem in iterparse(open_input(filename), events = ('end',),
+                                     tag = tags):
+            yield elem
+            parent = elem.getparent()
+            if parent is not None and parent.getparent() is None:
+            # A direct child of the root: free it and its previous siblings,
+            # including those skipped by the tag filter
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del parent[0]
+        return
+    root = None
+    depth = 0  # 1 for the root itself, 2 for its direct children, etc.
+    for event, elem in iterparse(open_input(filename), 
+                                 events = ('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        if tags is None or elem.tag in tags:
+            yield elem
+        depth -= 1
+        if depth == 1:  # A direct child of the root (e.g. a whole node) is done
+            elem.clear()
+            if name == 'lxml':  # Elements only go away with their parent's 
+                while elem.getprevious() is not None:  # reference
+                    del root[0]
+            else:
+                root.clear()  # Drop references to the already processed 
+                              # siblings
+
+def run_audits(filename, audits):
+    ''' Parses the OSM file once and feeds every element to each audit. An audit
+    is any object with a visit(elem) method, called on each fully built element, 
+    and a result() method returning its report. Its element_tags attribute lists
+    the names of the elements it needs (None for all of them), so that the 
+    parser can skip the others.
+    In:
+        filename (string): Path to OSM XML file to assess
+        audits (list): Audit objects to feed, e.g. [TagCounter(), 
+            PositionChecker()]
+    Out:
+        list: Result of each audit, in the same order as audits
+    '''
+    for elem in iter_elements(filename, audited_tags(audits)):
+        for audit in audits:
+            audit.visit(elem)
+    return [audit.result() for audit in audits]
+
+def audited_tags(audits, tags = ()):
+    ''' Returns the tag names of the elements needed by audits in addition to
+    tags, or None if every element is needed (see iter_elements()). '''
+    tags = set(tags)
+    for audit in audits:
+        if getattr(audit, 'element_tags', None) is None:
+            return None
+        tags.update(audit.element_tags)
+    return tuple(sorted(tags))
+
+
+# A.1.a. Data tags =============================================================
+
+class TagCounter(object):
+    ''' Audit identifying unique tag types and counting occurences for each.
+    result() returns a dict with unique tag types as keys, counts as values.
+    '''
+    element_tags = None  # Every element
+
+    def __init__(self):
+        self.tags = {}
+
+    def visit(self, elem):
+        if not(elem.tag in self.tags):  # Create new dict key if not already there
+            self.tags[elem.tag] = 0
+        self.tags[elem.tag] += 1
+
+    def result(self):
+        return self.tags
+
 def count_tags(filename):
     ''' Identifies unique tag types and counts occurences for each
     In:
@@ -17,17 +277,7 @@ def count_tags(filename):
     Out:
         dict: Unique tag types as keys, counts as values   
     '''     
-    tags = {}
-    context = ET.iterparse(filename, events = ('start',))  # Detect starts only
-    for event, elem in context:     # Go through each element in the OSM XLM file
-        if not(elem.tag in tags):   # Create new dict key if not already there    
-            tags[elem.tag] = 0      
-        tags[elem.tag] += 1         
-    return tags
-    
-print "\nA.1.a. DATA TAGS:"
-pprint.pprint(count_tags(filename))
-raw_input("Press Enter to continue...")
+    return run_audits(filename, [TagCounter()])[0]
 
 
 # A.1.b. Latitude / longitude ==================================================
@@ -59,6 +309,36 @@ def is_within_bounds(f, bounds):
         return True
     return False
                
+class PositionChecker(object):
+    ''' Audit checking latitude and longitude of each node for validity and 
+    accuracy. See check_positions() for the meaning of result().
+    '''
+    element_tags = ('node',)
+
+    def __init__(self):
+        self.counts = {'Null': 0, 'Empty': 0, 'Non_number': 0, 
+                       'Out_of_bounds': 0, 'Correct': 0}
+
+    def visit(self, elem):
+        if elem.tag == 'node':  # Check for each node element
+            lat = elem.get('lat').strip()  # Get rid of unwanted spaces
+            lon = elem.get('lon').strip()
+            if (lat is None or lon is None):
+                self.counts['Null'] += 1
+            elif (lat == "" or lon == ""):
+                self.counts['Empty'] += 1
+            elif not (is_number(lat) and is_number(lon)):
+                self.counts['Non_number'] += 1
+            elif not (is_within_bounds(float(lat), lat_bounds) and 
+            is_within_bounds(float(lon), lon_bounds)):  
+            # If lat or lon is out of bounds:
+                self.counts['Out_of_bounds'] += 1
+            else:
+                self.counts['Correct'] += 1
+
+    def result(self):
+        return self.counts
+
 def check_positions(filename):  
     ''' Checks latitude and longitude for validity and accuracy
     In:
@@ -73,39 +353,42 @@ def check_positions(filename):
                              the bounds of the selected map area
             Correct -- none of the above occurs
     '''
-    counts = {'Null': 0, 'Empty': 0, 'Non_number': 0, 'Out_of_bounds': 0, 
-              'Correct': 0}
-    context = ET.iterparse(filename, events = ('start', )) # Detect starts only
-    for event, elem in context:
-        if elem.tag == 'node':  # Check for each node element
-            lat = elem.get('lat').strip()  # Get rid of unwanted spaces
-            lon = elem.get('lon').strip()
-            if (lat is None or lon is None):
-                counts['Null'] += 1
-            elif (lat == "" or lon == ""):
-                counts['Empty'] += 1
-            elif not (is_number(lat) and is_number(lon)):
-                counts['Non_number'] += 1
-            elif not (is_within_bounds(float(lat), lat_bounds) and 
-            is_within_bounds(float(lon), lon_bounds)):  
-            # If lat or lon is out of bounds:
-                counts['Out_of_bounds'] += 1
-            else:
-                counts['Correct'] += 1
-    return counts
-
-print "\nA.1.b. LATITUDE / LONGITUDE:"    
-pprint.pprint(check_positions(filename))
-raw_input("Press Enter to continue...")
+    return run_audits(filename, [PositionChecker()])[0]
 
 
 # A.1.c. Postcode format ======================================================
 
-import re
-
 postcode_re = re.compile(r'^\d{5}$')  # Regex match to an isolated string of 
                                       # 5 consecutive digits
 
+class PostcodeAuditor(object):
+    ''' Audit checking the format of every addr:postcode value found in nodes.
+    See audit_postcodes() for the meaning of result().
+    '''
+    element_tags = ('node',)
+
+    def __init__(self):
+        self.counts = {'Null': 0, 'Empty': 0, 'Incorrect': 0, 'Correct': 0}
+
+    def visit(self, elem):
+        if elem.tag == 'node':
+            for elt in elem.findall('tag'):
+                if elt.get('k') == 'addr:postcode':  
+                # If the tag contains a postcode field
+                    pc = elt.get('v').strip()  # Then get the postcode value
+                    if pc == None:
+                        self.counts['Null'] += 1
+                    elif pc == "":
+                        self.counts['Empty'] += 1
+                    elif not re.match(postcode_re, pc): 
+                    # If not in line with the 5-digit convention:
+                        self.counts['Incorrect'] += 1
+                    else:
+                        self.counts['Correct'] += 1
+
+    def result(self):
+        return self.counts
+
 def audit_postcodes(filename):
     ''' Checks postocde to ensure every tag with an addr:postcode key has a postcode 
     value and that they follow the standard French postcode format (5 
@@ -120,28 +403,7 @@ def audit_postcodes(filename):
                          the convention
             Correct -- none of the above occurs
     '''
-    counts = {'Null': 0, 'Empty': 0, 'Incorrect': 0, 'Correct': 0}
-    context = ET.iterparse(filename, events = ('start', )) # Detect starts only
-    for event, elem in context:
-        if elem.tag == 'node':
-            for elt in elem.findall('tag'):
-                if elt.get('k') == 'addr:postcode':  
-                # If the tag contains a postcode field
-                    pc = elt.get('v').strip()  # Then get the postcode value
-                    if pc == None:
-                        counts['Null'] += 1
-                    elif pc == "":
-                        counts['Empty'] += 1
-                    elif not re.match(postcode_re, pc): 
-                    # If not in line with the 5-digit convention:
-                        counts['Incorrect'] += 1
-                    else:
-                        counts['Correct'] += 1
-    return counts
-    
-print "\nA.1.c. POSTCODE FORMAT:"
-pprint.pprint(audit_postcodes(filename))
-raw_input("Press Enter to continue...")
+    return run_audits(filename, [PostcodeAuditor()])[0]
 
 
 # A.1.d. Street / way types ====================================================
@@ -196,6 +458,25 @@ def is_street_name(elem):
     return (elem.attrib['k'] == "addr:street")
     
 
+class StreetTypeAuditor(object):
+    ''' Audit applying audit_street_type to all nodes and ways containing a 
+    street name. See audit_all_streets() for the meaning of result().
+    '''
+    element_tags = ('node', 'way')
+
+    def __init__(self):
+        self.street_types = defaultdict(set)
+
+    def visit(self, elem):
+        if elem.tag == "node" or elem.tag == "way":
+            for tag in elem.iter("tag"):  # Iterate through all "tag" elements
+                if is_street_name(tag):   # Audit street type when the element 
+                                          # contains a street name
+                    audit_street_type(self.street_types, tag.attrib['v'])
+
+    def result(self):
+        return self.street_types
+
 def audit_all_streets(filename):
     ''' Applies audit_street_type to all elements of the OSM XML file containing a
     street name. Returns the collection of unexpected street types in the form 
@@ -209,18 +490,7 @@ def audit_all_streets(filename):
         ("expected"), values are sets containing all unique street names with
         these street types.
     '''
-    osm_file = open(filename, "r")
-    street_types = defaultdict(set)
-    
-    for event, elem in ET.iterparse(osm_file, events = ("start",)): 
-                                                            # Detect starts only
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):  # Iterate through all "tag" elements
-                if is_street_name(tag):   # Audit street type when the element 
-                                          # contains a street name
-                    audit_street_type(street_types, tag.attrib['v'])
-    osm_file.close()
-    return street_types
+    return run_audits(filename, [StreetTypeAuditor()])[0]
 
 '''Values to replace and to be repaced with:'''
 street_mapping = { u"allee": u"Allée",
@@ -239,10 +509,46 @@ street_mapping = { u"allee": u"Allée",
             u"Guyancourt": u"Rue Louis Breguet"
             }
 
+class StreetNameNormalizer(object):
+    ''' Street name corrector compiled once from a mapping (see 
+    update_street_name()). All the keys of the mapping are combined into a 
+    single regex anchored at the start of the name, longest key first, so each
+    name is corrected in a single match instead of one substitution per key. 
+    Results are memoized by raw street name, as the same few thousand streets
+    come back over and over.
+    '''
+    def __init__(self, mapping):
+        self.mapping = dict(mapping)
+        keys = sorted(self.mapping, key = len, reverse = True)
+        self.regex = re.compile(u'^(?:' + u'|'.join(re.escape(k) for k in keys)
+                                + u')')
+        self.cache = {}
+
+    def replace(self, match):
+        return self.mapping[match.group()]
+
+    def normalize(self, street_name):
+        try:
+            return self.cache[street_name]
+        except KeyError:
+            pass
+        better_name = street_name
+        for _ in self.mapping:  # A correction can expose another key at the 
+                                # start of the name, but never more than once
+                                # per key
+            new_name = self.regex.sub(self.replace, better_name, count = 1)
+            if new_name == better_name:
+                break
+            better_name = new_name
+        self.cache[street_name] = better_name
+        return better_name
+
+street_normalizers = {}  # StreetNameNormalizer for each mapping, by id()
+
 def update_street_name(street_name, mapping):
-    ''' Uses the mapping dictionary to correct street types: For each key in 
-    mapping, looks for it in street_name and replaces this string with the 
-    associated value (which is the correctly spelled street type).
+    ''' Uses the mapping dictionary to correct street types: if street_name 
+    starts with a key of mapping, replaces this string with the associated value
+    (which is the correctly spelled street type). The longest matching key wins.
     
     In: 
         street_name (string): Full street name possibly requiring a correction
@@ -251,45 +557,32 @@ def update_street_name(street_name, mapping):
     Out:
         string: Correctly spelled street name.
     '''
-    for bad_name in mapping:
-        match = re.compile('^' + bad_name)
-        try:  # Substitute the string bad_name with the associated value in 
-              # mapping. The rest of the street_name string is untouched.
-            street_name = re.sub(match, mapping[bad_name], street_name)
-        except LookupError:  # If this happens, we need to manually amend the 
-                             # mapping.
-            print "Missing entry in mapping"
-            continue
-    return street_name
-
-
-street_types = audit_all_streets(filename)
-print "\nA.1.d. STREET / WAY TYPES:"
-print "    o Unexpected street types:"
-pprint.pprint(street_types.keys())  # Print unexpected street types (without the
-                                    # related street names)
-raw_input("Press Enter to continue...")
-
-print "\n    o Transforming street names:"
-for street_type, ways in street_types.iteritems():  
-# For each unexpected street type:
-    for street_name in ways:
-        better_name = update_street_name(street_name, street_mapping)  
-        # Display replacements:
-        if street_name != better_name:
-            print street_name, "=>", better_name
-raw_input("Press Enter to continue...")
+    normalizer = street_normalizers.get(id(mapping))
+    if normalizer is None or normalizer.mapping != mapping:
+        # First call with this mapping, or it has been amended since
+        normalizer = StreetNameNormalizer(mapping)
+        street_normalizers[id(mapping)] = normalizer
+    return normalizer.normalize(street_name)
 
 
 # A.2. Accuracy and consistency ================================================
 
 from difflib import SequenceMatcher
+from collections import Counter
+import cPickle
 import csv
 
-pc_cities = set()
-    
-with open(filename, 'r') as osm_file:
-    for event, elem in ET.iterparse(osm_file, events = ("start",)):
+class PcCityCollector(object):
+    ''' Audit collecting all unique (postcode, city) combinations found in nodes 
+    and ways. result() returns a set of tuples, either member possibly None 
+    (but not both).
+    '''
+    element_tags = ('node', 'way')
+
+    def __init__(self):
+        self.pc_cities = set()
+
+    def visit(self, elem):
         if elem.tag == "node" or elem.tag == 'way':
             pc_tag = elem.find("./tag[@k='addr:postcode']")  # Use XPath command
             # to locate postcode in node or way
@@ -306,12 +599,10 @@ with open(filename, 'r') as osm_file:
                 elem_city = None
             if not (elem_pc is None and elem_city is None): # As long as at 
             # least one of postcode or city name exists, add to set:
-                pc_cities.add((elem_pc, elem_city))
-                
-print "\nA.2. ACCURACY AND CONSISTENCY"            
-print "\n    o All postcode / city combinations in file:"    
-pprint.pprint(pc_cities)
-raw_input("Press Enter to continue...")
+                self.pc_cities.add((elem_pc, elem_city))
+
+    def result(self):
+        return self.pc_cities
 
 city_to_pc_map = {
      u'78170': '78170',
@@ -382,6 +673,8 @@ def get_city_from_pc(pc, city, reference):
     Out:
         string: Corrected city name.
     '''
+    if isinstance(reference, PostcodeCityResolver):
+        return reference.city_from_pc(pc, city)
     if city:
         best_match = [None, 0.] 
         # Initialise: best_match[0] is for the best-matching city name, 
@@ -423,9 +716,9 @@ def correct_pc_city(pc, city, reference):
     In:
         pc (string): Postcode, potentially None or incorrect
         city (string): City name, potentially None or incorrect
-        reference (dict of lists): Reference data parsed from the reference file
-            where keys = postcodes and values = lists of city names associated
-            with the key postcode.
+        reference (dict of lists or PostcodeCityResolver): Reference data 
+            parsed from the reference file where keys = postcodes and values = 
+            lists of city names associated with the key postcode.
     Out:
         tuple of strings: Corrected postcode, corrected city name
     '''
@@ -453,20 +746,93 @@ def correct_pc_city(pc, city, reference):
         new_city = pc_to_city_map[new_pc]
         
     return new_pc, new_city
-            
 
-ref_data = parse_reference_file(laposte_file)
 
-pc_city = set()
-for pc, city in pc_cities:  # Apply correct_pc_city() to all postcode/city 
-    # combinations found in the OSM XML file:
-    new_pc, new_city = correct_pc_city(pc, city, ref_data)
-    #print 'OUTCOME: ', new_pc, new_city, '\n'
-    pc_city.add((new_pc, new_city))
+class PostcodeCityResolver(object):
+    ''' Indexed version of the reference data, giving the same answers as 
+    get_city_from_pc() and correct_pc_city() for a fraction of the cost:
+    - the character profile of every candidate city name is computed once. It 
+    gives an upper bound of SequenceMatcher.ratio() (the same bound as 
+    SequenceMatcher.quick_ratio()), so candidates that cannot beat the best 
+    match so far are never scored;
+    - (postcode, city) results are memoized, and there are only a few hundred
+    distinct combinations in the whole file.
+    '''
+    def __init__(self, reference, profiles = None):
+        self.reference = reference
+        if profiles is None:
+            profiles = {}  # Postcode -> list of (candidate, char counts)
+            for pc, cities in reference.iteritems():
+                profiles[pc] = [(c, Counter(c)) for c in cities]
+        self.profiles = profiles
+        self.cache = {}
+
+    def city_from_pc(self, pc, city):
+        ''' Same as get_city_from_pc(pc, city, reference), not memoized. '''
+        candidates = self.profiles.get(pc, [])
+        if not city:  # No city name: pick the first one for this postcode
+            return candidates[0][0] if candidates else None
+        name = city.title()
+        counts = Counter(name)
+        bounds = []
+        for i, (c, c_counts) in enumerate(candidates):
+            total = len(c) + len(name)
+            if total:
+                matches = sum(min(n, c_counts[char]) 
+                              for char, n in counts.iteritems())
+                bounds.append((2. * matches / total, i))
+            else:
+                bounds.append((1., i))
+        bounds.sort(reverse = True)
+        best_match = [None, -1., -1]  # City name, match ratio, index
+        for bound, i in bounds:
+            if bound < best_match[1]:  # No remaining candidate can do better
+                break
+            c = candidates[i][0]
+            match_ratio = SequenceMatcher(None, c, name).ratio()
+            # Ties go to the candidate listed last, as in get_city_from_pc()
+            if (match_ratio, i) > (best_match[1], best_match[2]):
+                best_match = [c, match_ratio, i]
+        return best_match[0]
+
+    def correct(self, pc, city):
+        ''' Memoized correct_pc_city(pc, city, reference). '''
+        try:
+            return self.cache[(pc, city)]
+        except KeyError:
+            result = correct_pc_city(pc, city, self)
+            self.cache[(pc, city)] = result
+            return result
+
+def load_reference(filename):
+    ''' Returns a PostcodeCityResolver for the La Poste reference file. The 
+    parsed and indexed data is saved next to the reference file (filename + 
+    '.idx') and reused on the next runs, until the reference file is modified.
     
-print "\n    o All postcode/city combinations after corrections:"        
-pprint.pprint(pc_city)  # Outcome of our manipulations
-raw_input("Press Enter to continue...")
+    In: 
+        filename (string): Path to the reference file
+    Out:
+        PostcodeCityResolver: Indexed reference data
+    '''
+    index_file = filename + '.idx'
+    stat = os.stat(filename)
+    stamp = (stat.st_mtime, stat.st_size)
+    try:
+        with open(index_file, 'rb') as f:
+            index_stamp, reference, profiles = cPickle.load(f)
+        if index_stamp == stamp:
+            return PostcodeCityResolver(reference, profiles)
+    except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+        pass  # No usable index: rebuild it
+    resolver = PostcodeCityResolver(parse_reference_file(filename))
+    try:
+        with open(index_file, 'wb') as f:
+            cPickle.dump((stamp, resolver.reference, resolver.profiles), f, 
+                         cPickle.HIGHEST_PROTOCOL)
+    except IOError:  # E.g. read-only directory: keep going without an index
+        pass
+    return resolver
+
 
 
 # B.1. Data load into a MongoDB database =======================================
@@ -486,6 +852,10 @@ raw_input("Press Enter to continue...")
             },
     "lat": 41.9757030,
     "lon": -87.6921867,
+    "loc": {
+              "type": "Point",
+              "coordinates": [-87.6921867, 41.9757030]
+            },
     "address": {
               "housenumber": "5157",
               "postcode": "60625",
@@ -499,12 +869,19 @@ raw_input("Press Enter to continue...")
 ...
 ]
 
+Ways have no "lat" / "lon" values but a "node_refs" list of node ids. When a 
+NodeIndex is used, they also get a "loc" point at their centroid, a "bbox" and
+a GeoJSON "geometry" (see add_way_geometry()).
+
+The point is named "loc" rather than "location", which is an OSM tag key too 
+(e.g. location=underground), so that tag values stay out of the 2dsphere index.
 '''
 
 import codecs
 import json
-from random import sample, seed
-seed(123)
+from random import Random
+sampler = Random(123)  # Reservoir sampling of process_map(), seeded for 
+# reproducible samples without reseeding the random module of the importer
 
 lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')  # Regex for two pieces
 # of lowercase strings separated by a colon character
@@ -514,37 +891,42 @@ problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')  # Regex for any
 CREATED = [ "version", "changeset", "timestamp", "user", "uid"]  
 # Keys to retain in the 'created' field
 
-def process_tags(tag, tag_id):
-    ''' Parses node tags and way tags as per convention. Assumes no problematic 
-    characters.
-    
-    In:
-        tag (XML element): A node or way's "tag" sub-element from the OSM XML
-            data
-        tag_id (string): The node or way's "id" attribute
-    Out:
-        dict: Contains the following key:value pairs:
-            'id': node or way id
-            'key': "tag" sub-element's key (anything after the colon in the 
-                'k' attribute)
-            'value': "tag" sub-element's value ('v' attribute)
-            'type': "tag" sub-element's type (anything before the colon in the 
-                'k' attribute) if there is a colon, None otherwise
-    '''
-    k = tag.get('k').strip()
-    v = tag.get('v').strip()
-    if re.match(lower_colon, k):  # If there is a ':' in the tag key:
-        tag_type, tag_key = k.split(':', 1)  # tag_type is anything before ':', 
-                                             # tag_key is anything after
-        tag_value = v
-        if tag_type == "addr":
-            tag_type = "address"  # Use correct spelling
-    else:   # If there isn't a ':' in the tag key:
-        tag_type = None  # Returns None as the tag type
-        tag_key = k
-        tag_value = v
-    return  {'id': tag_id, 'key': tag_key, 'value': tag_value, 'type': tag_type}
-    # Return as a dict for convenience
+tag_keys = {}  # Raw 'k' attribute -> classification, see classify_tag_key()
+tag_keys_size = 100000  # Keys are a small vocabulary, but free-form keys 
+# could make the table grow without bound: stop adding past this size
+
+def classify_tag_key(k):
+    ''' Decides what shape_element() does with a tag key: keys with 
+    problematic characters or more than one colon are dropped, keys made of 
+    two lowercase parts separated by a colon go to a dict named after the 
+    first part ('addr' being spelled 'address'), and other keys are used as 
+    they are. Decisions are memoized, as a few hundred keys come back millions
+    of times.
+    
+    In:
+        k (string): Raw 'k' attribute of a "tag" sub-element
+    Out:
+        tuple or None: None if the tag is dropped (problematic character at 
+            the start of the key, or more than one ':'), (None, key) for a 
+            flat key, (type, key) for a key nested in a dict, e.g. 
+            ('address', 'postcode') for 'addr:postcode'
+    '''
+    try:
+        return tag_keys[k]
+    except KeyError:
+        pass
+    if re.match(problemchars, k) or k.count(':') > 1:
+        shape = None
+    else:
+        key = k.strip()
+        if re.match(lower_colon, key):
+            tag_type, key = key.split(':', 1)
+            shape = ("address" if tag_type == "addr" else tag_type, key)
+        else:
+            shape = (None, key)
+    if len(tag_keys) < tag_keys_size:
+        tag_keys[k] = shape
+    return shape
     
 def shape_element(element):
     ''' Converts an XML element to the selected JSON schema.
@@ -570,88 +952,1531 @@ def shape_element(element):
             node['lat'] = element.get('lat')
             node['lon'] = element.get('lon')
         
-        '''"Tag" sub-elements require specific treatment:'''
-        for t in element.findall('tag'):  # For each sub-element tagged "tag":
-            if not re.match(problemchars, t.get('k')) and \
-                len(re.findall(':', t.get('k'))) <= 1: 
-            # (i.e. ignore when there are problem chars or more than one ':')
-                tag_content = process_tags(t, element.get('id'))  
-                # Parse tag and extract id, key, value and type
-                if tag_content['type'] is not None:  
-                # ie. if the 'k' field contained a colon character
-                    if (tag_content['type'] not in node.keys()) or \
-                        not (isinstance(node[tag_content['type']], dict)):
-                    # Initialise an empty dict if there is no key of this 'type'
-                    # or its value is not already a dict
-                        node[tag_content['type']] = {}
-                    node[tag_content['type']][tag_content['key']] = \
-                        tag_content['value']
-                    # for instance: node['address']['postcode'] = '78100'
-                else: # ie. if the 'k' field didn't contain a colon character
-                    node[tag_content['key']] = tag_content['value']
+        '''"Tag" sub-elements require specific treatment (see add_tags()):'''
+        add_tags(node, [(t.get('k'), t.get('v')) 
+                        for t in element.iterfind('tag')])
+        
+        ''' GeoJSON point for MongoDB's 2dsphere index (longitude first):'''
+        if isinstance(node['lat'], float) and isinstance(node['lon'], float):
+            node['loc'] = {'type': 'Point', 
+                           'coordinates': [node['lon'], node['lat']]}
         
         ''' For "nd" tags, we collect all nodes contained in the way:'''
-        for t in element.findall('nd'):  
-            if 'node_refs' not in node.keys():
-                node['node_refs'] = []
-            node['node_refs'].append(t.get('ref'))
+        node_refs = [t.get('ref') for t in element.iterfind('nd')]
+        if node_refs:
+            node['node_refs'] = node_refs
                     
         return node
     else:
         return None
 
+def add_tags(node, tags):
+    ''' Adds the tags of an element to its dict, see classify_tag_key() for the
+    rules.
+    
+    In:
+        node (dict): Element being shaped by shape_element() or shape_entity()
+        tags (list): (k, v) pairs of the "tag" sub-elements
+    '''
+    for k, v in tags:
+        shape = classify_tag_key(k)
+        if shape is None:  # Problem chars or more than one ':'
+            continue
+        tag_type, tag_key = shape
+        if tag_type is not None:  # ie. if the 'k' field contained a colon
+            sub = node.get(tag_type)
+            if not isinstance(sub, dict):
+            # Initialise an empty dict if there is no key of this 'type'
+            # or its value is not already a dict
+                sub = node[tag_type] = {}
+            sub[tag_key] = v.strip()
+            # for instance: node['address']['postcode'] = '78100'
+        else: # ie. if the 'k' field didn't contain a colon character
+            node[tag_key] = v.strip()
+
+def shape_entity(entity):
+    ''' Same as shape_element(), for a node or way decoded from an OSM PBF 
+    file without going through an XML element.
+    
+    In:
+        entity (tuple): As returned by osm_pbf.decode_block(), its info in the
+            order of CREATED
+    Out:
+        dict: Same dict as shape_element() for the equivalent XML element
+    '''
+    tag, element_id, info, lat, lon, tags, refs, members = entity
+    if tag != "node" and tag != "way":
+        return None
+    # Same keys, set in the same order as in shape_element(); lat and lon are
+    # floats for the nodes, None for the ways
+    node = {'id': element_id, 'type': tag, 'visible': info[5],
+            'created': dict(zip(CREATED, info)), 'lat': lat, 'lon': lon}
+    if tags:
+        add_tags(node, tags)
+    if isinstance(node['lat'], float) and isinstance(node['lon'], float):
+        node['loc'] = {'type': 'Point', 
+                       'coordinates': [node['lon'], node['lat']]}
+    if refs:
+        node['node_refs'] = refs
+    return node
+
+
+# B.1.a. JSON writers =========================================================
+
+try:  # Faster serializer, if installed. Its output is valid JSON as well.
+    import ujson
+    dumps = ujson.dumps
+except ImportError:
+    dumps = json.dumps
+
+compression_ext = {None: '', 'gzip': '.gz', 'zstd': '.zst'}  # File extensions
+
+def output_path(file_in, compression = None):
+    ''' Returns the path of the JSON file converted from file_in (without
+    the extension of file_in if it is compressed). '''
+    root, ext = os.path.splitext(file_in)
+    if ext in streamed_ext:
+        file_in = root
+    return "{0}.json{1}".format(file_in, compression_ext[compression])
+
+def open_output(path, compression = None):
+    ''' Opens path for writing, through a streaming compressor if compression
+    is 'gzip' or 'zstd' (the latter requires the zstandard package). Compressed
+    output can be fed to mongoimport through a pipe, e.g. 
+    "gunzip -c Versailles.osm.json.gz | mongoimport ...".
+    '''
+    if compression is None:
+        return open(path, 'wb')
+    elif compression == 'gzip':
+        return gzip.open(path, 'wb', compresslevel = 6)
+    elif compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+    raise ValueError("Unknown compression: {0}".format(compression))
+
+class JsonLinesWriter(object):
+    ''' Writes documents to a JSON-lines file, one document per line. Lines 
+    are buffered and written batch_size at a time, serialized with ujson when
+    it is installed. pretty=True indents the documents with the standard json
+    module (for debugging only: the file is then not JSON-lines any more).
+    '''
+    def __init__(self, path, compression = None, pretty = False, 
+                 batch_size = 1000, offset = None):
+        ''' If offset is given, the existing (uncompressed) file is truncated
+        at that position and appended to, instead of being overwritten. '''
+        if offset is None:
+            self.fo = open_output(path, compression)
+        elif compression is None:
+            self.fo = open(path, 'r+b')
+            self.fo.seek(offset)
+            self.fo.truncate()
+        else:
+            raise ValueError("Compressed output cannot be appended to")
+        self.pretty = pretty
+        self.batch_size = batch_size
+        self.buffer = []
+
+    def write(self, el):
+        if self.pretty:
+            self.buffer.append(json.dumps(el, indent=2))
+        else:
+            self.buffer.append(dumps(el))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.fo.write("\n".join(self.buffer) + "\n")
+            self.buffer = []
+
+    def sync(self):
+        ''' Writes everything to disk and returns the position in the file. '''
+        self.flush()
+        self.fo.flush()
+        os.fsync(self.fo.fileno())
+        return self.fo.tell()
+
+    def close(self):
+        self.flush()
+        self.fo.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def clean_element(el, reference, metrics = None):
+    ''' Applies cleaning procedures to the address fields of a shaped element:
+    street names, postcodes and cities. el is updated in place.
+    
+    In:
+        el (dict): Element shaped by shape_element()
+        reference (PostcodeCityResolver): Reference data, as returned by 
+            load_reference().
+        metrics (Metrics): If given, the time spent on street names and on 
+            postcodes / cities, and the hits of their memos, are recorded in it
+            (see metrics.py).
+    Out:
+        dict: el, for convenience
+    '''
+    if 'address' in el: 
+        if 'street' in el['address']:  # Clean up street names
+            if metrics is not None:
+                normalizer = street_normalizers.get(id(street_mapping))
+                metrics.lookup('street_names', normalizer is not None and 
+                               el['address']['street'] in normalizer.cache)
+                start = metrics.clock()
+            el['address']['street'] = \
+                update_street_name(el['address']['street'], street_mapping)
+            if metrics is not None:
+                metrics.add('street_names', start)
+        if 'postcode' in el['address'] or 'city' in el['address']:  
+        # Clean up postcodes & cities
+        # We ensure either postcode or city (or both) is present
+            try:
+                pc = el['address']['postcode']  # Postcode present
+            except KeyError:
+                pc = None  # Postcode is absent
+            try:
+                city = el['address']['city']  # City present
+            except KeyError:
+                city = None  # City is absent
+            if metrics is not None:
+                metrics.lookup('postcodes_cities', (pc, city) in reference.cache)
+                start = metrics.clock()
+            el['address']['postcode'], el['address']['city'] = \
+                reference.correct(pc, city) 
+            # Apply clean-up function to postcode and city name
+            if metrics is not None:
+                metrics.add('postcodes_cities', start)
+    return el
+
 
-def process_map(file_in, pretty = False):
+def iter_documents(file_in, reference, audits = (), node_index = None,
+                   metrics = None):
+    ''' Iterates through the OSM file and yields each node and way shaped as 
+    per the JSON schema, with its address fields cleaned up.
+    
+    In:
+        file_in (string or file object): OSM XML file to clean up, or OSM PBF
+            file (.pbf), whose blocks are then shaped and cleaned by worker 
+            processes unless there are audits (see iter_pbf_documents())
+        reference (PostcodeCityResolver): Reference data, as returned by 
+            load_reference().
+        audits (list): Optional audit objects (see run_audits()) fed from the
+            same parse.
+        node_index (NodeIndex): If given, node coordinates are stored in it
+            and used to add geometries to the ways (see add_way_geometry()).
+            OSM files list all nodes before the ways.
+        metrics (Metrics): If given, the time spent in each stage is recorded
+            in it (see metrics.py).
+    Out:
+        generator: One dict per node or way
+    '''
+    if (isinstance(file_in, basestring) and file_in.endswith('.pbf') and 
+        not audits):
+        documents = iter_pbf_documents(file_in, reference, metrics)
+    else:
+        documents = iter_xml_documents(file_in, reference, audits, metrics)
+    for el in documents:
+        if node_index is not None:
+            if metrics is not None:
+                start = metrics.clock()
+            if el['type'] == 'node':
+                if 'loc' in el:  # Valid coordinates
+                    node_index.add(el['id'], el['lat'], el['lon'])
+            elif el['type'] == 'way':
+                add_way_geometry(el, node_index)
+            if metrics is not None:
+                metrics.add('geometry', start)
+        if metrics is not None:
+            metrics.count(el['type'])
+            metrics.document()
+        yield el
+
+def iter_xml_documents(file_in, reference, audits = (), metrics = None):
+    ''' Parses the elements of the file and yields them shaped and cleaned, 
+    see iter_documents(). '''
+    elements = iter_elements(file_in, audited_tags(audits, ('node', 'way')))
+    if metrics is not None:
+        elements = metrics.timed('parse', elements)
+    for element in elements:
+        if metrics is not None:
+            start = metrics.clock()
+        for audit in audits:
+            audit.visit(element)
+        if metrics is not None:
+            if audits:
+                metrics.add('audits', start)
+            start = metrics.clock()
+        el = shape_element(element)  # Create a properly shaped JSON-type 
+                                     # element as per defined schema.
+        if metrics is not None:
+            metrics.add('shape_element', start)
+        if el:
+            yield clean_element(el, reference, metrics)
+
+def iter_pbf_documents(file_in, reference, metrics = None, processes = None):
+    ''' Yields the nodes and ways of an OSM PBF file shaped and cleaned, see
+    iter_documents(). Blocks are decoded, shaped and cleaned by worker 
+    processes (see shape_pbf_block()), instead of going through XML elements.
+    With a single process, they are decoded in this process and the elements
+    are shaped one at a time as they are consumed: the documents of a whole 
+    block would be as many more objects for the garbage collector to go 
+    through.
+    
+    In:
+        processes (int): Number of worker processes. Defaults to the number of
+            CPUs.
+    '''
+    if (processes or cpu_count()) == 1:
+        blocks = map_blocks(file_in, decode_block, 1)
+        if metrics is not None:
+            blocks = metrics.timed('parse', blocks)
+        for entities in blocks:
+            for el in shape_entities(entities, reference, metrics):
+                yield el
+        return
+    blocks = map_blocks(file_in, shape_pbf_block, processes, 
+                        initializer = init_worker, 
+                        initargs = (reference, metrics is not None))
+    for documents, totals in blocks:
+        if metrics is not None:
+            metrics.merge(totals)
+        for el in documents:
+            yield el
+
+def shape_entities(entities, reference, metrics = None):
+    ''' Shapes and cleans the nodes and ways among entities decoded from an 
+    OSM PBF file (see osm_pbf.decode_block()).
+    Out:
+        generator: One dict per node or way
+    '''
+    for entity in entities:
+        if metrics is not None:
+            start = metrics.clock()
+        el = shape_entity(entity)
+        if metrics is not None:
+            metrics.add('shape_element', start)
+        if el:
+            yield clean_element(el, reference, metrics)
+
+
+def process_map(file_in, reference, pretty = False, audits = (),
+                sample_size = None, node_index = None, checkpoint_every = None,
+                resume = False, compression = None, metrics = None):
     ''' Iterates through the OSM file and saves it into a correctly formatted JSON 
     file, applying cleaning procedures along the way.
     
     In:
         file_in (string): Path to OSM XML file to clean up and convert to JSON
+        reference (dict of lists or PostcodeCityResolver): Reference data, as
+            returned by parse_reference_file() or load_reference().
         pretty (bool): If True, add whitespaces as required to the JSON file to
             ensure a pretty formatting. False (default) for large data as 
-            prettyfying is expansive.
+            prettyfying is expansive. For debugging only.
+        audits (list): Optional audit objects (see run_audits()) fed from the
+            same parse, so the audits don't need a pass of their own.
+        sample_size (int): If None (default), all elements are kept and
+            returned. Otherwise the run is fully streamed and only a uniform
+            random sample of sample_size elements is kept (reservoir
+            sampling), so memory use does not grow with the file size.
+        node_index (NodeIndex): If given, ways get a centroid, a bounding box
+            and a geometry, see iter_documents().
+        checkpoint_every (int): If set, the file is converted in segments of 
+            about this many bytes, cut on element boundaries, and a checkpoint
+            is saved to the JSON file's path + '.ckpt' after each segment.
+            Cannot be used with audits, which need the whole file.
+        resume (bool): If True and a checkpoint exists, the JSON file is 
+            truncated to the last checkpoint and the conversion restarts from
+            there instead of from the beginning. Requires checkpoint_every.
+        compression (string): None (default), 'gzip' or 'zstd' to compress the
+            JSON file on the fly (see open_output()). The file name gets a .gz
+            or .zst extension. Not compatible with checkpoint_every.
+        metrics (Metrics): If given, the time spent in each stage (parsing, 
+            shaping, cleaning, writing...) is recorded in it, see metrics.py.
     Out:
-        list of dicts: JSON-formatted data, identical to the data saved to disk.
+        list of dicts: JSON-formatted data, identical to the data saved to disk
+            (or a random sample of it if sample_size is set). After a resume,
+            only the elements converted by this run are included.
     '''
-    file_out = "{0}.json".format(file_in)
+    if not isinstance(reference, PostcodeCityResolver):
+        reference = PostcodeCityResolver(reference)
+    if checkpoint_every is None and resume:
+        raise ValueError("resume requires checkpoint_every")
+    if checkpoint_every is not None and audits:
+        raise ValueError("audits cannot be checkpointed, run them separately")
+    if checkpoint_every is not None and compression is not None:
+        raise ValueError("compressed output cannot be checkpointed")
+    if checkpoint_every is not None and file_in.endswith(streamed_ext):
+        raise ValueError("compressed or PBF input cannot be checkpointed")
+    file_out = output_path(file_in, compression)
+    checkpoint_file = file_out + '.ckpt'
+    state = {'input_offset': 0, 'output_offset': 0, 'count': 0}
+    if resume and os.path.exists(checkpoint_file):
+        with open(checkpoint_file, 'r') as f:
+            state = json.load(f)
+        # Drop whatever was written after the checkpoint:
+        writer = JsonLinesWriter(file_out, None, pretty, 
+                                 offset = state['output_offset'])
+        if node_index is not None:
+            refill_node_index(node_index, file_out, pretty)
+    else:
+        writer = JsonLinesWriter(file_out, compression, pretty)
+    if checkpoint_every is None:
+        documents = ((el, None) 
+                     for el in iter_documents(file_in, reference, audits, 
+                                              node_index, metrics))
+    else:
+        documents = iter_segment_documents(file_in, reference, node_index,
+                                           checkpoint_every, 
+                                           state['input_offset'], metrics)
     data = []
-    with codecs.open(file_out, "w") as fo:
-        for _, element in ET.iterparse(file_in):
-            el = shape_element(element)  # Create a properly shaped JSON-type 
-                                         # element as per defined schema.
-            if el:           
-                ''' Apply cleaning procedures to the address fields: 
-                street names, postcodes and cities: '''
-                if 'address' in el: 
-                    if 'street' in el['address']:  # Clean up street names
-                        el['address']['street'] = \
-                            update_street_name(
-                                el['address']['street'], street_mapping
-                                              )
-                    if 'postcode' in el['address'] or 'city' in el['address']:  
-                    # Clean up postcodes & cities
-                    # We ensure either postcode or city (or both) is present
-                        try:
-                            pc = el['address']['postcode']  # Postcode present
-                        except KeyError:
-                            pc = None  # Postcode is absent
-                        try:
-                            city = el['address']['city']  # City present
-                        except KeyError:
-                            city = None  # City is absent
-                        el['address']['postcode'], el['address']['city'] = \
-                            correct_pc_city(pc, city, ref_data) 
-                        # Apply clean-up function to postcode and city name
+    n_shaped = state['count']  # Number of elements written so far
+    with writer:
+        for el, input_offset in documents:
+            if el is None:  # End of a segment: save a checkpoint
+                state = {'input_offset': input_offset, 
+                         'output_offset': writer.sync(), 'count': n_shaped}
+                save_checkpoint(checkpoint_file, state)
+                continue
+            if sample_size is None or len(data) < sample_size:
                 data.append(el)
-                if pretty:
-                    fo.write(json.dumps(el, indent=2)+"\n")
-                else:
-                    fo.write(json.dumps(el) + "\n")  # Prefered for large 
-                    # datasets as prettyfying the JSON file is expansive
+            else:  # Reservoir sampling: keep el with probability
+                   # sample_size / (n_shaped + 1)
+                i = sampler.randint(0, n_shaped)
+                if i < sample_size:
+                    data[i] = el
+            n_shaped += 1
+            if metrics is not None:
+                start = metrics.clock()
+            writer.write(el)
+            if metrics is not None:
+                metrics.add('json_write', start)
+    if os.path.exists(checkpoint_file):  # The run is complete
+        os.remove(checkpoint_file)
     return data
 
-data = process_map('./Versailles.osm/Versailles.osm', False)
+def iter_segment_documents(file_in, reference, node_index, segment_size, 
+                           start = 0, metrics = None):
+    ''' Same as iter_documents(), but the file is read in segments of about 
+    segment_size bytes cut on element boundaries (see find_shards()), starting
+    at byte offset start. The segments are cut from start, so a resumed run 
+    can use another segment size than the interrupted one.
+    
+    Out:
+        generator: (document, None) tuples, followed at the end of each 
+            segment by (None, offset), offset being where the next segment 
+            starts in the file.
+    '''
+    with open(file_in, 'rb') as f:
+        for seg_start, seg_end in find_shards(file_in, segment_size, start):
+            f.seek(seg_start)
+            chunk = f.read(seg_end - seg_start)
+            for el in iter_documents(StringIO('<osm>' + chunk + '</osm>'), 
+                                     reference, (), node_index, metrics):
+                yield el, None
+            yield None, seg_end
+
+def save_checkpoint(checkpoint_file, state):
+    ''' Atomically writes the checkpoint state (a dict) as JSON. '''
+    with open(checkpoint_file + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.rename(checkpoint_file + '.tmp', checkpoint_file)
+
+def refill_node_index(node_index, file_out, pretty = False):
+    ''' Adds the nodes already written to a JSON file to node_index, so that 
+    the ways converted after a resume still get their geometries.
+    '''
+    if pretty:
+        raise ValueError("cannot read back nodes from a pretty-printed file")
+    with codecs.open(file_out, "r") as fi:
+        for line in fi:
+            el = json.loads(line)
+            if 'loc' in el and el['type'] == 'node':
+                node_index.add(el['id'], el['lat'], el['lon'])
+
+
+# B.1.b. Parallel conversion ===================================================
+
+import shutil
+from cStringIO import StringIO
+
+element_start_re = re.compile(r'<(?:node|way|relation)[\s/>]')  # Regex for the
+# opening of a top-level OSM element. Nodes, ways and relations are never
+# nested, so any match is a safe place to cut the file.
+
+def find_element_start(f, offset, block_size = 1 << 16):
+    ''' Returns the byte offset of the first top-level element starting at or 
+    after offset in the open file f, or None if there is none.
+    '''
+    f.seek(offset)
+    tail = ''  # End of the previous block, in case a match spans two blocks
+    while True:
+        block = f.read(block_size)
+        if not block:
+            return None
+        m = element_start_re.search(tail + block)
+        if m:
+            return offset - len(tail) + m.start()
+        offset += len(block)
+        tail = block[-10:]
+
+def find_shards(file_in, shard_size, start = 0):
+    ''' Splits the OSM file into byte ranges of roughly shard_size bytes, each 
+    starting on a top-level element boundary, so that every range is a valid 
+    sequence of complete <node>, <way> and <relation> elements.
+    
+    In:
+        file_in (string): Path to the OSM XML file
+        shard_size (int): Target size of each shard, in bytes
+        start (int): Byte offset where the first shard starts, or before it
+    Out:
+        list of tuples: (start, end) byte offsets of each shard, in file order
+    '''
+    if file_in.endswith(streamed_ext):
+        raise ValueError("Shards need an uncompressed XML file, not " + file_in)
+    shards = []
+    with open(file_in, 'rb') as f:
+        f.seek(0, 2)
+        size = f.tell()
+        f.seek(max(0, size - (1 << 16)))
+        data_end = f.tell() + f.read().rfind('</osm>')  # Stop before the 
+                                                        # closing root tag
+        start = find_element_start(f, start)
+        while start is not None and start < data_end:
+            end = find_element_start(f, start + shard_size)
+            if end is None or end > data_end:
+                end = data_end
+            shards.append((start, end))
+            start = end
+    return shards
+
+worker_state = {}  # State of a worker process, set by init_worker()
+
+def init_worker(reference, instrument = False):
+    ''' Pool initializer: keeps the PostcodeCityResolver for all the shards (or
+    PBF blocks) of the worker, so it is sent once per worker instead of once 
+    per shard, and its memo is kept from one shard to the next. With 
+    instrument, the shards are timed (see process_shard() and 
+    shape_pbf_block()). '''
+    worker_state['reference'] = reference
+    worker_state['instrument'] = instrument
+
+def shape_pbf_block(blob):
+    ''' Decodes one block of an OSM PBF file, and shapes and cleans its nodes
+    and ways. Runs in a worker process started with init_worker().
+    
+    In:
+        blob (string): Encoded OSMData blob, see osm_pbf.read_blobs()
+    Out:
+        tuple: List of the documents, in file order, and the totals() of the 
+            Metrics of the block if the worker is instrumented (None otherwise)
+    '''
+    reference = worker_state['reference']
+    metrics = Metrics() if worker_state['instrument'] else None
+    if metrics is not None:
+        start = metrics.clock()
+    entities = decode_block(blob)
+    if metrics is not None:
+        metrics.add('parse', start)
+    documents = list(shape_entities(entities, reference, metrics))
+    return documents, metrics and metrics.totals()
+
+def process_shard(args):
+    ''' Shapes and cleans every element of one shard of the OSM file and writes
+    them to a JSON-lines part file. Runs in a worker process started with 
+    init_worker().
+    
+    In:
+        args (tuple): file_in, start, end, part_out, compression -- the path 
+            to the OSM file, the byte range of the shard, the path to the part
+            file to write and the compression of the part file.
+    Out:
+        tuple: Number of elements written, and the totals() of the Metrics of
+            the shard if the worker is instrumented (None otherwise)
+    '''
+    file_in, start, end, part_out, compression = args
+    reference = worker_state['reference']
+    metrics = Metrics() if worker_state['instrument'] else None
+    with open(file_in, 'rb') as f:
+        f.seek(start)
+        chunk = f.read(end - start)
+    count = 0
+    with JsonLinesWriter(part_out, compression) as writer:
+        for el in iter_documents(StringIO('<osm>' + chunk + '</osm>'), 
+                                 reference, metrics = metrics):
+            if metrics is not None:
+                write_start = metrics.clock()
+            writer.write(el)
+            if metrics is not None:
+                metrics.add('json_write', write_start)
+            count += 1
+    return count, metrics and metrics.totals()
+
+def process_map_parallel(file_in, reference, processes = None, 
+                         shard_size = 32 << 20, compression = None, 
+                         metrics = None):
+    ''' Parallel version of process_map(): the OSM file is split into shards 
+    on element boundaries, each shard is shaped, cleaned and written to its own
+    part file by a pool of worker processes, then the parts are merged in 
+    order. The output file is identical to process_map()'s.
+    
+    In:
+        file_in (string): Path to OSM XML file to clean up and convert to JSON
+        reference (dict of lists or PostcodeCityResolver): Reference data, as
+            returned by parse_reference_file() or load_reference().
+        processes (int): Number of worker processes. Defaults to the number of
+            CPUs.
+        shard_size (int): Approximate size of each shard, in bytes (default 
+            32MB).
+        compression (string): None, 'gzip' or 'zstd', see process_map(). Each 
+            part is compressed by its worker; gzip and zstd streams remain 
+            valid once concatenated.
+        metrics (Metrics): If given, the workers record the time spent in each
+            stage, which is added to it as each shard is done (see metrics.py)
+    Out:
+        int: Number of elements written to the JSON file
+    '''
+    if not isinstance(reference, PostcodeCityResolver):
+        reference = PostcodeCityResolver(reference)
+    file_out = output_path(file_in, compression)
+    tasks = [(file_in, start, end, "{0}.part{1:05d}".format(file_out, i), 
+              compression)
+             for i, (start, end) in enumerate(find_shards(file_in, shard_size))]
+    pool = Pool(processes, initializer = init_worker, 
+                initargs = (reference, metrics is not None))
+    counts = []
+    try:
+        for count, totals in pool.imap(process_shard, tasks):
+            counts.append(count)
+            if metrics is not None:
+                metrics.merge(totals)
+    finally:
+        pool.close()
+        pool.join()
+    if metrics is not None:
+        start = metrics.clock()
+    with open(file_out, "wb") as fo:  # Merge part files in shard order
+        for task in tasks:
+            part_out = task[3]
+            with open(part_out, "rb") as fp:
+                shutil.copyfileobj(fp, fo)
+            os.remove(part_out)
+    if metrics is not None:
+        metrics.add('merge_parts', start)
+    return sum(counts)
+
+
+# B.1.c. Direct load into MongoDB ==============================================
+
+import threading
+import time
+from itertools import islice
+from Queue import Queue
+
+def load_to_mongodb(documents, host = 'localhost:27017', 
+                    db_name = 'OpenStreetMap', collection = 'Versailles',
+                    batch_size = 1000, writers = 4, drop = False, 
+                    geo_index = True, verbose = True):
+    ''' Inserts documents into MongoDB in unordered insert_many() batches, 
+    using several writer threads sharing one client (and its connection pool).
+    The documents are consumed as they come, so the caller can stream them 
+    straight from the parser without writing a JSON file first.
+    
+    In:
+        documents (iterable of dicts): Documents to insert, e.g. 
+            iter_documents(file_in, reference)
+        host (string): MongoDB host and port
+        db_name (string): Database name
+        collection (string): Collection name
+        batch_size (int): Number of documents per insert_many() call
+        writers (int): Number of concurrent writer threads
+        drop (bool): If True, drop the collection first (full reload)
+        geo_index (bool): If True, build a 2dsphere index on the "loc" field
+            once the documents are loaded
+        verbose (bool): If True, print the throughput of each batch
+    Out:
+        int: Number of documents inserted
+    '''
+    from pymongo import MongoClient, GEOSPHERE
+    from pymongo.errors import BulkWriteError
+    client = MongoClient(host, maxPoolSize = writers)
+    coll = client[db_name][collection]
+    if drop:
+        coll.drop()
+    batches = Queue(maxsize = 2 * writers)  # Bounded: the parser can't run 
+                                            # far ahead of the database
+    lock = threading.Lock()
+    stats = {'inserted': 0, 'batches': 0}
+    errors = []
+
+    def writer():
+        while True:
+            batch = batches.get()
+            if batch is None:  # No more batches
+                return
+            if errors:  # Another writer failed: drain the queue
+                continue
+            start = time.time()
+            try:
+                n = len(coll.insert_many(batch, ordered = False).inserted_ids)
+            except BulkWriteError as e:  # Other documents still get inserted
+                n = e.details['nInserted']
+                if verbose:
+                    print "    {0} documents rejected".format(len(batch) - n)
+            except Exception as e:
+                errors.append(e)
+                continue
+            elapsed = time.time() - start
+            with lock:
+                stats['inserted'] += n
+                stats['batches'] += 1
+                if verbose:
+                    print "    Batch {0}: {1} documents in {2:.3f}s " \
+                          "({3:.0f} docs/s)".format(stats['batches'], n, 
+                          elapsed, n / elapsed if elapsed else float('inf'))
+
+    threads = [threading.Thread(target = writer) for _ in range(writers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    documents = iter(documents)
+    try:
+        try:
+            while not errors:
+                batch = list(islice(documents, batch_size))
+                if not batch:
+                    break
+                batches.put(batch)
+        finally:  # Let the writers finish, even if the documents failed
+            for t in threads:
+                batches.put(None)
+            for t in threads:
+                t.join()
+        if errors:
+            raise errors[0]
+        if geo_index:  # Cheaper to build once than to maintain while loading
+            coll.create_index([('loc', GEOSPHERE)])
+    except BaseException:  # Even a partial load changes the data, but the 
+        # error that stopped it is the one to report
+        stamp_dataset(client[db_name], collection, quiet = True)
+        raise
+    else:
+        stamp_dataset(client[db_name], collection)
+    finally:
+        client.close()
+    return stats['inserted']
+
+def stamp_dataset(db, collection, quiet = False):
+    ''' Records a new version stamp for the collection in the "versions" 
+    collection, so that query results cached for the previous version (see 
+    aggregate() in queries.py) are no longer used.
+    
+    In:
+        db (pymongo Database): Database of the collection
+        collection (string): Collection name
+        quiet (bool): If True, errors are ignored, so that the error of a 
+            failed load is not hidden by the one of the stamp
+    '''
+    version = '{0:.6f}-{1}'.format(time.time(), os.getpid())
+    try:
+        db.versions.replace_one({'_id': collection}, 
+                                {'_id': collection, 'version': version}, 
+                                upsert = True)
+    except Exception:
+        if not quiet:
+            raise
+
+def load_map(file_in, reference, node_index = None, metrics = None, **kwargs):
+    ''' Cleans the OSM file and loads it straight into MongoDB, without going
+    through the JSON file. Keyword arguments are passed to load_to_mongodb().
+    
+    In:
+        file_in (string): Path to OSM XML file to clean up and load
+        reference (dict of lists or PostcodeCityResolver): Reference data, as
+            returned by parse_reference_file() or load_reference().
+        node_index (NodeIndex): If given, ways get a centroid, a bounding box
+            and a geometry, see iter_documents().
+        metrics (Metrics): If given, the time spent in each stage of the 
+            cleaning is recorded in it, see iter_documents().
+    Out:
+        int: Number of documents inserted
+    '''
+    if not isinstance(reference, PostcodeCityResolver):
+        reference = PostcodeCityResolver(reference)
+    return load_to_mongodb(iter_documents(file_in, reference, (), node_index,
+                                          metrics), **kwargs)
+
+
+# B.1.d. Way geometries ========================================================
+
+class NodeIndex(object):
+    ''' Compact store of node coordinates, to resolve the node references of 
+    ways without a dict of millions of entries or a database lookup. Node ids
+    are kept in a sorted int64 array and coordinates in float32 arrays (16 
+    bytes per node, about 0.5m precision), searched by bisection. With a path, 
+    the arrays are written to path + '.ids', '.lat' and '.lon' and memory-mapped
+    instead of being held in memory, for extracts that don't fit in RAM.
+    
+    Nodes are added with add(), then the index is frozen by the first call to
+    lookup(). Requires numpy.
+    '''
+    def __init__(self, path = None, buffer_size = 1 << 16):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.buffer = []  # (id, lat, lon) tuples not stored in arrays yet
+        self.chunks = []  # In-memory mode: (ids, lats, lons) arrays
+        self.count = 0
+        self.ids = self.lat = self.lon = None  # Set by finalize()
+        if path:
+            self.files = [open(path + ext, 'wb') 
+                          for ext in ('.ids', '.lat', '.lon')]
+
+    def add(self, node_id, lat, lon):
+        if self.ids is not None:
+            raise ValueError("Node {0} comes after the first way lookup: nodes "
+                             "must all be added first".format(node_id))
+        self.buffer.append((int(node_id), lat, lon))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        import numpy as np
+        if not self.buffer:
+            return
+        ids, lats, lons = zip(*self.buffer)
+        chunk = (np.array(ids, dtype = np.int64), 
+                 np.array(lats, dtype = np.float32),
+                 np.array(lons, dtype = np.float32))
+        if self.path:
+            for arr, f in zip(chunk, self.files):
+                arr.tofile(f)
+        else:
+            self.chunks.append(chunk)
+        self.count += len(ids)
+        self.buffer = []
+
+    def finalize(self):
+        import numpy as np
+        self.flush()
+        dtypes = (np.int64, np.float32, np.float32)
+        if self.path and self.count:
+            for f in self.files:
+                f.close()
+            arrays = [np.memmap(f.name, dtype = dt, mode = 'r+', 
+                                shape = (self.count,))
+                      for f, dt in zip(self.files, dtypes)]
+        elif self.chunks:
+            arrays = [np.concatenate(c) for c in zip(*self.chunks)]
+            self.chunks = []
+        else:  # No node at all
+            arrays = [np.empty(0, dtype = dt) for dt in dtypes]
+        ids = arrays[0]
+        if len(ids) and not (ids[1:] >= ids[:-1]).all():  # Usually sorted in 
+                                                          # OSM files already
+            order = np.argsort(ids, kind = 'mergesort')
+            for arr in arrays:
+                arr[:] = arr[order]
+        self.ids, self.lat, self.lon = arrays
+
+    def lookup(self, node_ids):
+        ''' Returns the coordinates of a list of node ids.
+        In:
+            node_ids (list of ints or strings): Node ids to look up
+        Out:
+            tuple of arrays: found (bool: whether the node is in the index), 
+                lat, lon (float32, meaningless where found is False)
+        '''
+        import numpy as np
+        if self.ids is None:
+            self.finalize()
+        node_ids = np.array(node_ids, dtype = np.int64)
+        if not len(self.ids):
+            return (np.zeros(len(node_ids), dtype = bool), 
+                    np.zeros(len(node_ids), dtype = np.float32),
+                    np.zeros(len(node_ids), dtype = np.float32))
+        pos = np.searchsorted(self.ids, node_ids)
+        pos = np.minimum(pos, len(self.ids) - 1)
+        return self.ids[pos] == node_ids, self.lat[pos], self.lon[pos]
+
+def add_way_geometry(way, node_index):
+    ''' Resolves the node references of a shaped way and adds the following
+    fields to it (way is updated in place):
+        loc -- GeoJSON point at the centroid of its nodes, as for nodes
+        bbox -- [min lon, min lat, max lon, max lat]
+        geometry -- GeoJSON Polygon if the way is closed (first node = last
+            node) and all its nodes are known, LineString otherwise
+    Nodes missing from the index (e.g. outside of the extract) are skipped. 
+    Nothing is added if none of the nodes is known.
+    
+    In:
+        way (dict): Way shaped by shape_element()
+        node_index (NodeIndex): Coordinates of the nodes
+    Out:
+        dict: way, for convenience
+    '''
+    refs = way.get('node_refs')
+    if not refs:
+        return way
+    found, lats, lons = node_index.lookup(refs)
+    lats = lats[found].astype(float).round(7)
+    lons = lons[found].astype(float).round(7)
+    if not len(lats):
+        return way
+    points = [[lon, lat] for lon, lat in zip(lons.tolist(), lats.tolist())]
+    closed = found.all() and len(refs) >= 4 and refs[0] == refs[-1]
+    if closed:  # Don't count the closing node twice in the centroid
+        lats, lons = lats[:-1], lons[:-1]
+    way['loc'] = {'type': 'Point', 
+                  'coordinates': [round(float(lons.mean()), 7), 
+                                  round(float(lats.mean()), 7)]}
+    way['bbox'] = [float(lons.min()), float(lats.min()), float(lons.max()), 
+                   float(lats.max())]
+    if closed:
+        way['geometry'] = {'type': 'Polygon', 'coordinates': [points]}
+    elif len(points) >= 2:
+        way['geometry'] = {'type': 'LineString', 'coordinates': points}
+    return way
+
+
+# B.1.e. Incremental updates ===================================================
+
+def iter_changes(file_in):
+    ''' Iterates through an osmChange (.osc) file, yielding each node, way or 
+    relation with the action applied to it. Elements are released once yielded.
+    
+    In:
+        file_in (string or file object): osmChange file to parse, possibly
+            compressed (see open_input())
+    Out:
+        generator: (action, element) tuples, action being 'create', 'modify' 
+            or 'delete'
+    '''
+    action = None  # Current <create>, <modify> or <delete> element
+    for event, elem in ET.iterparse(open_input(file_in), 
+                                    events = ('start', 'end')):
+        if event == 'start':
+            if elem.tag in ('create', 'modify', 'delete'):
+                action = elem
+        elif action is not None and elem.tag in ('node', 'way', 'relation'):
+            yield action.tag, elem
+            action.remove(elem)  # Only child left, so this is cheap
+        elif elem.tag in ('create', 'modify', 'delete'):
+            action = None
+
+def read_changes(file_in, reference):
+    ''' Shapes and cleans the nodes and ways of an osmChange file, the same way
+    process_map() does. When an element appears several times, the last action
+    wins.
+    
+    In:
+        file_in (string or file object): osmChange file to parse
+        reference (dict of lists or PostcodeCityResolver): Reference data, as
+            returned by parse_reference_file() or load_reference().
+    Out:
+        dict: Keys are (type, id) tuples, values are the new documents, or None
+            for deleted elements
+    '''
+    if not isinstance(reference, PostcodeCityResolver):
+        reference = PostcodeCityResolver(reference)
+    changes = {}
+    for action, element in iter_changes(file_in):
+        if element.tag not in ('node', 'way'):  # Relations are not converted
+            continue
+        key = (element.tag, element.get('id'))
+        if action == 'delete':
+            changes[key] = None
+        else:
+            changes[key] = clean_element(shape_element(element), reference)
+    return changes
+
+def changed_nodes(changes):
+    ''' Returns the new coordinates of the nodes in changes, by id: a (lat, 
+    lon) tuple, or None for nodes deleted or without valid coordinates. '''
+    nodes = {}
+    for (el_type, el_id), el in changes.iteritems():
+        if el_type == 'node':
+            nodes[el_id] = ((el['lat'], el['lon']) 
+                            if el is not None and 'loc' in el else None)
+    return nodes
+
+def change_node_index(stored_nodes, moved):
+    ''' Returns a NodeIndex of the nodes after the changes.
+    In:
+        stored_nodes (iterable): (id, lat, lon) tuples of the nodes of the 
+            previous conversion
+        moved (dict): As returned by changed_nodes()
+    '''
+    node_index = NodeIndex()
+    for node_id, lat, lon in stored_nodes:
+        if node_id not in moved:
+            node_index.add(node_id, lat, lon)
+    for node_id, coordinates in moved.iteritems():
+        if coordinates is not None:
+            node_index.add(node_id, *coordinates)
+    return node_index
+
+def update_way_geometry(way, node_index):
+    ''' Returns a copy of a way with its loc, bbox and geometry computed
+    again from node_index (see add_way_geometry()). '''
+    way = dict(way)
+    for field in ('loc', 'bbox', 'geometry'):
+        way.pop(field, None)
+    return add_way_geometry(way, node_index)
+
+def apply_changes_to_json(changes, file_out, geometry = True):
+    ''' Applies changes to a JSON-lines file written by process_map(): changed
+    documents replace the old ones in place, deleted ones are removed and new 
+    ones are appended. The file is rewritten line by line, without going back 
+    to the OSM XML data.
+    
+    With geometry, the geometries of the changed ways, and of the ways whose 
+    nodes were moved or deleted, are computed from the nodes of the file 
+    updated by the changes (see add_way_geometry()). This takes a first pass 
+    over the file to index its nodes.
+    
+    In:
+        changes (dict): As returned by read_changes()
+        file_out (string): Path to the JSON file to update
+        geometry (bool): Whether to update the geometries of the ways
+    Out:
+        dict: Counts of 'modified', 'deleted' and 'created' documents, and of
+            the ways 'relocated' because some of their nodes changed
+    '''
+    counts = {'modified': 0, 'deleted': 0, 'created': 0, 'relocated': 0}
+    pending = dict(changes)  # Changes not applied yet
+    node_index = None
+    if geometry:
+        moved = changed_nodes(changes)
+        with codecs.open(file_out, "r") as fi:
+            stored = ((el['id'], el['lat'], el['lon']) 
+                      for el in (json.loads(line) for line in fi)
+                      if el['type'] == 'node' and 'loc' in el)
+            node_index = change_node_index(stored, moved)
+        for key, el in pending.items():
+            if el is not None and key[0] == 'way':
+                pending[key] = update_way_geometry(el, node_index)
+    tmp_out = file_out + '.tmp'
+    with codecs.open(file_out, "r") as fi, codecs.open(tmp_out, "w") as fo:
+        for line in fi:
+            el = json.loads(line)
+            key = (el['type'], el['id'])
+            if key not in pending:
+                if (node_index is not None and el['type'] == 'way' and 
+                    any(ref in moved for ref in el.get('node_refs', ()))):
+                    counts['relocated'] += 1
+                    fo.write(json.dumps(update_way_geometry(el, node_index)) 
+                             + "\n")
+                else:
+                    fo.write(line)
+                continue
+            new_el = pending.pop(key)
+            if new_el is None:
+                counts['deleted'] += 1
+            else:
+                counts['modified'] += 1
+                fo.write(json.dumps(new_el) + "\n")
+        for key in sorted(pending):  # Elements not in the file yet
+            if pending[key] is not None:
+                counts['created'] += 1
+                fo.write(json.dumps(pending[key]) + "\n")
+    os.rename(tmp_out, file_out)
+    return counts
+
+def apply_changes_to_mongodb(changes, host = 'localhost:27017', 
+                             db_name = 'OpenStreetMap', 
+                             collection = 'Versailles', batch_size = 1000,
+                             geometry = True):
+    ''' Applies changes to the MongoDB collection as targeted upserts and 
+    deletes, matched on type and id (an index on both is created if needed).
+    
+    With geometry, the geometries of the changed ways, and of the stored ways
+    whose nodes were moved or deleted, are computed from the nodes of the 
+    collection updated by the changes (see add_way_geometry()). Only the 
+    nodes of these ways are read.
+    
+    In:
+        changes (dict): As returned by read_changes()
+        host (string): MongoDB host and port
+        db_name (string): Database name
+        collection (string): Collection name
+        batch_size (int): Number of operations per bulk_write() call, and of
+            node ids per query when reading nodes
+        geometry (bool): Whether to update the geometries of the ways
+    Out:
+        dict: Counts of 'upserted', 'modified' and 'deleted' documents
+    '''
+    from pymongo import MongoClient, ReplaceOne, DeleteOne
+    client = MongoClient(host)
+    counts = {'upserted': 0, 'modified': 0, 'deleted': 0}
+    try:
+        coll = client[db_name][collection]
+        coll.create_index([('type', 1), ('id', 1)])
+        changes = dict(changes)
+        if geometry:
+            moved = changed_nodes(changes)
+            if moved:  # Stored ways using these nodes need a new geometry
+                for way in coll.find({'type': 'way', 
+                                      'node_refs': {'$in': list(moved)}},
+                                     {'_id': 0}):
+                    changes.setdefault(('way', way['id']), way)
+            ways = [(key, el) for key, el in changes.iteritems() 
+                    if key[0] == 'way' and el is not None]
+            refs = list(set(ref for key, way in ways 
+                            for ref in way.get('node_refs', ())
+                            if ref not in moved))
+            stored = []
+            for i in range(0, len(refs), batch_size):
+                for node in coll.find({'type': 'node', 
+                                       'id': {'$in': refs[i:i + batch_size]},
+                                       'loc': {'$exists': True}},
+                                      {'id': 1, 'lat': 1, 'lon': 1}):
+                    stored.append((node['id'], node['lat'], node['lon']))
+            node_index = change_node_index(stored, moved)
+            for key, way in ways:
+                changes[key] = update_way_geometry(way, node_index)
+        operations = []
+        for (el_type, el_id), el in sorted(changes.iteritems()):
+            query = {'type': el_type, 'id': el_id}
+            if el is None:
+                operations.append(DeleteOne(query))
+            else:
+                operations.append(ReplaceOne(query, el, upsert = True))
+        for i in range(0, len(operations), batch_size):
+            result = coll.bulk_write(operations[i:i + batch_size], 
+                                     ordered = False)
+            counts['upserted'] += result.upserted_count
+            counts['modified'] += result.modified_count
+            counts['deleted'] += result.deleted_count
+    except BaseException:  # Some changes may have been applied already
+        stamp_dataset(client[db_name], collection, quiet = True)
+        raise
+    else:
+        stamp_dataset(client[db_name], collection)
+    finally:
+        client.close()
+    return counts
+
+def apply_change_file(file_in, reference, json_file = None, mongodb = True, 
+                      geometry = True, **kwargs):
+    ''' Applies an osmChange file (e.g. a daily diff) to the outputs of a 
+    previous conversion, at a cost proportional to the size of the diff 
+    (plus a scan of the nodes of the JSON file for the way geometries). 
+    Keyword arguments are passed to apply_changes_to_mongodb().
+    
+    In:
+        file_in (string): Path to the osmChange file
+        reference (dict of lists or PostcodeCityResolver): Reference data, as
+            returned by parse_reference_file() or load_reference().
+        json_file (string): Path to the JSON file to update, if any
+        mongodb (bool): Whether to update the MongoDB collection
+        geometry (bool): Whether to update the geometries of the ways, see 
+            apply_changes_to_json()
+    Out:
+        dict: Counts returned by apply_changes_to_json() and 
+            apply_changes_to_mongodb(), under the 'json' and 'mongodb' keys
+    '''
+    changes = read_changes(file_in, reference)
+    counts = {}
+    if json_file:
+        counts['json'] = apply_changes_to_json(changes, json_file, geometry)
+    if mongodb:
+        counts['mongodb'] = apply_changes_to_mongodb(changes, 
+                                                     geometry = geometry,
+                                                     **kwargs)
+    return counts
+
+
+# B.1.f. Columnar export =======================================================
+
+def export_columns(file_in, reference, path = None, node_index = None, 
+                   **kwargs):
+    ''' Cleans the OSM file and writes the main fields as typed columns 
+    (Parquet if pyarrow is installed, npz otherwise), for analytics that only
+    scan a few fields. Keyword arguments are passed to ColumnarWriter.
+    
+    In:
+        file_in (string): Path to OSM XML file to clean up and export
+        reference (dict of lists or PostcodeCityResolver): Reference data, as
+            returned by parse_reference_file() or load_reference().
+        path (string): Output path without extension, defaults to file_in 
+            without its extension(s)
+        node_index (NodeIndex): If given, ways get their centroid as lat/lon,
+            see iter_documents().
+    Out:
+        string: Path of the written file
+    '''
+    from columnar import ColumnarWriter
+    if not isinstance(reference, PostcodeCityResolver):
+        reference = PostcodeCityResolver(reference)
+    if path is None:
+        path = output_path(file_in)[:-len('.json')]
+    with ColumnarWriter(path, **kwargs) as writer:
+        for el in iter_documents(file_in, reference, (), node_index):
+            writer.write(el)
+    return writer.path
+
+
+# B.1.g. Multi-output conversion ===============================================
+
+def json_sink(path, compression = None):
+    ''' Returns a sink writing the documents to a JSON-lines file (see 
+    tee_documents()), whose result is the number of documents written. '''
+    def sink(documents):
+        count = 0
+        with JsonLinesWriter(path, compression) as writer:
+            for el in documents:
+                writer.write(el)
+                count += 1
+        return count
+    return sink
+
+def mongodb_sink(**kwargs):
+    ''' Returns a sink loading the documents into MongoDB, keyword arguments 
+    being passed to load_to_mongodb(). insert_many() adds an _id to the 
+    documents it inserts, so it is given copies of the shared documents. '''
+    def sink(documents):
+        return load_to_mongodb((dict(el) for el in documents), **kwargs)
+    return sink
+
+def columns_sink(path, **kwargs):
+    ''' Returns a sink writing the documents as columns (see 
+    export_columns(), keyword arguments are passed to ColumnarWriter), whose 
+    result is the path of the written file. '''
+    def sink(documents):
+        from columnar import ColumnarWriter
+        with ColumnarWriter(path, **kwargs) as writer:
+            for el in documents:
+                writer.write(el)
+        return writer.path
+    return sink
+
+def tee_documents(documents, sinks, batch_size = 1000, queue_size = 4, 
+                  metrics = None):
+    ''' Feeds the same documents to several sinks, each running in its own 
+    thread, so that the JSON file, the MongoDB load and the columnar export 
+    are written while the next documents are being parsed and cleaned. Each 
+    sink has a bounded queue of batches: when a sink falls queue_size batches
+    behind, the producer waits for it instead of buffering more documents.
+    
+    In:
+        documents (iterable of dicts): Documents to write, e.g. 
+            iter_documents(file_in, reference)
+        sinks (dict): Sinks by name, e.g. {'json': json_sink(path)}. A sink 
+            is a function taking an iterable of documents and returning a 
+            result. The documents are shared, so sinks must not modify them.
+        batch_size (int): Number of documents per queued batch
+        queue_size (int): Maximum number of batches waiting for each sink
+        metrics (Metrics): If given, the time the producer spends waiting for
+            the sinks is recorded in it, as the 'backpressure' stage
+    Out:
+        dict: Result of each sink, by name
+    '''
+    queues = dict((name, Queue(maxsize = queue_size)) for name in sinks)
+    results = {}
+    errors = []
+
+    def consumer(name):
+        queue = queues[name]
+        finished = []
+        def iter_queue():
+            while True:
+                batch = queue.get()
+                if batch is None:  # No more batches
+                    finished.append(True)
+                    return
+                for el in batch:
+                    yield el
+        try:
+            results[name] = sinks[name](iter_queue())
+        except Exception as e:
+            errors.append(e)
+        if not finished:  # Drain the queue, so that the producer never waits 
+            while queue.get() is not None:  # for this sink again
+                pass
+
+    threads = [threading.Thread(target = consumer, args = (name,)) 
+               for name in sinks]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    documents = iter(documents)
+    try:
+        while not errors:
+            batch = list(islice(documents, batch_size))
+            if not batch:
+                break
+            if metrics is not None:
+                start = metrics.clock()
+            for queue in queues.values():
+                queue.put(batch)  # Blocks while this sink is too far behind
+            if metrics is not None:
+                metrics.add('backpressure', start)
+    finally:  # Let the sinks finish, even if the documents failed
+        for queue in queues.values():
+            queue.put(None)
+        for t in threads:
+            t.join()
+    if errors:
+        raise errors[0]
+    return results
+
+def process_map_tee(file_in, reference, sinks, audits = (), node_index = None,
+                    metrics = None, **kwargs):
+    ''' Cleans the OSM file in a single pass and writes the documents to 
+    several outputs at once (see tee_documents(), which gets the keyword 
+    arguments), instead of parsing the file again for each one.
+    
+    In:
+        file_in (string): Path to OSM XML file to clean up and convert
+        reference (dict of lists or PostcodeCityResolver): Reference data, as
+            returned by parse_reference_file() or load_reference().
+        sinks (dict): Sinks by name, e.g. {'json': json_sink(path), 
+            'mongodb': mongodb_sink(drop = True)}
+        audits, node_index, metrics: See iter_documents()
+    Out:
+        dict: Result of each sink, by name
+    '''
+    if not isinstance(reference, PostcodeCityResolver):
+        reference = PostcodeCityResolver(reference)
+    return tee_documents(iter_documents(file_in, reference, audits, 
+                                        node_index, metrics), 
+                         sinks, metrics = metrics, **kwargs)
+
+
+# Report =======================================================================
+
+import argparse
+
+from metrics import Metrics
+
+metrics_file = './conversion_metrics.json'
+
+# Stages of the command line, run in this order whatever the order given:
+stage_names = ('audits', 'convert', 'load', 'export', 'update')
+
+def print_audits(results, reference, pause = False):
+    ''' Prints the results of the audits section by section.
+    In:
+        results (list): Results of TagCounter, PositionChecker, 
+            PostcodeAuditor, StreetTypeAuditor and PcCityCollector, in this 
+            order
+        reference (PostcodeCityResolver): Reference data, to show the 
+            corrected postcode / city combinations
+        pause (bool): If True, wait for Enter after each section
+    '''
+    def wait():
+        if pause:
+            raw_input("Press Enter to continue...")
+
+    tags, positions, postcodes, street_types, pc_cities = results
+
+    print "\nA.1.a. DATA TAGS:"
+    pprint.pprint(tags)
+    wait()
+
+    print "\nA.1.b. LATITUDE / LONGITUDE:"    
+    pprint.pprint(positions)
+    wait()
+
+    print "\nA.1.c. POSTCODE FORMAT:"
+    pprint.pprint(postcodes)
+    wait()
+
+    print "\nA.1.d. STREET / WAY TYPES:"
+    print "    o Unexpected street types:"
+    pprint.pprint(street_types.keys())  # Print unexpected street types (without
+                                        # the related street names)
+    wait()
+
+    print "\n    o Transforming street names:"
+    for street_type, ways in street_types.iteritems():  
+    # For each unexpected street type:
+        for street_name in ways:
+            better_name = update_street_name(street_name, street_mapping)  
+            # Display replacements:
+            if street_name != better_name:
+                print street_name, "=>", better_name
+    wait()
+
+    print "\nA.2. ACCURACY AND CONSISTENCY"            
+    print "\n    o All postcode / city combinations in file:"    
+    pprint.pprint(pc_cities)
+    wait()
+
+    pc_city = set()
+    for pc, city in pc_cities:  # Apply correct_pc_city() to all postcode/city 
+        # combinations found in the OSM XML file:
+        new_pc, new_city = reference.correct(pc, city)
+        pc_city.add((new_pc, new_city))
+        
+    print "\n    o All postcode/city combinations after corrections:"        
+    pprint.pprint(pc_city)  # Outcome of our manipulations
+    wait()
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(description = 'Audits and cleans an '
+                                     'OpenStreetMap extract, then converts it '
+                                     'to JSON, MongoDB and/or columns')
+    parser.add_argument('--stages', default = 'audits,convert',
+                        help = 'comma-separated stages to run, among: {0} '
+                        '(default: audits,convert)'.format(
+                            ', '.join(stage_names)))
+    parser.add_argument('--input', default = filename,
+                        help = 'OSM file (XML, optionally .bz2 / .gz, or PBF)')
+    parser.add_argument('--reference', default = laposte_file,
+                        help = 'La Poste postcode / city reference file')
+    parser.add_argument('--changes', help = 'osmChange file (update stage)')
+    parser.add_argument('--host', default = 'localhost:27017',
+                        help = 'MongoDB host (load and update stages)')
+    parser.add_argument('--drop', action = 'store_true',
+                        help = 'drop the collection before loading')
+    parser.add_argument('--json-only', action = 'store_true',
+                        help = 'only update the JSON file, not MongoDB '
+                        '(update stage)')
+    parser.add_argument('--processes', type = int,
+                        help = 'convert with this many worker processes')
+    parser.add_argument('--compression', choices = ('gzip', 'zstd'),
+                        help = 'compress the JSON file')
+    parser.add_argument('--checkpoint-every', type = int, metavar = 'BYTES',
+                        help = 'checkpoint the conversion every BYTES of input')
+    parser.add_argument('--resume', action = 'store_true',
+                        help = 'resume the conversion from its last checkpoint')
+    parser.add_argument('--parser', choices = ('etree', 'lxml'),
+                        default = xml_parser, help = 'XML parser')
+    parser.add_argument('--no-geometry', action = 'store_true',
+                        help = 'do not build way geometries')
+    parser.add_argument('--metrics', nargs = '?', const = metrics_file,
+                        help = 'instrument the run and save its metrics to '
+                        'this JSON file (default: {0})'.format(metrics_file))
+    parser.add_argument('--progress', type = float, metavar = 'SECONDS',
+                        help = 'print a progress line every SECONDS')
+    parser.add_argument('--pause', action = 'store_true',
+                        help = 'wait for Enter between sections of the report')
+    args = parser.parse_args(argv)
+    args.stages = [s.strip() for s in args.stages.split(',') if s.strip()]
+    unknown = [s for s in args.stages if s not in stage_names]
+    if unknown:
+        parser.error('unknown stage(s): {0}'.format(', '.join(unknown)))
+    if 'update' in args.stages and not args.changes:
+        parser.error('the update stage requires --changes')
+    if args.json_only and 'update' in args.stages:
+        if args.compression:
+            parser.error('--json-only: a compressed JSON file cannot be '
+                         'updated')
+        if 'convert' not in args.stages and \
+                not os.path.exists(output_path(args.input)):
+            parser.error('--json-only: no JSON file to update, convert {0} '
+                         'first'.format(args.input))
+    if args.resume and args.checkpoint_every is None:
+        parser.error('--resume requires --checkpoint-every')
+    if args.checkpoint_every is not None:
+        if args.processes:
+            parser.error('--checkpoint-every cannot be used with --processes')
+        if args.compression:
+            parser.error('--checkpoint-every cannot be used with '
+                         '--compression')
+        if args.input.endswith(streamed_ext):
+            parser.error('--checkpoint-every needs an uncompressed XML '
+                         'input, not {0}'.format(args.input))
+    return args
+
+def main(argv = None):
+    ''' Runs the stages given on the command line. When several of convert, 
+    load and export are requested, they are fed by a single conversion pass 
+    (see process_map_tee()), which also feeds the audits; so does the 
+    conversion for audits and convert. The run is only instrumented with 
+    --metrics (to save the metrics) or --progress.
+    '''
+    global xml_parser
+    args = parse_args(argv)
+    xml_parser = args.parser
+    stages = set(args.stages)
+    ref_data = load_reference(args.reference)
+    metrics = None
+    if args.metrics or args.progress:
+        metrics = Metrics(args.progress)
+    node_index = (lambda: None) if args.no_geometry else NodeIndex
+    single_pass = not args.processes and args.checkpoint_every is None
+    outputs = [s for s in ('convert', 'load', 'export') if s in stages]
+    tee = single_pass and len(outputs) > 1
+    audits = []
+    if 'audits' in stages:
+        audits = [TagCounter(), PositionChecker(), PostcodeAuditor(), 
+                  StreetTypeAuditor(), PcCityCollector()]
+        if not (tee or ('convert' in stages and single_pass)):
+            run_audits(args.input, audits)
+            print_audits([audit.result() for audit in audits], ref_data, 
+                         args.pause)
+            audits = []
+
+    if tee:
+        sinks = {}
+        if 'convert' in stages:
+            sinks['convert'] = json_sink(output_path(args.input, 
+                                                     args.compression),
+                                         args.compression)
+        if 'load' in stages:
+            sinks['load'] = mongodb_sink(host = args.host, drop = args.drop)
+        if 'export' in stages:
+            sinks['export'] = columns_sink(output_path(args.input)
+                                           [:-len('.json')])
+        results = process_map_tee(args.input, ref_data, sinks, audits, 
+                                  node_index(), metrics)
+        if audits:
+            print_audits([audit.result() for audit in audits], ref_data, 
+                         args.pause)
+        print "\nB.1. DATA LOAD INTO A MONGODB DATABASE"
+        for stage in outputs:
+            print "    o {0}: {1}".format(stage, results[stage])
+        stages.difference_update(outputs)
+
+    if 'convert' in stages:
+        if args.processes:
+            sample = None
+            count = process_map_parallel(args.input, ref_data, args.processes,
+                                         compression = args.compression,
+                                         metrics = metrics)
+        else:
+            sample = process_map(args.input, ref_data, False, audits, 
+                                 sample_size = 5, node_index = node_index(),
+                                 checkpoint_every = args.checkpoint_every,
+                                 resume = args.resume, 
+                                 compression = args.compression, 
+                                 metrics = metrics)
+        if audits:
+            print_audits([audit.result() for audit in audits], ref_data, 
+                         args.pause)
+        print "\nB.1. DATA LOAD INTO A MONGODB DATABASE"
+        if sample is None:
+            print "    o {0} documents written".format(count)
+        else:
+            print "    o Data sample:"
+            pprint.pprint(sample)
+
+    if 'load' in stages:
+        load_map(args.input, ref_data, node_index = node_index(), 
+                 metrics = metrics, host = args.host, drop = args.drop)
+
+    if 'export' in stages:
+        print "Columns written to", export_columns(args.input, ref_data, 
+                                                   node_index = node_index())
+
+    if 'update' in stages:
+        json_file = output_path(args.input)
+        counts = apply_change_file(args.changes, ref_data, 
+                                   json_file if os.path.exists(json_file) 
+                                   else None, not args.json_only,
+                                   host = args.host,
+                                   geometry = not args.no_geometry)
+        pprint.pprint(counts)
+
+    if args.metrics:
+        metrics.save(args.metrics)
+
 
-print "\nB.1. DATA LOAD INTO A MONGODB DATABASE"
-print "    o Data sample:"
-pprint.pprint(sample(data, 5))
\ No newline at end of file
+if __name__ == '__main__':
+    main()
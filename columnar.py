@@ -0,0 +1,734 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+''' Columnar export of the cleaned OSM documents, for offline analytics.
+
+Each field of interest is stored as a typed column, so that a scan only reads
+the columns it needs. Columns are named after the MongoDB field paths (e.g.
+"created.user", "address.city"). The data is written to Parquet when pyarrow is
+installed, to a NumPy .npz archive otherwise:
+- Parquet: strings are dictionary-encoded by Parquet; missing values are nulls.
+  For string columns, a "<column>.null" boolean column flags the documents
+  where the field is present but null (or not a string).
+- npz: strings are stored as int32 codes into a "<column>.categories" array of
+  unique values (-1 when missing, -2 when null), integers use INT_NULL and
+  floats NaN when null, timestamps are datetime64[s] (NaT when null).
+
+The export can then be queried without MongoDB: ColumnarCollection runs
+aggregation pipelines on it, with the same results as MongoDB.
+'''
+
+import imp
+import numpy as np
+from collections import OrderedDict
+
+try:  # Parquet output, pyarrow being only imported when it is written
+    imp.find_module('pyarrow')
+    pyarrow_installed = True
+except ImportError:
+    pyarrow_installed = False
+
+# A. Export ====================================================================
+
+# Fields always present in the documents (null when unknown):
+INT_COLUMNS = ['id', 'created.version', 'created.changeset', 'created.uid']
+FLOAT_COLUMNS = ['lat', 'lon']  # null for ways
+TIME_COLUMNS = ['created.timestamp']
+# GeoJSON point of the "loc" field (centroid for ways), NaN when absent:
+LOCATION_COLUMNS = ['loc.lon', 'loc.lat']
+STRING_COLUMNS = ['type', 'created.user', 'address.street',
+                  'address.housenumber', 'address.postcode', 'address.city']
+
+# Most frequent (or most queried) tag keys, exported as string columns:
+COLUMN_TAGS = ['name', 'amenity', 'tourism', 'artwork_type', 'highway',
+               'building', 'shop', 'leisure', 'historic', 'landuse',
+               'natural', 'sport']
+
+INT_NULL = np.iinfo(np.int64).min
+MISSING = -1  # String codes
+NULL = -2
+ABSENT = object()  # Value of a missing field
+
+
+def get_field(doc, path):
+    ''' Returns the value of a dotted field path in doc, or ABSENT if a part
+    of the path is absent. '''
+    for key in path.split('.'):
+        if not isinstance(doc, dict) or key not in doc:
+            return ABSENT
+        doc = doc[key]
+    return doc
+
+def to_unicode(value):
+    ''' Returns string values as unicode, ABSENT as is, and anything else
+    (e.g. a dict found where a tag value was expected) as None. '''
+    if isinstance(value, unicode):
+        return value
+    elif isinstance(value, str):
+        return value.decode('utf-8')
+    elif value is ABSENT:
+        return ABSENT
+    return None
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class ColumnarWriter(object):
+    ''' Accumulates documents row by row and writes them as columns, in row
+    groups of row_group_size documents (Parquet) or all at once when closed
+    (npz, which is kept compact in memory in the meantime).
+
+    In:
+        path (string): Path of the output file, without extension: ".parquet"
+            or ".npz" is added (see the path attribute)
+        tag_keys (list): Tag keys to export as columns
+        row_group_size (int): Number of documents per row group
+        use_parquet (bool): Defaults to True if pyarrow is installed
+    '''
+    def __init__(self, path, tag_keys = COLUMN_TAGS, row_group_size = 100000,
+                 use_parquet = None):
+        if use_parquet is None:
+            use_parquet = pyarrow_installed
+        self.use_parquet = use_parquet
+        self.path = path + ('.parquet' if use_parquet else '.npz')
+        self.string_columns = STRING_COLUMNS + list(tag_keys)
+        self.columns = (INT_COLUMNS + FLOAT_COLUMNS + TIME_COLUMNS +
+                        LOCATION_COLUMNS + self.string_columns)
+        self.row_group_size = row_group_size
+        self.rows = dict((c, []) for c in self.columns)
+        self.count = 0
+        self.chunks = dict((c, []) for c in self.columns)  # npz: numpy arrays
+        self.categories = dict((c, {}) for c in self.string_columns)  # npz:
+        # value -> code
+        self.parquet_writer = None
+
+    def write(self, doc):
+        rows = self.rows
+        for c in INT_COLUMNS:
+            rows[c].append(to_int(get_field(doc, c)))
+        for c in FLOAT_COLUMNS:
+            rows[c].append(to_float(get_field(doc, c)))
+        for c in TIME_COLUMNS:
+            value = get_field(doc, c)
+            rows[c].append(value if isinstance(value, basestring) else None)
+        loc = doc.get('loc')
+        if isinstance(loc, dict) and loc.get('type') == 'Point':
+            lon, lat = loc['coordinates']
+        else:  # No point, or a "loc" tag (way without geometry)
+            lon = lat = None
+        rows['loc.lon'].append(lon)
+        rows['loc.lat'].append(lat)
+        for c in self.string_columns:
+            rows[c].append(to_unicode(get_field(doc, c)))
+        self.count += 1
+        if len(rows['id']) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows['id']:
+            return
+        if self.use_parquet:
+            self.flush_parquet()
+        else:
+            self.flush_npz()
+        self.rows = dict((c, []) for c in self.columns)
+
+    def flush_parquet(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        arrays = []
+        names = []
+        for c in self.columns:
+            values = self.rows[c]
+            names.append(c)
+            if c in INT_COLUMNS:
+                arrays.append(pa.array(values, type = pa.int64()))
+            elif c in TIME_COLUMNS:
+                arrays.append(pa.array(parse_timestamps(values),
+                                       type = pa.timestamp('s')))
+            elif c in self.categories:
+                arrays.append(pa.array([None if v is ABSENT else v
+                                        for v in values], type = pa.string()))
+                names.append(c + '.null')
+                arrays.append(pa.array([v is None for v in values],
+                                       type = pa.bool_()))
+            else:
+                arrays.append(pa.array(values, type = pa.float64()))
+        table = pa.Table.from_arrays(arrays, names)
+        if self.parquet_writer is None:
+            self.parquet_writer = pq.ParquetWriter(self.path, table.schema,
+                                                   use_dictionary = True,
+                                                   compression = 'snappy')
+        self.parquet_writer.write_table(table)
+
+    def flush_npz(self):
+        for c in self.columns:
+            values = self.rows[c]
+            if c in INT_COLUMNS:
+                chunk = np.array([INT_NULL if v is None else v for v in values],
+                                 dtype = np.int64)
+            elif c in TIME_COLUMNS:
+                chunk = parse_timestamps(values)
+            elif c in self.categories:
+                codes = self.categories[c]
+                chunk = np.array([MISSING if v is ABSENT else NULL if v is None
+                                  else codes.setdefault(v, len(codes))
+                                  for v in values], dtype = np.int32)
+            else:
+                chunk = np.array([np.nan if v is None else v for v in values],
+                                 dtype = np.float64)
+            self.chunks[c].append(chunk)
+
+    def close(self):
+        self.flush()
+        if self.use_parquet:
+            if self.parquet_writer is not None:
+                self.parquet_writer.close()
+            return
+        arrays = {}
+        for c in self.columns:
+            if self.chunks[c]:
+                arrays[c] = np.concatenate(self.chunks[c])
+            else:  # No document at all
+                arrays[c] = np.empty(0, dtype = np.int32 if c in
+                                     self.categories else np.int64)
+            if c in self.categories:
+                values = sorted(self.categories[c], key = self.categories[c].get)
+                arrays[c + '.categories'] = np.array(values, dtype = np.unicode_)
+        np.savez_compressed(self.path, **arrays)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def parse_timestamps(values):
+    ''' Converts OSM timestamps ("2013-08-03T16:43:42Z") to datetime64[s]. '''
+    return np.array([v[:-1] if v else 'NaT' for v in values],
+                    dtype = 'datetime64[s]')
+
+
+# B. Aggregation pipelines =====================================================
+
+class Column(object):
+    ''' A column of a query, as integer codes into an array of distinct values
+    sorted as MongoDB sorts them, so that comparing codes compares values.
+    Codes are MISSING when the field is absent and NULL when it is null. '''
+    def __init__(self, codes, values):
+        self.codes = codes
+        self.values = values
+
+    def take(self, rows):
+        return Column(self.codes[rows], self.values)
+
+    def lookup(self, per_value, null, missing):
+        ''' Maps a boolean array computed on the distinct values to the rows.
+        '''
+        table = np.append(np.asarray(per_value, dtype = bool), [null, missing])
+        return table[self.codes]  # NULL and MISSING index the end of table
+
+def object_array(values):
+    array = np.empty(len(values), dtype = object)
+    array[:] = values
+    return array
+
+def sorted_column(codes, values):
+    ''' Returns a Column with values sorted, remapping the codes. Python 2
+    sorts numbers before strings, like MongoDB. '''
+    order = sorted(range(len(values)), key = values.__getitem__)
+    remap = np.empty(len(values) + 2, dtype = np.int64)
+    remap[order] = np.arange(len(values))
+    remap[[NULL, MISSING]] = [NULL, MISSING]
+    return Column(remap[codes], object_array([values[i] for i in order]))
+
+def column_from_array(data, null = None, convert = None):
+    ''' Factorizes a numpy array into a Column; values are converted to Python
+    objects with convert. '''
+    codes = np.full(len(data), NULL, dtype = np.int64)
+    valid = slice(None) if null is None else ~null
+    values, codes[valid] = np.unique(data[valid], return_inverse = True)
+    values = values.tolist()
+    if convert is not None:
+        values = [convert(v) for v in values]
+    return sorted_column(codes, values)
+
+def column_from_values(values):
+    ''' Factorizes a (short) list of Python values into a Column. '''
+    distinct = {}
+    codes = np.array([NULL if v is None else distinct.setdefault(v,
+                      len(distinct)) for v in values], dtype = np.int64)
+    return sorted_column(codes, sorted(distinct, key = distinct.get))
+
+def constant_column(value, size):
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    return Column(np.zeros(size, dtype = np.int64), object_array([value]))
+
+def format_timestamp(value):
+    return unicode(np.datetime_as_string(np.datetime64(value, 's'))) + u'Z'
+
+
+def open_columns(path):
+    ''' Returns a ColumnarCollection on the export at path (without extension),
+    Parquet or npz, whichever exists. '''
+    import os
+    for ext in ('.parquet', '.npz'):
+        if os.path.exists(path + ext):
+            return ColumnarCollection(path + ext)
+    raise IOError('No columnar export at {0} (.parquet or .npz)'.format(path))
+
+class ColumnarCollection(object):
+    ''' Runs MongoDB aggregation pipelines on a columnar export, as
+    vectorized filters and group-bys on the columns they use. Columns are read
+    on first use and kept in memory.
+
+    Supported stages: $match (equality, $eq, $ne, $gt, $gte, $lt, $lte, $in,
+    $nin, $exists, $and, $or, $nor, and $geoWithin a convex $geometry polygon
+    on "loc"), $group (field, compound or constant _id; $sum and $avg
+    accumulators), $sort, $skip, $limit, $project, $count and $facet (as the
+    last stage). Anything else, or a field that was not exported, raises
+    ValueError.
+
+    In:
+        path (string): Path of the .parquet or .npz file
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.cache = {}
+        if path.endswith('.parquet'):
+            import pyarrow.parquet as pq
+            self.parquet = pq.ParquetFile(path)
+            self.names = set(self.parquet.schema.names)
+            self.size = self.parquet.metadata.num_rows
+        else:
+            self.parquet = None
+            self.npz = np.load(path)
+            self.names = set(self.npz.files)
+            self.size = len(self.npz['id'])
+
+    def read(self, name):
+        ''' Returns the column name as a numpy array, nulls as NaN (floats),
+        INT_NULL (integers) or NaT (timestamps), and strings as codes (see
+        read_strings()). '''
+        if self.parquet is None:
+            return self.npz[name]
+        chunks = self.parquet.read(columns = [name]).column(0).chunks
+        data = [c.to_numpy(zero_copy_only = False) for c in chunks]
+        data = np.concatenate(data) if data else np.empty(0)
+        if name in INT_COLUMNS and data.dtype.kind == 'f':
+            data = np.where(np.isnan(data), INT_NULL, data).astype(np.int64)
+        elif name in TIME_COLUMNS:
+            data = data.astype('datetime64[s]')
+        return data
+
+    def read_strings(self, name):
+        ''' Returns the codes (MISSING, NULL or an index into values) and the
+        values of a string column. '''
+        if self.parquet is None:
+            return (self.npz[name].astype(np.int64),
+                    self.npz[name + '.categories'].tolist())
+        distinct = {}
+        codes = []
+        for chunk in self.parquet.read(columns = [name]).column(0).chunks:
+            encoded = chunk.dictionary_encode()
+            remap = np.array([distinct.setdefault(v, len(distinct)) for v in
+                              encoded.dictionary.to_pylist()] + [MISSING])
+            indices = encoded.indices.to_numpy(zero_copy_only = False)
+            if indices.dtype.kind == 'f':  # Nulls as NaN
+                indices = np.where(np.isnan(indices), -1, indices)
+            codes.append(remap[indices.astype(np.int64)])
+        codes = np.concatenate(codes) if codes else np.empty(0, np.int64)
+        null = self.read(name + '.null').astype(bool)
+        codes[null] = NULL
+        return codes, sorted(distinct, key = distinct.get)
+
+    def column(self, path):
+        ''' Returns the field at path as a Column. '''
+        if path in self.cache:
+            return self.cache[path]
+        if path not in self.names or path.endswith(('.null', '.categories')):
+            raise ValueError('Field "{0}" is not in the columnar export {1}'
+                             .format(path, self.path))
+        if path in INT_COLUMNS:  # Strings in the documents
+            data = self.read(path)
+            column = column_from_array(data, data == INT_NULL,
+                                       lambda v: unicode(v))
+        elif path in TIME_COLUMNS:
+            data = self.read(path)
+            column = column_from_array(data, np.isnat(data), format_timestamp)
+        elif path in FLOAT_COLUMNS or path in LOCATION_COLUMNS:
+            data = self.read(path)
+            column = column_from_array(data, np.isnan(data))
+            if path in LOCATION_COLUMNS:
+                column.codes[column.codes == NULL] = MISSING
+        else:
+            column = sorted_column(*self.read_strings(path))
+        self.cache[path] = column
+        return column
+
+    def coordinates(self, path):
+        ''' Returns the longitudes and latitudes of a GeoJSON point field. '''
+        if path != 'loc':
+            raise ValueError('Only "loc" has coordinates in the columnar '
+                             'export')
+        if 'coordinates' not in self.cache:
+            self.cache['coordinates'] = (self.read('loc.lon'),
+                                         self.read('loc.lat'))
+        return self.cache['coordinates']
+
+    def aggregate(self, pipeline):
+        ''' Runs a pipeline, see run_pipeline(). '''
+        return run_pipeline(self, pipeline)
+
+
+class Frame(object):
+    ''' Intermediate result of a pipeline: either documents of the collection
+    (source, optionally restricted to rows), or computed columns (keyed by
+    dotted path). objects lists the paths of subdocuments that exist even if
+    all their fields are missing (e.g. a compound group _id).'''
+    def __init__(self, size, columns = None, source = None, rows = None,
+                 objects = ()):
+        self.size = size
+        self.columns = columns if columns is not None else OrderedDict()
+        self.source = source
+        self.rows = rows
+        self.objects = set(objects)
+
+    def fields(self, path):
+        ''' Returns the (sub-path, Column) pairs of a field: a single pair for
+        a scalar field, or one per field of a subdocument. '''
+        if self.source is not None:
+            column = self.source.column(path)
+            if self.rows is not None:
+                column = column.take(self.rows)
+            return [('', column)]
+        if path in self.columns:
+            return [('', self.columns[path])]
+        prefix = path + '.'
+        fields = [(p[len(path):], c) for p, c in self.columns.items()
+                  if p.startswith(prefix)]
+        if not fields and path not in self.objects:  # Missing everywhere
+            fields = [('', Column(np.full(self.size, MISSING, np.int64),
+                                  object_array([])))]
+        return fields
+
+    def column(self, path):
+        fields = self.fields(path)
+        if len(fields) != 1 or fields[0][0]:
+            raise ValueError('"{0}" is a subdocument'.format(path))
+        return fields[0][1]
+
+    def coordinates(self, path):
+        if self.source is None:
+            raise ValueError('$geoWithin only applies to documents')
+        lon, lat = self.source.coordinates(path)
+        if self.rows is not None:
+            lon, lat = lon[self.rows], lat[self.rows]
+        return lon, lat
+
+    def take(self, rows):
+        if self.source is not None:
+            if self.rows is not None:
+                rows = self.rows[rows]
+            return Frame(len(rows), source = self.source, rows = rows)
+        columns = OrderedDict((p, c.take(rows))
+                              for p, c in self.columns.items())
+        return Frame(len(rows), columns, objects = self.objects)
+
+
+def run_pipeline(collection, pipeline):
+    ''' Runs a MongoDB aggregation pipeline on a ColumnarCollection.
+
+    In:
+        collection (ColumnarCollection): Exported documents
+        pipeline (list): Stages of the pipeline
+    Out:
+        list: Resulting documents. As the documents' _id is not exported, the
+            pipeline must end with documents built by $group, $project,
+            $count or $facet.
+    '''
+    return run_stages(Frame(collection.size, source = collection), pipeline)
+
+def run_stages(frame, pipeline):
+    ''' Runs the stages of a pipeline on frame, see run_pipeline(). '''
+    for i, stage in enumerate(pipeline):
+        (name, spec), = stage.items()
+        if name == '$facet':  # Sub-pipelines on the same frame
+            if i != len(pipeline) - 1:
+                raise ValueError('$facet is only supported as the last stage')
+            return [dict((unicode(branch), run_stages(frame, stages))
+                         for branch, stages in spec.items())]
+        elif name == '$match':
+            frame = frame.take(np.flatnonzero(match_mask(frame, spec)))
+        elif name == '$group':
+            frame = group(frame, spec)
+        elif name == '$sort':
+            frame = frame.take(sort_order(frame, spec))
+        elif name == '$skip':
+            frame = frame.take(np.arange(min(spec, frame.size), frame.size))
+        elif name == '$limit':
+            frame = frame.take(np.arange(min(spec, frame.size)))
+        elif name == '$project':
+            frame = project(frame, spec)
+        elif name == '$count':
+            if not frame.size:
+                return []
+            frame = Frame(1, OrderedDict([(spec, column_from_values(
+                                                 [frame.size]))]))
+        else:
+            raise ValueError('Unsupported stage: {0}'.format(name))
+    if frame.source is not None:
+        raise ValueError("Documents' _id is not exported: end the pipeline "
+                         'with $group, $project (without _id) or $count')
+    return to_documents(frame)
+
+
+# B.1. $match ==================================================================
+
+def is_number(value):
+    return isinstance(value, (int, long, float)) and \
+        not isinstance(value, bool)
+
+def comparable(a, b):
+    ''' MongoDB only compares values of the same type bracket. '''
+    return (is_number(a) and is_number(b)) or \
+        (isinstance(a, basestring) and isinstance(b, basestring))
+
+def equal_mask(column, value):
+    if value is None:  # Matches null and missing fields
+        return column.lookup(np.zeros(len(column.values), bool), True, True)
+    return column.lookup([comparable(v, value) and v == value
+                          for v in column.values], False, False)
+
+comparisons = {'$gt': lambda a, b: a > b, '$gte': lambda a, b: a >= b,
+               '$lt': lambda a, b: a < b, '$lte': lambda a, b: a <= b}
+
+def field_mask(frame, path, condition):
+    ''' Returns the rows of frame where the field at path matches condition.
+    '''
+    if not (isinstance(condition, dict) and condition and
+            all(k.startswith('$') for k in condition)):
+        return equal_mask(frame.column(path), condition)
+    mask = np.ones(frame.size, dtype = bool)
+    for op, arg in condition.items():
+        if op == '$geoWithin':
+            mask &= within_mask(frame, path, arg)
+            continue
+        column = frame.column(path)
+        if op == '$eq':
+            mask &= equal_mask(column, arg)
+        elif op == '$ne':
+            mask &= ~equal_mask(column, arg)
+        elif op in ('$in', '$nin'):
+            found = np.zeros(frame.size, dtype = bool)
+            for value in arg:
+                found |= equal_mask(column, value)
+            mask &= found if op == '$in' else ~found
+        elif op == '$exists':
+            exists = bool(arg)
+            mask &= column.lookup(np.ones(len(column.values), bool),
+                                  exists, not exists)
+        elif op in comparisons:
+            compare = comparisons[op]
+            mask &= column.lookup([comparable(v, arg) and compare(v, arg)
+                                   for v in column.values],
+                                  arg is None and op in ('$gte', '$lte'), False)
+        else:
+            raise ValueError('Unsupported query operator: {0}'.format(op))
+    return mask
+
+def match_mask(frame, query):
+    ''' Returns the rows of frame that match a $match query. '''
+    mask = np.ones(frame.size, dtype = bool)
+    for key, condition in query.items():
+        if key in ('$and', '$or', '$nor'):
+            masks = [match_mask(frame, q) for q in condition]
+            if key == '$and':
+                mask &= np.logical_and.reduce(masks)
+            else:
+                found = np.logical_or.reduce(masks)
+                mask &= found if key == '$or' else ~found
+        elif key.startswith('$'):
+            raise ValueError('Unsupported query operator: {0}'.format(key))
+        else:
+            mask &= field_mask(frame, key, condition)
+    return mask
+
+def to_vectors(lon, lat):
+    ''' Unit vectors of points on the sphere. '''
+    lon, lat = np.radians(lon), np.radians(lat)
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon),
+                     np.sin(lat)], axis = -1)
+
+def within_mask(frame, path, spec):
+    ''' Rows of frame with a point inside a GeoJSON polygon. Like MongoDB's
+    2dsphere queries, the edges are great circle arcs and the interior is the
+    smaller of the two areas they delimit. Only convex polygons without holes
+    are supported: a point is inside if it is on the inner side of every edge.
+    '''
+    polygon = spec.get('$geometry') if isinstance(spec, dict) else None
+    if not polygon or polygon.get('type') != 'Polygon' or \
+            len(polygon['coordinates']) != 1:
+        raise ValueError('$geoWithin is only supported with a $geometry '
+                         'Polygon without holes')
+    ring = np.array(polygon['coordinates'][0][:-1], dtype = float)
+    vertices = to_vectors(ring[:, 0], ring[:, 1])
+    center = vertices.sum(axis = 0)
+    lon, lat = frame.coordinates(path)
+    points = to_vectors(lon, lat)
+    mask = ~np.isnan(lon)
+    for a, b in zip(vertices, np.roll(vertices, -1, axis = 0)):
+        normal = np.cross(a, b)
+        side = np.sign(np.dot(normal, center))
+        if np.any(np.dot(vertices, normal) * side < -1e-12):
+            raise ValueError('$geoWithin is only supported with convex polygons')
+        with np.errstate(invalid = 'ignore'):
+            mask &= np.dot(points, normal) * side >= 0
+    return mask
+
+
+# B.2. $group, $sort and $project ==============================================
+
+def expression_fields(frame, expression):
+    ''' Evaluates a field path ("$field") or a constant to (sub-path, Column)
+    pairs. '''
+    if isinstance(expression, basestring) and expression.startswith('$'):
+        return frame.fields(expression[1:])
+    if isinstance(expression, dict):
+        raise ValueError('Unsupported expression: {0}'.format(expression))
+    return [('', constant_column(expression, frame.size))]
+
+def numbers(column):
+    ''' Numeric values of a column per code (0 for anything else) and whether
+    they are numbers. '''
+    is_num = np.array([is_number(v) for v in column.values] + [False, False])
+    values = np.array([v if is_number(v) else 0 for v in column.values] +
+                      [0, 0])
+    return values[column.codes], is_num[column.codes]
+
+def accumulate(frame, inverse, n_groups, spec):
+    ''' Computes an accumulator ({"$sum": ...} or {"$avg": ...}) per group. '''
+    (op, expression), = spec.items()
+    if op not in ('$sum', '$avg'):
+        raise ValueError('Unsupported accumulator: {0}'.format(op))
+    fields = expression_fields(frame, expression)
+    if len(fields) != 1 or fields[0][0]:
+        raise ValueError('Cannot accumulate subdocument {0}'.format(expression))
+    values, is_num = numbers(fields[0][1])
+    if values.dtype.kind == 'f':
+        sums = np.bincount(inverse, values, n_groups).tolist()
+    else:  # Exact integer sums
+        sums = np.zeros(n_groups, dtype = np.int64)
+        np.add.at(sums, inverse, values.astype(np.int64))
+        sums = sums.tolist()
+    if op == '$sum':
+        return sums
+    counts = np.bincount(inverse, is_num, n_groups)
+    return [float(s) / c if c else None for s, c in zip(sums, counts)]
+
+def group(frame, spec):
+    ''' Runs a $group stage: groups are found with numpy.unique on the codes
+    of the _id fields. '''
+    id_spec = spec['_id']
+    keys = OrderedDict()
+    if isinstance(id_spec, dict):  # Compound _id
+        for name, expression in id_spec.items():
+            for sub, column in expression_fields(frame, expression):
+                keys['_id.' + name + sub] = column
+    else:
+        for sub, column in expression_fields(frame, id_spec):
+            if not sub:  # Groups missing fields with nulls
+                column = Column(np.where(column.codes == MISSING, NULL,
+                                         column.codes), column.values)
+            keys['_id' + sub] = column
+    if not frame.size:
+        return Frame(0, OrderedDict((p, c.take(np.arange(0)))
+                                    for p, c in keys.items()))
+    codes = np.stack([c.codes for c in keys.values()], axis = 1)
+    unique, inverse = np.unique(codes, axis = 0, return_inverse = True)
+    columns = OrderedDict((p, Column(unique[:, i], c.values))
+                          for i, (p, c) in enumerate(keys.items()))
+    for name, accumulator in spec.items():
+        if name != '_id':
+            columns[name] = column_from_values(
+                accumulate(frame, inverse, len(unique), accumulator))
+    objects = ['_id'] if isinstance(id_spec, dict) or len(keys) > 1 else []
+    return Frame(len(unique), columns, objects = objects)
+
+def sort_order(frame, spec):
+    ''' Row order of a $sort stage. As values are sorted in each Column,
+    sorting by codes sorts by value; nulls and missing fields come first. '''
+    items = spec.items() if isinstance(spec, dict) else spec
+    keys = []
+    for path, direction in items:
+        for sub, column in frame.fields(path):
+            keys.append(np.maximum(column.codes, MISSING) * direction)
+    return np.lexsort(keys[::-1])  # lexsort sorts by the last key first
+
+def project(frame, spec):
+    ''' Runs a $project stage: inclusion of fields (1), renaming ("$field")
+    and exclusion of _id (0). '''
+    include_id = spec.get('_id', 1)
+    fields = [(k, v) for k, v in spec.items() if k != '_id']
+    if fields and all(v in (0, False) for k, v in fields):  # Exclusion
+        if frame.source is not None:
+            raise ValueError("Documents' _id is not exported, exclusion "
+                             'projections are not supported')
+        columns = OrderedDict((p, c) for p, c in frame.columns.items()
+                              if not any(p == k or p.startswith(k + '.')
+                                         for k, v in fields))
+        if not include_id:
+            columns = OrderedDict((p, c) for p, c in columns.items()
+                                  if p != '_id' and not p.startswith('_id.'))
+        return Frame(frame.size, columns, objects = frame.objects)
+    columns = OrderedDict()
+    objects = []
+    if include_id in (0, False):
+        pass
+    elif include_id in (1, True):
+        if frame.source is not None:
+            raise ValueError("Documents' _id is not exported: project it out "
+                             'with "_id": 0')
+        fields.insert(0, ('_id', '$_id'))
+    else:
+        fields.insert(0, ('_id', include_id))
+    for name, value in fields:
+        if value in (1, True):
+            value = '$' + name
+        for sub, column in expression_fields(frame, value):
+            columns[name + sub] = column
+        if isinstance(value, basestring) and value[1:] in frame.objects:
+            objects.append(name)
+    return Frame(frame.size, columns, objects = objects)
+
+def to_documents(frame):
+    ''' Builds the result documents of a frame of computed columns, with
+    unicode keys and strings like documents returned by pymongo. '''
+    columns = [(p.split('.'), c.codes.tolist(), c.values)
+               for p, c in frame.columns.items()]
+    documents = []
+    for i in range(frame.size):
+        doc = {}
+        for path in frame.objects:
+            doc[unicode(path)] = {}
+        for keys, codes, values in columns:
+            code = codes[i]
+            if code == MISSING:
+                continue
+            parent = doc
+            for key in keys[:-1]:
+                parent = parent.setdefault(unicode(key), {})
+            parent[unicode(keys[-1])] = None if code == NULL else values[code]
+        documents.append(doc)
+    return documents
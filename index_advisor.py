@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+''' Index advisor for the queries of the report (queries.py).
+
+Each pipeline is explained to find the ones that scan the whole collection.
+For those, an index is proposed from the leading $match and $sort stages, in
+the equality / sort / range order that lets MongoDB use it for all three (and
+with a 2dsphere key for geospatial conditions). The indexes can then be built,
+and every query is timed before and after, so that each index is justified by
+a measure.
+
+Usage: python index_advisor.py [--build]
+'''
+
+import argparse
+import time
+from collections import OrderedDict
+
+import queries
+
+geo_operators = ('$geoWithin', '$geoIntersects', '$near', '$nearSphere')
+range_operators = ('$exists', '$ne', '$gt', '$gte', '$lt', '$lte', '$nin')
+
+
+def report_pipelines(coll):
+    ''' Returns the pipelines of the report by name, including cities_by_user
+    for the current top contributors. '''
+    pipelines = OrderedDict(queries.report_queries)
+    user_list = [u[u'_id'] for u in coll.aggregate(queries.match)]
+    pipelines['cities_by_user'] = queries.cities_by_user_query(user_list)
+    return pipelines
+
+def plan_stages(explain):
+    ''' Returns the set of stages (e.g. 'COLLSCAN', 'IXSCAN') found in the
+    winning plans of an explain() output, whatever the server version. '''
+    stages = set()
+    def walk(value, in_plan):
+        if isinstance(value, dict):
+            if in_plan and 'stage' in value:
+                stages.add(value['stage'])
+            for key, sub in value.items():
+                walk(sub, in_plan or key == 'winningPlan')
+        elif isinstance(value, list):
+            for sub in value:
+                walk(sub, in_plan)
+    walk(explain, False)
+    return stages
+
+def explain(db, coll, pipeline):
+    ''' Returns the stages of the winning plan of an aggregation pipeline. '''
+    return plan_stages(db.command('aggregate', coll.name, pipeline = pipeline,
+                                  explain = True))
+
+def time_query(coll, pipeline, repeat = 3):
+    ''' Returns the best time of repeat runs of a pipeline, in seconds. As
+    aggregate() in queries.py may answer from its cache, the collection is
+    queried directly. '''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.time()
+        for doc in coll.aggregate(pipeline):
+            pass
+        best = min(best, time.time() - start)
+    return best
+
+def propose_index(pipeline):
+    ''' Proposes index keys for a pipeline: fields matched by equality first,
+    then the fields of a $sort right after the $match, then fields matched by
+    range (including $exists, $ne and $nin). Geospatial conditions get a
+    2dsphere key.
+
+    In:
+        pipeline (list): Aggregation pipeline
+    Out:
+        list: (field, direction or '2dsphere') pairs, empty if no index can
+            serve the pipeline (e.g. a $group over the whole collection)
+    '''
+    equality, sort, ranges, geo = [], [], [], []
+    stages = list(pipeline)
+    if stages and '$match' in stages[0]:
+        for field, condition in sorted(stages.pop(0)['$match'].items()):
+            if field.startswith('$'):  # $and, $or...: no single index
+                continue
+            operators = condition.keys() if isinstance(condition, dict) else ()
+            if any(op in geo_operators for op in operators):
+                geo.append((field, '2dsphere'))
+            elif any(op in range_operators for op in operators):
+                ranges.append((field, 1))
+            else:  # Values, $eq and $in
+                equality.append((field, 1))
+    if stages and '$sort' in stages[0]:
+        sort = list(stages[0]['$sort'].items())
+    keys = equality + sort + ranges + geo
+    seen = set()
+    return [(f, d) for f, d in keys if not (f in seen or seen.add(f))]
+
+def advise(build = False, host = 'localhost:27017', repeat = 3):
+    ''' Explains and times every query of the report, proposes an index for
+    each one that scans the whole collection and, if build is True, builds
+    these indexes and measures the queries again.
+
+    In:
+        build (bool): Whether to create the proposed indexes
+        host (string): MongoDB host and port
+        repeat (int): Number of runs per timing (the best one is kept)
+    Out:
+        list: One dict per query with its 'name', 'plan' and 'time' (before),
+            proposed 'index' (or None), and 'plan_after' and 'time_after' if
+            the indexes were built
+    '''
+    from pymongo import MongoClient
+    client = MongoClient(host)
+    try:
+        db = client.OpenStreetMap
+        coll = db.Versailles
+        rows = []
+        for name, pipeline in report_pipelines(coll).items():
+            plan = explain(db, coll, pipeline)
+            keys = propose_index(pipeline) if 'COLLSCAN' in plan else []
+            rows.append({'name': name, 'pipeline': pipeline, 'plan': plan,
+                         'time': time_query(coll, pipeline, repeat),
+                         'index': keys or None})
+        if build:
+            existing = set(tuple(i['key'].items())
+                           for i in coll.list_indexes())
+            for keys in set(tuple(r['index']) for r in rows if r['index']):
+                if keys not in existing:
+                    coll.create_index(list(keys))
+            for row in rows:
+                row['plan_after'] = explain(db, coll, row['pipeline'])
+                row['time_after'] = time_query(coll, row['pipeline'], repeat)
+        return rows
+    finally:
+        client.close()
+
+def print_advice(rows):
+    print "{0:<16} {1:<24} {2:>9} {3:>9}  {4}".format(
+        'Query', 'Plan', 'Before', 'After', 'Proposed index')
+    for row in rows:
+        plan = ','.join(sorted(row.get('plan_after', row['plan']) &
+                               set(['COLLSCAN', 'IXSCAN', 'GEO_NEAR_2DSPHERE',
+                                    'DISTINCT_SCAN'])))
+        after = '{0:.3f}s'.format(row['time_after']) \
+            if 'time_after' in row else '-'
+        index = ', '.join('{0}: {1}'.format(f, d) for f, d in row['index']) \
+            if row['index'] else ('full scan needed'
+                                  if 'COLLSCAN' in row['plan'] else '-')
+        print "{0:<16} {1:<24} {2:>8.3f}s {3:>9}  {4}".format(
+            row['name'], plan, row['time'], after, index)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Index advisor for the '
+                                     'queries of the report')
+    parser.add_argument('--build', action = 'store_true',
+                        help = 'create the proposed indexes')
+    parser.add_argument('--host', default = 'localhost:27017')
+    args = parser.parse_args()
+    print_advice(advise(args.build, args.host))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+''' Instrumentation of the conversion pipeline.
+
+A Metrics object is passed down to process_map() (or iter_documents()), which
+then times each stage of the processing of every element: XML parsing,
+shape_element(), street name normalization, postcode / city matching, JSON
+writing... The functions only check whether they were given one, so the
+overhead is a test per stage when instrumentation is disabled.
+
+The results (wall and CPU time per stage, element counters, cache hit rates,
+throughput and memory high-water mark) are saved as a JSON file, and progress
+lines can be printed periodically during the run.
+
+Worker processes (see process_map_parallel() and iter_pbf_documents()) use
+their own Metrics, whose totals() are merged into the Metrics of the parent:
+stage times are then summed over the workers, and may add up to more than the
+wall time.
+'''
+
+import json
+import resource
+import sys
+import time
+from collections import Counter, OrderedDict
+
+
+def peak_rss_mb():
+    ''' Memory high-water mark of the process, in MB. '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+class Metrics(object):
+    ''' Collects the time spent in each stage, counters and cache lookups.
+
+    Timing a stage:
+        start = metrics.clock()
+        ...
+        metrics.add('stage', start)
+
+    In:
+        progress_interval (float): If set, print a progress line every
+            progress_interval seconds (checked every 1000 documents)
+        stream (file object): Where to print the progress lines
+    '''
+    def __init__(self, progress_interval = None, stream = sys.stderr):
+        self.progress_interval = progress_interval
+        self.stream = stream
+        self.stages = OrderedDict()  # Stage -> [wall, cpu, calls]
+        self.counters = Counter()
+        self.lookups = {}  # Cache -> [lookups, hits]
+        self.documents = 0
+        self.workers = {'cpu_seconds': 0., 'peak_rss_mb': None}  # Merged
+        self.start = self.clock()
+        self.last_progress = self.start[0]
+
+    def clock(self):
+        return time.time(), time.clock()
+
+    def add(self, stage, start, calls = 1):
+        ''' Adds the time elapsed since start (as returned by clock()) to
+        stage. '''
+        wall, cpu = time.time() - start[0], time.clock() - start[1]
+        totals = self.stages.get(stage)
+        if totals is None:
+            totals = self.stages[stage] = [0., 0., 0]
+        totals[0] += wall
+        totals[1] += cpu
+        totals[2] += calls
+
+    def timed(self, stage, iterable):
+        ''' Yields the items of iterable, adding the time spent producing each
+        of them (e.g. parsing) to stage. '''
+        iterator = iter(iterable)
+        while True:
+            start = self.clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, start, 0)
+                return
+            self.add(stage, start)
+            yield item
+
+    def count(self, name, n = 1):
+        self.counters[name] += n
+
+    def lookup(self, cache, hit):
+        ''' Records a lookup in a cache (e.g. the street name memo). '''
+        totals = self.lookups.get(cache)
+        if totals is None:
+            totals = self.lookups[cache] = [0, 0]
+        totals[0] += 1
+        totals[1] += hit
+
+    def document(self):
+        ''' Counts a converted document, and prints a progress line if it is
+        time to. '''
+        self.documents += 1
+        if not self.documents % 1000:
+            self.progress()
+
+    def progress(self):
+        ''' Prints a progress line if progress_interval seconds have passed
+        since the last one. '''
+        if not self.progress_interval:
+            return
+        now = time.time()
+        if now - self.last_progress >= self.progress_interval:
+            self.last_progress = now
+            elapsed = now - self.start[0]
+            self.stream.write("    {0} documents in {1:.0f}s ({2:.0f} "
+                              "docs/s), {3:.0f} MB peak\n".format(
+                              self.documents, elapsed,
+                              self.documents / elapsed, peak_rss_mb()))
+            self.stream.flush()
+
+    def totals(self):
+        ''' Returns what was collected so far, to be sent to the parent
+        process and merged into its Metrics (see merge()). '''
+        return {'stages': self.stages, 'counters': self.counters,
+                'lookups': self.lookups, 'documents': self.documents,
+                'cpu_seconds': time.clock() - self.start[1],
+                'peak_rss_mb': peak_rss_mb()}
+
+    def merge(self, totals):
+        ''' Adds the totals() of a worker process. '''
+        for stage, (wall, cpu, calls) in totals['stages'].items():
+            own = self.stages.get(stage)
+            if own is None:
+                own = self.stages[stage] = [0., 0., 0]
+            own[0] += wall
+            own[1] += cpu
+            own[2] += calls
+        self.counters.update(totals['counters'])
+        for cache, (lookups, hits) in totals['lookups'].items():
+            own = self.lookups.get(cache)
+            if own is None:
+                own = self.lookups[cache] = [0, 0]
+            own[0] += lookups
+            own[1] += hits
+        self.documents += totals['documents']
+        self.workers['cpu_seconds'] += totals['cpu_seconds']
+        self.workers['peak_rss_mb'] = max(self.workers['peak_rss_mb'],
+                                          totals['peak_rss_mb'])
+        self.progress()
+
+    def report(self):
+        ''' Returns all the metrics as a JSON-serializable dict. '''
+        elapsed = time.time() - self.start[0]
+        stages = OrderedDict()
+        for stage, (wall, cpu, calls) in self.stages.items():
+            stages[stage] = {'wall_seconds': wall, 'cpu_seconds': cpu,
+                             'calls': calls,
+                             'calls_per_second': calls / wall if wall else None,
+                             'share_of_wall_time': wall / elapsed
+                                                   if elapsed else None}
+        caches = dict((cache, {'lookups': lookups, 'hits': hits,
+                               'hit_rate': float(hits) / lookups
+                                           if lookups else None})
+                      for cache, (lookups, hits) in self.lookups.items())
+        return {'wall_seconds': elapsed,
+                'cpu_seconds': time.clock() - self.start[1] +
+                               self.workers['cpu_seconds'],
+                'documents': self.documents,
+                'documents_per_second': self.documents / elapsed
+                                        if elapsed else None,
+                'peak_rss_mb': peak_rss_mb(),
+                'worker_peak_rss_mb': self.workers['peak_rss_mb'],
+                'stages': stages,
+                'counters': dict(self.counters),
+                'caches': caches}
+
+    def save(self, path):
+        ''' Writes report() as a JSON file. '''
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent = 2, separators = (',', ': '))
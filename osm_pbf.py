@@ -0,0 +1,767 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+''' Reader for OSM PBF files (https://wiki.openstreetmap.org/wiki/PBF_Format).
+
+The file is made of independent, zlib-compressed blocks of a few thousand
+nodes, ways or relations. Blocks are decoded in parallel by a pool of worker
+processes (see map_blocks()), either into the XML elements that ET.iterparse
+would give for the same data, so the audits work on them unchanged (see
+iter_pbf_elements()), or straight into the documents of the conversion (see
+iter_documents() in clean_and_save_to_json.py).
+
+The messages are decoded by the protobuf library if it is installed with its
+compiled implementation (the message classes are generated from the schema
+below), and by hand otherwise, which needs no library but is several times
+slower. xml_to_pbf() writes PBF files, for the tests and benchmarks.
+'''
+
+import calendar
+import struct
+import time
+import zlib
+import xml.etree.cElementTree as ET
+from collections import deque
+from itertools import repeat
+from multiprocessing import Pool, cpu_count
+
+
+# Protocol buffers wire format =================================================
+
+def read_varint(buf, pos):
+    ''' Decodes the varint starting at buf[pos] (buf being a bytearray).
+    Returns the value and the position just after it. '''
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+def iter_fields(buf):
+    ''' Iterates through the fields of a protobuf message.
+    In:
+        buf (bytearray): Encoded message
+    Out:
+        generator: (field number, wire type, value) tuples. Values are ints for
+            varints and bytearrays for everything else.
+    '''
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:  # Varint
+            value, pos = read_varint(buf, pos)
+        elif wire_type == 2:  # Length-delimited
+            length, pos = read_varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire_type == 1:  # 64-bit
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:  # 32-bit
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported wire type {0}".format(wire_type))
+        yield number, wire_type, value
+
+def unpack_varints(buf):
+    ''' Decodes a packed repeated varint field. '''
+    values = []
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        value, pos = read_varint(buf, pos)
+        values.append(value)
+    return values
+
+def zigzag(n):
+    ''' Decodes a sint32 / sint64 value. '''
+    return (n >> 1) ^ -(n & 1)
+
+def signed(n):
+    ''' Decodes an int32 / int64 value (two's complement on 64 bits). '''
+    return n - (1 << 64) if n >= (1 << 63) else n
+
+def to_string(buf):
+    ''' Returns a byte string as ElementTree would: str if ASCII, else
+    unicode. '''
+    s = str(buf)
+    try:
+        s.decode('ascii')
+        return s
+    except UnicodeDecodeError:
+        return s.decode('utf-8')
+
+
+# Messages =====================================================================
+
+# The messages of the format (fileformat.proto and osmformat.proto), reduced to
+# the fields read here: (message, fields), each field being a (name, number, 
+# type, repeated) tuple. Messages come after the messages they contain.
+schema = [
+    ('Blob', [('raw', 1, 'bytes', False), ('raw_size', 2, 'int32', False),
+              ('zlib_data', 3, 'bytes', False),
+              ('lzma_data', 4, 'bytes', False),
+              ('lz4_data', 6, 'bytes', False),
+              ('zstd_data', 7, 'bytes', False)]),
+    ('StringTable', [('s', 1, 'bytes', True)]),
+    ('Info', [('version', 1, 'int32', False),
+              ('timestamp', 2, 'int64', False),
+              ('changeset', 3, 'int64', False), ('uid', 4, 'int32', False),
+              ('user_sid', 5, 'uint32', False),
+              ('visible', 6, 'bool', False)]),
+    ('DenseInfo', [('version', 1, 'int32', True),
+                   ('timestamp', 2, 'sint64', True),
+                   ('changeset', 3, 'sint64', True),
+                   ('uid', 4, 'sint32', True),
+                   ('user_sid', 5, 'sint32', True),
+                   ('visible', 6, 'bool', True)]),
+    ('Node', [('id', 1, 'sint64', False), ('keys', 2, 'uint32', True),
+              ('vals', 3, 'uint32', True), ('info', 4, 'Info', False),
+              ('lat', 8, 'sint64', False), ('lon', 9, 'sint64', False)]),
+    ('DenseNodes', [('id', 1, 'sint64', True),
+                    ('denseinfo', 5, 'DenseInfo', False),
+                    ('lat', 8, 'sint64', True), ('lon', 9, 'sint64', True),
+                    ('keys_vals', 10, 'int32', True)]),
+    ('Way', [('id', 1, 'int64', False), ('keys', 2, 'uint32', True),
+             ('vals', 3, 'uint32', True), ('info', 4, 'Info', False),
+             ('refs', 8, 'sint64', True)]),
+    ('Relation', [('id', 1, 'int64', False), ('keys', 2, 'uint32', True),
+                  ('vals', 3, 'uint32', True), ('info', 4, 'Info', False),
+                  ('roles_sid', 8, 'int32', True),
+                  ('memids', 9, 'sint64', True),
+                  ('types', 10, 'int32', True)]),  # An enum in the .proto
+    ('PrimitiveGroup', [('nodes', 1, 'Node', True),
+                        ('dense', 2, 'DenseNodes', False),
+                        ('ways', 3, 'Way', True),
+                        ('relations', 4, 'Relation', True)]),
+    ('PrimitiveBlock', [('stringtable', 1, 'StringTable', False),
+                        ('primitivegroup', 2, 'PrimitiveGroup', True),
+                        ('granularity', 17, 'int32', False),
+                        ('date_granularity', 18, 'int32', False),
+                        ('lat_offset', 19, 'int64', False),
+                        ('lon_offset', 20, 'int64', False)])]
+
+field_defaults = {('PrimitiveBlock', 'granularity'): 100,  # Other fields 
+                  ('PrimitiveBlock', 'date_granularity'): 1000}  # default to 0
+
+decoder = None  # 'protobuf' (the protobuf library, with its compiled
+# implementation), 'python' (decode_message()), or None for 'protobuf' when it
+# is installed and 'python' otherwise
+
+scalar_decoders = {'int32': signed, 'int64': signed, 'uint32': None, 
+                   'sint32': zigzag, 'sint64': zigzag, 'bool': bool}
+
+class Message(object):
+    ''' Base class of the messages decoded by decode_message(). Fields are
+    attributes, which have the protobuf default value when the field is not in
+    the message. '''
+    fields = {}  # Field number -> (name, type, repeated)
+
+    def HasField(self, name):  # Same as the protobuf library's
+        return name in self.__dict__
+
+def message_classes():
+    ''' Returns a Message subclass for each message of the schema, by name. '''
+    classes = {}
+    for message, fields in schema:
+        attributes = {'fields': {}}
+        for name, number, field_type, is_repeated in fields:
+            if is_repeated:
+                attributes[name] = ()
+            elif field_type in classes:
+                attributes[name] = classes[field_type]()  # Empty message
+            else:
+                attributes[name] = field_defaults.get((message, name), 
+                    '' if field_type == 'bytes' else 0)
+            attributes['fields'][number] = (name, field_type, is_repeated)
+        classes[message] = type(message, (Message,), attributes)
+    return classes
+
+messages = message_classes()
+
+def decode_message(buf, message):
+    ''' Decodes a message of the schema without the protobuf library.
+    In:
+        buf (bytearray): Encoded message
+        message (string): Name of the message in the schema
+    Out:
+        Message: Values are decoded as by the protobuf library (zigzag for
+            sint fields, etc.), and repeated fields are lists.
+    '''
+    msg = messages[message]()
+    fields = msg.fields
+    for number, wire_type, value in iter_fields(buf):
+        field = fields.get(number)
+        if field is None:  # Not read here
+            continue
+        name, field_type, is_repeated = field
+        if field_type in messages:
+            values = [decode_message(value, field_type)]
+        elif field_type == 'bytes':
+            values = [str(value)]
+        else:
+            values = unpack_varints(value) if wire_type == 2 else [value]
+            if scalar_decoders[field_type] is not None:
+                values = map(scalar_decoders[field_type], values)
+        if is_repeated:
+            msg.__dict__.setdefault(name, []).extend(values)
+        else:
+            setattr(msg, name, values[-1])
+    return msg
+
+compiled = {}  # Message classes generated by the protobuf library, see 
+# compiled_classes()
+
+def compiled_classes():
+    ''' Returns the message classes of the schema generated by the protobuf 
+    library, by name. They are generated at run time from the schema, so 
+    neither the .proto files nor protoc are needed, and once per process.
+    Out:
+        dict or None: None if the library is not installed, or if it only has
+            its pure-Python implementation, which is slower than 
+            decode_message()
+    '''
+    if 'classes' in compiled:
+        return compiled['classes']
+    compiled['classes'] = None
+    try:
+        from google.protobuf import descriptor_pb2, descriptor_pool
+        from google.protobuf import message_factory
+        from google.protobuf.internal import api_implementation
+    except ImportError:
+        return None
+    if api_implementation.Type() == 'python':
+        return None
+    Field = descriptor_pb2.FieldDescriptorProto
+    package = 'osm_pbf'
+    proto = descriptor_pb2.FileDescriptorProto(name = 'osm_pbf.proto',
+                                               package = package)
+    for message, fields in schema:
+        message_proto = proto.message_type.add(name = message)
+        for name, number, field_type, is_repeated in fields:
+            field = message_proto.field.add(name = name, number = number,
+                label = Field.LABEL_REPEATED if is_repeated 
+                        else Field.LABEL_OPTIONAL)
+            if field_type in messages:
+                field.type = Field.TYPE_MESSAGE
+                field.type_name = '.{0}.{1}'.format(package, field_type)
+            else:
+                field.type = getattr(Field, 'TYPE_' + field_type.upper())
+            if (message, name) in field_defaults:
+                field.default_value = str(field_defaults[(message, name)])
+    pool = descriptor_pool.DescriptorPool()  # Kept apart from the default 
+    pool.AddSerializedFile(proto.SerializeToString())  # pool of the library
+    get_class = getattr(message_factory, 'GetMessageClass', None)
+    if get_class is None:  # protobuf < 4.21
+        get_class = message_factory.MessageFactory(pool).GetPrototype
+    compiled['classes'] = dict(
+        (message, get_class(pool.FindMessageTypeByName(package + '.' + 
+                                                       message)))
+        for message, fields in schema)
+    return compiled['classes']
+
+def parse_message(data, message):
+    ''' Decodes a message of the schema with the decoder selected by decoder.
+    In:
+        data (string): Encoded message
+        message (string): Name of the message in the schema
+    Out:
+        Message or protobuf message: Both have the same attributes
+    '''
+    classes = compiled_classes() if decoder != 'python' else None
+    if classes is not None:
+        return classes[message].FromString(data)
+    if decoder == 'protobuf':
+        raise ImportError("The protobuf library is not installed, or without "
+                          "its compiled implementation")
+    return decode_message(bytearray(data), message)
+
+
+# OSM PBF blocks ===============================================================
+
+def read_blobs(filename):
+    ''' Reads the file block by block, without decoding the blocks.
+    Out:
+        generator: (type, blob) tuples, type being 'OSMHeader' or 'OSMData'
+            and blob the encoded Blob message.
+    '''
+    with open(filename, 'rb') as f:
+        while True:
+            size = f.read(4)
+            if not size:
+                return
+            header_size, = struct.unpack('>I', size)
+            blob_type = None
+            blob_size = 0
+            for number, _, value in iter_fields(bytearray(f.read(header_size))):
+                if number == 1:
+                    blob_type = str(value)
+                elif number == 3:
+                    blob_size = value
+            yield blob_type, f.read(blob_size)
+
+def decompress_blob(blob):
+    ''' Returns the decompressed content of a Blob message. '''
+    blob = parse_message(blob, 'Blob')
+    if blob.lzma_data or blob.lz4_data or blob.zstd_data:
+        raise ValueError("Unsupported PBF compression (lzma, lz4 or zstd)")
+    if blob.zlib_data:
+        return zlib.decompress(blob.zlib_data)
+    return blob.raw
+
+def format_coordinate(nanodegrees):
+    ''' Formats a coordinate in nanodegrees with 7 decimals, as in OSM XML. '''
+    units, remainder = divmod(nanodegrees, 100)
+    if remainder:  # Finer than OSM's usual precision
+        return '{0:.9f}'.format(nanodegrees * 1e-9)
+    sign = '-' if units < 0 else ''
+    return '{0}{1}.{2:07d}'.format(sign, abs(units) // 10 ** 7,
+                                   abs(units) % 10 ** 7)
+
+def format_timestamp(milliseconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', 
+                         time.gmtime(milliseconds // 1000))
+
+def format_timestamps(timestamps, date_granularity):
+    ''' Formats a column of timestamps, which often repeat from one node to the
+    next (same changeset). '''
+    formatted = {}
+    result = []
+    for timestamp in timestamps:
+        s = formatted.get(timestamp)
+        if s is None:
+            s = formatted[timestamp] = format_timestamp(timestamp * 
+                                                        date_granularity)
+        result.append(s)
+    return result
+
+def delta_decode(values):
+    ''' Decodes delta-coded values (DenseNodes, refs): returns their running
+    sums. '''
+    result = []
+    current = 0
+    for v in values:
+        current += v
+        result.append(current)
+    return result
+
+entity_info = ('version', 'changeset', 'timestamp', 'user', 'uid', 'visible')
+# Attributes of the info of an entity, see decode_block()
+
+member_names = ('node', 'way', 'relation')  # Relation member types, by value
+
+def decode_info(info, strings, date_granularity):
+    ''' Returns the info tuple of an entity from its Info message. '''
+    has = info.HasField
+    return (str(info.version) if has('version') else None,
+            str(info.changeset) if has('changeset') else None,
+            format_timestamp(info.timestamp * date_granularity)
+                if has('timestamp') else None,
+            strings[info.user_sid] if has('user_sid') else None,
+            str(info.uid) if has('uid') else None,
+            ('true' if info.visible else 'false') if has('visible') else None)
+
+def decode_dense(dense, strings, block):
+    ''' Decodes a DenseNodes message into a list of node entities. '''
+    ids = [str(i) for i in delta_decode(dense.id)]
+    n = len(ids)
+    granularity = block.granularity
+    lats = [(block.lat_offset + granularity * lat) / 1e9 
+            for lat in delta_decode(dense.lat)]
+    lons = [(block.lon_offset + granularity * lon) / 1e9 
+            for lon in delta_decode(dense.lon)]
+    info = dense.denseinfo
+    columns = [[None] * n] * len(entity_info)
+    if info.version:
+        columns[:5] = [[str(v) for v in info.version],
+                       [str(c) for c in delta_decode(info.changeset)],
+                       format_timestamps(delta_decode(info.timestamp),
+                                         block.date_granularity),
+                       [strings[s] for s in delta_decode(info.user_sid)],
+                       [str(u) for u in delta_decode(info.uid)]]
+    if info.visible:
+        columns[5] = ['true' if v else 'false' for v in info.visible]
+    keys_vals = list(dense.keys_vals)
+    if keys_vals:
+        tags = []
+        kv = 0  # Position in keys_vals
+        for _ in xrange(n):
+            node_tags = []
+            while keys_vals[kv]:  # 0 ends the tags of the node
+                node_tags.append((strings[keys_vals[kv]], 
+                                  strings[keys_vals[kv + 1]]))
+                kv += 2
+            kv += 1
+            tags.append(node_tags)
+    else:
+        tags = [()] * n
+    return zip(repeat('node'), ids, zip(*columns), lats, lons, tags, 
+               repeat(()), repeat(()))
+
+def decode_block(blob):
+    ''' Decodes an OSMData blob, with the protobuf library if available (see 
+    decoder). Runs in a worker process.
+    In:
+        blob (string): Encoded Blob message
+    Out:
+        list of tuples: One (tag, id, info, lat, lon, tags, node refs, members)
+            tuple per node, way or relation, in file order. info is a tuple of
+            the attributes named in entity_info, strings as in the XML 
+            attributes or None if missing; lat and lon are floats for the 
+            nodes, None otherwise; tags a list of (k, v) pairs and members a 
+            list of (type, ref, role) tuples.
+    '''
+    block = parse_message(decompress_blob(blob), 'PrimitiveBlock')
+    strings = [to_string(s) for s in block.stringtable.s]
+    granularity = block.granularity
+    date_granularity = block.date_granularity
+    entities = []
+    for group in block.primitivegroup:
+        for node in group.nodes:
+            entities.append(('node', str(node.id), 
+                decode_info(node.info, strings, date_granularity),
+                (block.lat_offset + granularity * node.lat) / 1e9,
+                (block.lon_offset + granularity * node.lon) / 1e9,
+                [(strings[k], strings[v]) for k, v in zip(node.keys, 
+                                                          node.vals)], 
+                (), ()))
+        if group.dense.id:
+            entities.extend(decode_dense(group.dense, strings, block))
+        for way in group.ways:
+            entities.append(('way', str(way.id), 
+                decode_info(way.info, strings, date_granularity), None, None,
+                [(strings[k], strings[v]) for k, v in zip(way.keys, way.vals)],
+                [str(ref) for ref in delta_decode(way.refs)], ()))
+        for relation in group.relations:
+            entities.append(('relation', str(relation.id), 
+                decode_info(relation.info, strings, date_granularity), 
+                None, None,
+                [(strings[k], strings[v]) for k, v in zip(relation.keys, 
+                                                          relation.vals)],
+                (), [(member_names[t], str(ref), strings[role]) 
+                     for t, ref, role in zip(relation.types, 
+                                             delta_decode(relation.memids),
+                                             relation.roles_sid)]))
+    return entities
+
+def decode_header(blob):
+    ''' Decodes an OSMHeader blob.
+    Out:
+        dict: Attributes of the equivalent <bounds> XML element (empty if the
+            file has no bounding box)
+    '''
+    bounds = {}
+    for number, _, value in iter_fields(bytearray(decompress_blob(blob))):
+        if number == 1:  # HeaderBBox, in nanodegrees
+            box = dict((n, zigzag(v)) for n, _, v in iter_fields(value))
+            bounds = {'minlon': format_coordinate(box.get(1, 0)),
+                      'maxlon': format_coordinate(box.get(2, 0)),
+                      'maxlat': format_coordinate(box.get(3, 0)),
+                      'minlat': format_coordinate(box.get(4, 0))}
+        elif number == 4 and str(value) not in ('OsmSchema-V0.6',
+                                                'DenseNodes'):
+            raise ValueError("Unsupported PBF feature: " + str(value))
+    return bounds
+
+def read_bounds(filename):
+    ''' Decodes the OSMHeader blob, which comes first in the file, see 
+    decode_header(). '''
+    for blob_type, blob in read_blobs(filename):
+        return decode_header(blob) if blob_type == 'OSMHeader' else {}
+    return {}
+
+def map_blocks(filename, function, processes = None, initializer = None,
+               initargs = ()):
+    ''' Applies function to each OSMData blob of the file in a pool of worker 
+    processes, a few blocks ahead of the consumer. With a single process, the
+    blobs are processed in this process instead, which saves sending the
+    results from one process to the other.
+    In:
+        filename (string): Path to the .osm.pbf file
+        function (function): Called with each blob (e.g. decode_block())
+        processes (int): Number of worker processes. Defaults to the number of
+            CPUs.
+        initializer, initargs: As for multiprocessing.Pool
+    Out:
+        generator: Results of function, in file order
+    '''
+    processes = processes or cpu_count()
+    blobs = (blob for blob_type, blob in read_blobs(filename)
+             if blob_type == 'OSMData')
+    if processes == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for blob in blobs:
+            yield function(blob)
+        return
+    pool = Pool(processes, initializer, initargs)
+    try:
+        pending = deque()
+        for blob in blobs:
+            pending.append(pool.apply_async(function, (blob,)))
+            while len(pending) > 2 * processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+# Elements =====================================================================
+
+def build_elements(entity):
+    ''' Turns an entity decoded by decode_block() into XML elements.
+    Out:
+        list: The sub-elements (nd, tag, member), then the element itself, in
+            the order ET.iterparse gives them with 'end' events.
+    '''
+    tag, element_id, info, lat, lon, tags, refs, members = entity
+    attrib = {'id': element_id}
+    for name, value in zip(entity_info, info):
+        if value is not None:
+            attrib[name] = value
+    if lat is not None:
+        attrib['lat'] = format_coordinate(int(round(lat * 1e9)))
+        attrib['lon'] = format_coordinate(int(round(lon * 1e9)))
+    elem = ET.Element(tag, attrib)
+    for ref in refs:
+        ET.SubElement(elem, 'nd', {'ref': ref})
+    for member_type, ref, role in members:
+        ET.SubElement(elem, 'member', {'type': member_type, 'ref': ref,
+                                       'role': role})
+    for k, v in tags:
+        ET.SubElement(elem, 'tag', {'k': k, 'v': v})
+    return list(elem) + [elem]
+
+def iter_pbf_elements(filename, processes = None):
+    ''' Iterates through an OSM PBF file and yields the same elements as
+    iter_elements() would for the equivalent OSM XML file: the <bounds>, then
+    each node, way and relation preceded by its sub-elements, and finally the
+    <osm> root. Data blocks are decoded in parallel, see map_blocks().
+
+    In:
+        filename (string): Path to the .osm.pbf file
+        processes (int): Number of worker processes. Defaults to the number of
+            CPUs.
+    Out:
+        generator: XML elements
+    '''
+    bounds = read_bounds(filename)
+    if bounds:
+        yield ET.Element('bounds', bounds)
+    for entities in map_blocks(filename, decode_block, processes):
+        for entity in entities:
+            for elem in build_elements(entity):
+                yield elem
+    yield ET.Element('osm', {'version': '0.6'})
+
+
+# Writing ======================================================================
+
+def encode_varint(n):
+    ''' Encodes an int as a varint (negative values on 64 bits). '''
+    if n < 0:
+        n += 1 << 64
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return out
+
+def zigzag_encode(n):
+    return (n << 1) ^ (n >> 63)
+
+def varint_field(number, value):
+    return encode_varint(number << 3) + encode_varint(value)
+
+def bytes_field(number, data):
+    return encode_varint(number << 3 | 2) + encode_varint(len(data)) + data
+
+def packed_field(number, values):
+    data = bytearray()
+    for value in values:
+        data += encode_varint(value)
+    return bytes_field(number, data)
+
+def delta_encode(values):
+    ''' Zigzag-encoded deltas, as decoded by decode_message() and
+    delta_decode(). '''
+    result = []
+    previous = 0
+    for value in values:
+        result.append(zigzag_encode(value - previous))
+        previous = value
+    return result
+
+def write_blob(f, blob_type, data):
+    blob = (varint_field(2, len(data)) +
+            bytes_field(3, bytearray(zlib.compress(str(data)))))
+    header = bytes_field(1, bytearray(blob_type)) + varint_field(3, len(blob))
+    f.write(struct.pack('>I', len(header)))
+    f.write(header)
+    f.write(blob)
+
+def parse_coordinate(value):
+    ''' Coordinate of an XML attribute, in units of 100 nanodegrees. '''
+    return int(round(float(value) * 10 ** 7))
+
+def parse_timestamp(value):
+    return calendar.timegm(time.strptime(value, '%Y-%m-%dT%H:%M:%SZ'))
+
+class StringTable(object):
+    ''' Strings of a PrimitiveBlock, by index (0 is reserved). '''
+    def __init__(self):
+        self.strings = ['']
+        self.index = {'': 0}
+
+    def __call__(self, s):
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        i = self.index.get(s)
+        if i is None:
+            i = self.index[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+    def encode(self):
+        return bytes_field(1, bytearray().join(bytes_field(1, bytearray(s))
+                                               for s in self.strings))
+
+info_attributes = ('version', 'timestamp', 'changeset', 'uid', 'user')
+
+def encode_info(elem, strings):
+    ''' Info message of a way or a relation, with the attributes it has. '''
+    data = bytearray()
+    get = elem.get
+    if get('version') is not None:
+        data += varint_field(1, int(get('version')))
+    if get('timestamp') is not None:
+        data += varint_field(2, parse_timestamp(get('timestamp')))
+    if get('changeset') is not None:
+        data += varint_field(3, int(get('changeset')))
+    if get('uid') is not None:
+        data += varint_field(4, int(get('uid')))
+    if get('user') is not None:
+        data += varint_field(5, strings(get('user')))
+    if get('visible') is not None:
+        data += varint_field(6, get('visible') == 'true')
+    return bytes_field(4, data) if data else bytearray()
+
+def encode_tags(elem, strings):
+    tags = elem.findall('tag')
+    if not tags:
+        return bytearray()
+    return (packed_field(2, [strings(t.get('k')) for t in tags]) +
+            packed_field(3, [strings(t.get('v')) for t in tags]))
+
+def encode_dense(nodes, strings):
+    ''' DenseNodes message. The DenseInfo is only written if every node has
+    all the metadata attributes. '''
+    data = packed_field(1, delta_encode([int(n.get('id')) for n in nodes]))
+    if all(n.get(a) is not None for n in nodes for a in info_attributes):
+        info = (packed_field(1, [int(n.get('version')) for n in nodes]) +
+                packed_field(2, delta_encode([parse_timestamp(
+                    n.get('timestamp')) for n in nodes])) +
+                packed_field(3, delta_encode([int(n.get('changeset'))
+                                              for n in nodes])) +
+                packed_field(4, delta_encode([int(n.get('uid'))
+                                              for n in nodes])) +
+                packed_field(5, delta_encode([strings(n.get('user'))
+                                              for n in nodes])))
+        if all(n.get('visible') is not None for n in nodes):
+            info += packed_field(6, [n.get('visible') == 'true'
+                                     for n in nodes])
+        data += bytes_field(5, info)
+    data += packed_field(8, delta_encode([parse_coordinate(n.get('lat'))
+                                          for n in nodes]))
+    data += packed_field(9, delta_encode([parse_coordinate(n.get('lon'))
+                                          for n in nodes]))
+    keys_vals = []
+    for n in nodes:
+        for t in n.findall('tag'):
+            keys_vals += [strings(t.get('k')), strings(t.get('v'))]
+        keys_vals.append(0)
+    if any(keys_vals):
+        data += packed_field(10, keys_vals)
+    return bytes_field(2, data)
+
+def encode_way(way, strings):
+    data = (varint_field(1, int(way.get('id'))) + encode_tags(way, strings) +
+            encode_info(way, strings) +
+            packed_field(8, delta_encode([int(nd.get('ref'))
+                                          for nd in way.findall('nd')])))
+    return bytes_field(3, data)
+
+member_types = {'node': 0, 'way': 1, 'relation': 2}
+
+def encode_relation(relation, strings):
+    members = relation.findall('member')
+    data = (varint_field(1, int(relation.get('id'))) +
+            encode_tags(relation, strings) + encode_info(relation, strings) +
+            packed_field(8, [strings(m.get('role')) for m in members]) +
+            packed_field(9, delta_encode([int(m.get('ref')) for m in members])) +
+            packed_field(10, [member_types[m.get('type')] for m in members]))
+    return bytes_field(4, data)
+
+def write_block(f, tag, elements):
+    ''' Writes elements of the same type as an OSMData blob. '''
+    strings = StringTable()
+    if tag == 'node':
+        group = encode_dense(elements, strings)
+    else:
+        encode = encode_way if tag == 'way' else encode_relation
+        group = bytearray().join(encode(elem, strings) for elem in elements)
+    write_blob(f, 'OSMData', strings.encode() + bytes_field(2, group))
+
+def write_header(f, bounds):
+    data = bytearray()
+    if bounds is not None:
+        box = [parse_coordinate(bounds.get(a)) * 100 for a in
+               ('minlon', 'maxlon', 'maxlat', 'minlat')]
+        data += bytes_field(1, bytearray().join(
+            varint_field(i, zigzag_encode(v)) for i, v in enumerate(box, 1)))
+    data += bytes_field(4, bytearray('OsmSchema-V0.6'))
+    data += bytes_field(4, bytearray('DenseNodes'))
+    write_blob(f, 'OSMHeader', data)
+
+def xml_to_pbf(file_in, file_out, block_size = 8000):
+    ''' Converts an OSM XML file to PBF, e.g. to make test or benchmark data:
+    nodes are written as DenseNodes, in blocks of up to block_size elements of
+    the same type. Reading the PBF file gives back the elements of the XML
+    file (see iter_pbf_elements()).
+    '''
+    with open(file_out, 'wb') as f:
+        header = False
+        tag, block = None, []
+        depth = 0
+        root = None
+        for event, elem in ET.iterparse(file_in, events = ('start', 'end')):
+            if event == 'start':
+                root = elem if root is None else root
+                depth += 1
+                continue
+            depth -= 1
+            if depth != 1:
+                continue
+            if not header:  # <bounds> comes first, if there is one
+                write_header(f, elem if elem.tag == 'bounds' else None)
+                header = True
+            if elem.tag in member_types:
+                if block and (elem.tag != tag or len(block) >= block_size):
+                    write_block(f, tag, block)
+                    block = []
+                tag = elem.tag
+                block.append(elem)
+            root.clear()  # The block keeps its elements
+        if not header:
+            write_header(f, None)
+        if block:
+            write_block(f, tag, block)
@@ -1,10 +1,18 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import argparse
+import os
 import pprint
+import threading
 
 # B.2. Data investigations with MongoDB ========================================
 
+# Where the queries run: 'mongodb', or 'columnar' to run them without a 
+# database, on the file written by export_columns() in clean_and_save_to_json
+backend = os.environ.get('OSM_QUERIES_BACKEND', 'mongodb')
+columns_file = './Versailles.osm/Versailles.osm'  # Without .parquet / .npz
+
 def get_db():
     ''' Creates connection to local MongoDB database.
     '''
@@ -13,38 +21,250 @@ def get_db():
     db = client.OpenStreetMap
     return db
 
-db = get_db()
+def get_collection(backend = 'mongodb'):
+    ''' Returns the collection to query: the MongoDB collection, or the 
+    columnar export (see columnar.ColumnarCollection), which has the same 
+    aggregate() method.
+    '''
+    if backend == 'columnar':
+        from columnar import open_columns
+        return open_columns(columns_file)
+    return get_db().Versailles
+
+collections = {}  # Collection of each backend, opened by its first query
+collections_lock = threading.Lock()  # Batched queries start on several 
+                                     # threads at once
+
+def current_collection():
+    ''' Returns the collection of the selected backend, opened on first use so
+    that importing this module doesn't connect to anything. The threads of 
+    aggregate_batch() all get the collection (and client) of the first one.
+    '''
+    with collections_lock:
+        if backend not in collections:
+            collections[backend] = get_collection(backend)
+        return collections[backend]
+
+def get_version(collection):
+    ''' Returns the version stamp of the data: written by the loader for 
+    MongoDB (None if it has not been loaded since stamps were introduced), 
+    last modification time and size of the file for the columnar export.
+    '''
+    if backend == 'columnar':
+        stat = os.stat(collection.path)
+        return ('columnar', collection.path, stat.st_mtime, stat.st_size)
+    doc = collection.database.versions.find_one({'_id': collection.name})
+    return doc and ('mongodb', collection.full_name, doc['version'])
+
+
+# B.2.0. Query result cache ====================================================
 
-def aggregate(query):
-    ''' Runs a MongoDB aggregation query on the connected database.
+import copy
+import cPickle
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+cache_file = './queries.cache'
+cache_size = 256  # Maximum number of cached results
+version_check_interval = 10  # Seconds between two reads of the version stamp
+
+def canonical(value):
+    ''' Returns a pipeline (or any part of it) in a canonical form, as nested
+    lists: the keys of plain dicts are sorted, as their order is meaningless, 
+    while ordered dicts (e.g. a SON $sort specification) keep their order.
+    '''
+    if isinstance(value, dict):
+        items = value.items()
+        if type(value) is dict:
+            items = sorted(items)
+        return ['dict'] + [[k, canonical(v)] for k, v in items]
+    elif isinstance(value, (list, tuple)):
+        return ['list'] + [canonical(v) for v in value]
+    return value
+
+def pipeline_key(query):
+    ''' Hash of the canonical form of a pipeline. '''
+    return hashlib.sha1(json.dumps(canonical(query), 
+                                   default = repr)).hexdigest()
+
+class ResultCache(object):
+    ''' Persistent cache of query results for one version of the data, with 
+    least recently used eviction. Results cached for another version are 
+    dropped as soon as a result is stored for the new one. The file is only
+    read by the first lookup.
+    
+    In:
+        path (string): Pickle file holding the cache between runs
+        max_entries (int): Maximum number of results kept
+    '''
+    def __init__(self, path, max_entries = cache_size):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()  # Queries may run on several threads
+        self.version, self.entries = None, None  # Set by load()
+    
+    def load(self):
+        ''' Reads the cache file, if not done yet. Called with the lock held.
+        '''
+        if self.entries is not None:
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                self.version, self.entries = cPickle.load(f)
+        except (IOError, EOFError, cPickle.UnpicklingError, ValueError):
+            self.version, self.entries = None, OrderedDict()
+    
+    def get(self, key, version):
+        ''' Returns the cached result, or None. '''
+        with self.lock:
+            self.load()
+            if version != self.version or key not in self.entries:
+                return None
+            result = self.entries.pop(key)
+            self.entries[key] = result  # Most recently used last
+            return copy.deepcopy(result)
+    
+    def put(self, key, version, result):
+        with self.lock:
+            self.load()
+            if version != self.version:  # The data was reloaded
+                self.version = version
+                self.entries.clear()
+            self.entries[key] = copy.deepcopy(result)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last = False)
+            self.save()
+    
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            cPickle.dump((self.version, self.entries), f, 
+                         cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.path)  # Never leaves a truncated cache
+
+result_cache = ResultCache(cache_file)
+current_version = {'version': None, 'checked': 0}
+
+def dataset_version():
+    ''' Version stamp of the data, read at most every version_check_interval
+    seconds. '''
+    now = time.time()
+    if now - current_version['checked'] > version_check_interval:
+        current_version['version'] = get_version(current_collection())
+        current_version['checked'] = now
+    return current_version['version']
+
+def aggregate(query, use_cache = True):
+    ''' Runs a MongoDB aggregation query on the selected backend. Results are
+    cached (see ResultCache) until the data is reloaded.
 
     In:
         query (string): An query using MongoDB's aggregation framework
+        use_cache (bool): If False, always run the query
     Out:
         list: List of documents returned by the query
     '''    
-    return [doc for doc in db.Versailles.aggregate(query)]
+    version = dataset_version() if use_cache else None
+    if version is None:  # Unknown version: the cache can't be trusted
+        return list(iter_aggregate(query))
+    key = pipeline_key(query)
+    result = result_cache.get(key, version)
+    if result is None:
+        result = list(iter_aggregate(query))
+        result_cache.put(key, version, result)
+    return result
+
+def iter_aggregate(query):
+    ''' Streams the documents returned by an aggregation query from the 
+    cursor, without caching them or building a list. '''
+    for doc in current_collection().aggregate(query):
+        yield doc
+
+
+# B.2.1. Batched execution =====================================================
+
+from multiprocessing.pool import ThreadPool
+
+def split_index_match(pipeline):
+    ''' Splits the conditions of a leading $match that can use an index 
+    (geospatial ones) from the rest of the pipeline: inside a $facet, no stage 
+    can use an index.
+    
+    In:
+        pipeline (list): Aggregation pipeline
+    Out:
+        tuple: (dict of indexable conditions or None, rest of the pipeline)
+    '''
+    if not pipeline or '$match' not in pipeline[0]:
+        return None, pipeline
+    first_match = pipeline[0]['$match']
+    indexed = dict((k, v) for k, v in first_match.items() 
+                   if isinstance(v, dict) and '$geoWithin' in v)
+    if not indexed:
+        return None, pipeline
+    others = dict((k, v) for k, v in first_match.items() 
+                  if k not in indexed)
+    rest = ([{'$match': others}] if others else []) + pipeline[1:]
+    return indexed, rest
+
+def facet_pipelines(queries):
+    ''' Groups queries into as few pipelines as possible: queries sharing the 
+    same indexable $match (see split_index_match()) become the branches of a 
+    $facet stage after this $match, all the others the branches of a $facet 
+    over the whole collection. Each resulting pipeline scans the data once.
+    
+    In:
+        queries (dict): Aggregation pipelines by name
+    Out:
+        list: Pipelines, each returning a single document with the results of
+            its queries by name
+    '''
+    groups = OrderedDict()  # Key of the indexable $match -> (index_match, 
+                            # branches)
+    for name, pipeline in queries.items():
+        index_match, rest = split_index_match(pipeline)
+        group = groups.setdefault(pipeline_key(index_match), 
+                                  (index_match, OrderedDict()))
+        group[1][name] = rest
+    return [([{'$match': shared_match}] if shared_match else []) + 
+            [{'$facet': branches}]
+            for shared_match, branches in groups.values()]
+
+def aggregate_batch(queries, threads = 4):
+    ''' Runs several aggregation queries in batches (see facet_pipelines()),
+    concurrently on a pool of threads sharing the client's connection pool.
+    Results of a $facet are limited to 16MB per batch by MongoDB.
+    
+    In:
+        queries (dict): Aggregation pipelines by name
+        threads (int): Maximum number of batches run at the same time
+    Out:
+        dict: List of documents returned by each query, by name
+    '''
+    pipelines = facet_pipelines(queries)
+    pool = ThreadPool(max(1, min(threads, len(pipelines))))
+    try:
+        outputs = pool.map(aggregate, pipelines)
+    finally:
+        pool.close()
+    results = dict((name, []) for name in queries)
+    for output in outputs:
+        for doc in output:  # $facet returns one document
+            results.update(doc)
+    return results
 
     
 # B.2.a. General statistics ====================================================
 
 doc_count = [{"$group": {"_id": "Number of documents", "count":{"$sum": 1}}}]
 
-print "\n B.2.a. GENERAL STATISTICS"
-print "    o Number of documents:"
-pprint.pprint(aggregate(doc_count))
-
 node_count = [{"$match": {"type": "node"}},
               {"$group": {"_id": "$type", "count": {"$sum": 1}}}]
 
-print "\n    o Number of nodes:"
-pprint.pprint(aggregate(node_count))
-
 way_count = [{"$match": {"type": "way"}},
              {"$group": {"_id": "$type", "count": {"$sum": 1}}}]
-
-print "\n    o Number of ways:"            
-pprint.pprint(aggregate(way_count))
  
  
 # B.2.b. Specific statistics ===================================================
@@ -52,25 +272,15 @@ pprint.pprint(aggregate(way_count))
 unique_uids = [{"$group": {"_id": "$created.uid", "count": {"$sum": 1}}},
                {"$group": {"_id": "Unique users", "count": {"$sum": 1}}}]
 
-print "\n B.2.a. SPECIFIC STATISTICS"
-print "    o Number of unique users who edited the data:"
-pprint.pprint(aggregate(unique_uids))
-
 top10_users = [{"$group": {"_id": "$created.user", "count": {"$sum": 1}}},
                {"$sort": {"count": -1}},
                {"$limit": 10}]
 
-print "\n    o Top 10 contributors:"
-pprint.pprint(aggregate(top10_users))
-
 top10_cities = [{"$match": {"address.city": {"$exists": 1}}},
                 {"$group": {"_id": "$address.city", "count": {"$sum": 1}}},
                 {"$sort": {"count": -1}},
                 {"$limit": 10}]
 
-print "\n    o Number of nodes per city (top 10):"
-pprint.pprint(aggregate(top10_cities))
-
 '''Cities edited by top 10 contributors:'''
 
 # First we need to retrieve the top 10 users, but only for elements that have 
@@ -81,43 +291,39 @@ match = [{"$match": {"address.city": {"$exists": 1}}},
                {"$limit": 10},
          {"$project": {"_id": 1}}]
 
-# Turn the result into a list of users:
-user_list = [u[u'_id'] for u in aggregate(match)]
-print "\nTop 10 contributors for elements that contain a city name:"
-print user_list
-
-# Use this list to filter down users:
-cities_by_user = [{"$match": {"created.user": {"$in": user_list},
-                              "address.city": {"$ne": None}}},
-                  {"$group": 
-                     {"_id": {"user": "$created.user", "city": "$address.city"},
-                      "count": {"$sum": 1}}},
-                  {"$sort": {"_id.user": 1}}]
-print "\nNumber of contribution by these 10 users, by city:"
-pprint.pprint(aggregate(cities_by_user))
+def cities_by_user_query(user_list = None):
+    ''' Number of contributions by user and city, for the users in user_list
+    (all users if None). '''
+    user_filter = {"address.city": {"$ne": None}}
+    if user_list is not None:
+        user_filter["created.user"] = {"$in": user_list}
+    return [{"$match": user_filter},
+            {"$group": 
+               {"_id": {"user": "$created.user", "city": "$address.city"},
+                "count": {"$sum": 1}}},
+            {"$sort": {"_id.user": 1}}]
 
 # B.2.c. Visiting the Château de Versailles ====================================
 
+# Area around the Château, as a GeoJSON polygon (longitude first). Matching it 
+# with $geoWithin uses the 2dsphere index built on "loc" by the loader.
+chateau_area = {"type": "Polygon",
+                "coordinates": [[[2.079505, 48.801217], [2.123966, 48.801217],
+                                 [2.123966, 48.828209], [2.079505, 48.828209],
+                                 [2.079505, 48.801217]]]}
+
+in_chateau_area = {"$geoWithin": {"$geometry": chateau_area}}
+
 tourism_spots = [{"$match": 
-                      {"lat": {"$gte": 48.801217},
-                       "lat": {"$lte": 48.828209},
-                       "lon": {"$gte": 2.079505},
-                       "lon": {"$lte": 2.123966},
+                      {"loc": in_chateau_area,
                        "tourism": {"$exists": 1}
                       }
                  },
                  {"$group": {"_id": "$tourism", "count": {"$sum": 1}}}
                 ]
 
-print "\nB.2.c. VISITING THE CHATEAU DE VERSAILLES"
-print "    o Tourist points of interest:"
-pprint.pprint(aggregate(tourism_spots))
-
 attractions = [{"$match": 
-                      {"lat": {"$gte": 48.801217},
-                       "lat": {"$lte": 48.828209},
-                       "lon": {"$gte": 2.079505},
-                       "lon": {"$lte": 2.123966},
+                      {"loc": in_chateau_area,
                        "tourism": "attraction"
                       }
                  },
@@ -125,14 +331,8 @@ attractions = [{"$match":
                                "attraction_name": "$name"}}
                 ]
 
-print "\n    o Attractions:"                
-pprint.pprint(aggregate(attractions))
-
 artworks = [{"$match": 
-                      {"lat": {"$gte": 48.801217},
-                       "lat": {"$lte": 48.828209},
-                       "lon": {"$gte": 2.079505},
-                       "lon": {"$lte": 2.123966},
+                      {"loc": in_chateau_area,
                        "tourism": "artwork"
                       }
              },
@@ -140,19 +340,98 @@ artworks = [{"$match":
                          "count": {"$sum": 1}}}
            ]
 
-print "\n    o Artworks:"
-pprint.pprint(aggregate(artworks))
-
 fountains = [{"$match": 
-                      {"lat": {"$gte": 48.801217},
-                       "lat": {"$lte": 48.828209},
-                       "lon": {"$gte": 2.079505},
-                       "lon": {"$lte": 2.123966},
+                      {"loc": in_chateau_area,
                        "amenity": "fountain"
                       }
               },
               {"$group": {"_id": "$amenity", "count": {"$sum": 1}}}
             ]
 
-print "\n    o Fountains:"
-pprint.pprint(aggregate(fountains))
\ No newline at end of file
+
+# Report =======================================================================
+
+# Independent queries of the report, in order
+report_queries = OrderedDict([
+    ('doc_count', doc_count), ('node_count', node_count), 
+    ('way_count', way_count), ('unique_uids', unique_uids), 
+    ('top10_users', top10_users), ('top10_cities', top10_cities), 
+    ('match', match), ('tourism_spots', tourism_spots), 
+    ('attractions', attractions), ('artworks', artworks), 
+    ('fountains', fountains)])
+
+def run_report(batched = False):
+    ''' Runs the queries of the report, one at a time or in batches (see 
+    aggregate_batch()). In batched mode, the contributions of all users by 
+    city are computed in the same batch as the list of top contributors, and
+    filtered afterwards instead of running a second query.
+    
+    In:
+        batched (bool): Whether to run the queries in batches
+    Out:
+        dict: Results by query name, plus 'user_list' and 'cities_by_user'
+    '''
+    if batched:
+        queries = OrderedDict(report_queries)
+        queries['all_cities_by_user'] = cities_by_user_query()
+        results = aggregate_batch(queries)
+    else:
+        results = dict((name, aggregate(query)) 
+                       for name, query in report_queries.items())
+    # Turn the result into a list of users:
+    results['user_list'] = [u[u'_id'] for u in results['match']]
+    if batched:
+        results['cities_by_user'] = [
+            doc for doc in results.pop('all_cities_by_user')
+            if doc['_id'].get('user') in results['user_list']]
+    else:  # Use this list to filter down users:
+        results['cities_by_user'] = aggregate(
+            cities_by_user_query(results['user_list']))
+    return results
+
+def print_report(results):
+    print "\n B.2.a. GENERAL STATISTICS"
+    print "    o Number of documents:"
+    pprint.pprint(results['doc_count'])
+    print "\n    o Number of nodes:"
+    pprint.pprint(results['node_count'])
+    print "\n    o Number of ways:"            
+    pprint.pprint(results['way_count'])
+
+    print "\n B.2.a. SPECIFIC STATISTICS"
+    print "    o Number of unique users who edited the data:"
+    pprint.pprint(results['unique_uids'])
+    print "\n    o Top 10 contributors:"
+    pprint.pprint(results['top10_users'])
+    print "\n    o Number of nodes per city (top 10):"
+    pprint.pprint(results['top10_cities'])
+    print "\nTop 10 contributors for elements that contain a city name:"
+    print results['user_list']
+    print "\nNumber of contribution by these 10 users, by city:"
+    pprint.pprint(results['cities_by_user'])
+
+    print "\nB.2.c. VISITING THE CHATEAU DE VERSAILLES"
+    print "    o Tourist points of interest:"
+    pprint.pprint(results['tourism_spots'])
+    print "\n    o Attractions:"                
+    pprint.pprint(results['attractions'])
+    print "\n    o Artworks:"
+    pprint.pprint(results['artworks'])
+    print "\n    o Fountains:"
+    pprint.pprint(results['fountains'])
+
+def main(argv = None):
+    global backend
+    parser = argparse.ArgumentParser(description = 'Runs the queries of the '
+                                     'report and prints their results')
+    parser.add_argument('--backend', choices = ('mongodb', 'columnar'),
+                        default = backend)
+    parser.add_argument('--batched', action = 'store_true',
+                        default = os.environ.get('OSM_QUERIES_BATCHED') == '1',
+                        help = 'run the queries in batches')
+    args = parser.parse_args(argv)
+    backend = args.backend
+    print_report(run_report(batched = args.batched))
+
+if __name__ == '__main__':
+    main()
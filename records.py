@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+''' Compact in-memory representation of the cleaned OSM documents.
+
+The documents yielded by iter_documents() in clean_and_save_to_json are nested
+dicts: each one has its own 'created' dict, its own copies of the tag keys and
+user names, and the node references of ways are strings. That is fine to
+stream them, not to keep a whole extract in memory for in-process analysis.
+
+A Record holds the same data in __slots__:
+- the 'created' fields are slots, and decimal strings (ids, versions,
+  changesets, uids) are stored as ints,
+- tag keys, users, element types and address values are interned, so that
+  every occurrence of the same string is the same object,
+- node references are an array of 64-bit integers,
+- other tags are a tuple of (key, value) pairs instead of a dict.
+
+Record.from_document(doc).to_document() == doc for any document, whatever its
+fields: values that don't fit the compact layout are kept as they are. Decimal
+strings come back as str, even if they were unicode (equal in Python 2).
+
+Usage:
+    records = list(iter_records(filename, load_reference(laposte_file)))
+    doc = records[0].to_document()
+'''
+
+from array import array
+
+CREATED = ('version', 'changeset', 'timestamp', 'user', 'uid')
+ABSENT = object()  # Value of a missing field
+max_ref = 1 << 63  # Node references are stored as signed 64-bit integers
+
+strings = {str: {}, unicode: {}}  # Interning tables, by type so that 'a' and
+# u'a' (equal in Python 2) are not swapped
+
+def intern_string(s):
+    ''' Returns the interned copy of a string, any other value as is. '''
+    table = strings.get(type(s))
+    if table is None:
+        return s
+    return table.setdefault(s, s)
+
+def pack_number(value):
+    ''' Returns a decimal string as an int, other values as is. Int values
+    can't be told apart from packed strings, so ABSENT is returned for them:
+    the caller then keeps the field as it is. '''
+    if isinstance(value, basestring):
+        try:
+            n = int(value)
+        except ValueError:
+            return value
+        return n if str(n) == value else value  # '007', ' 7'... stay strings
+    elif isinstance(value, (int, long)):
+        return ABSENT
+    return value
+
+def unpack_number(value):
+    return str(value) if isinstance(value, (int, long)) else value
+
+class Items(tuple):
+    ''' (key, value) pairs of a dict, with interned keys. '''
+    __slots__ = ()
+
+def pack_dict(d, intern_values = False):
+    return Items((intern_string(k),
+                  intern_string(v) if intern_values else pack_value(v))
+                 for k, v in d.iteritems())
+
+def pack_value(value):
+    return pack_dict(value) if isinstance(value, dict) else value
+
+def unpack_value(value):
+    if isinstance(value, Items):
+        return dict((k, unpack_value(v)) for k, v in value)
+    return value
+
+class Record(object):
+    ''' Compact version of a cleaned document (see the module docstring).
+    Fields missing from the document are ABSENT. '''
+    __slots__ = ('id', 'type', 'visible', 'version', 'changeset', 'timestamp',
+                 'user', 'uid', 'lat', 'lon', 'loc', 'node_refs',
+                 'address', 'tags')
+
+    @classmethod
+    def from_document(cls, doc):
+        ''' Builds a Record from a document shaped as per the JSON schema. '''
+        rec = cls()
+        doc = dict(doc)  # Fields are popped as they are packed
+        rec.id = ABSENT
+        if 'id' in doc:
+            rec.id = pack_number(doc['id'])
+            if rec.id is not ABSENT:  # Else left in the tags
+                del doc['id']
+        rec.type = intern_string(doc.pop('type', ABSENT))
+        rec.visible = intern_string(doc.pop('visible', ABSENT))
+
+        created = doc.get('created')
+        rec.version = rec.changeset = rec.timestamp = rec.user = rec.uid = \
+            ABSENT
+        if isinstance(created, dict) and sorted(created) == sorted(CREATED):
+            packed = [pack_number(created[n]) for n in ('version',
+                                                        'changeset', 'uid')]
+            if ABSENT not in packed:
+                rec.version, rec.changeset, rec.uid = packed
+                rec.timestamp = created['timestamp']
+                rec.user = intern_string(created['user'])
+                del doc['created']
+
+        rec.lat = doc.pop('lat', ABSENT)
+        rec.lon = doc.pop('lon', ABSENT)
+        rec.loc = ABSENT
+        loc = doc.get('loc', ABSENT)
+        if loc is not ABSENT and loc == rec.point():  # Derived from lat / lon
+            rec.loc = None
+            del doc['loc']
+
+        rec.node_refs = ABSENT
+        node_refs = doc.get('node_refs')
+        if isinstance(node_refs, list):
+            packed = [pack_number(ref) for ref in node_refs]
+            if all(isinstance(ref, (int, long)) and
+                   -max_ref <= ref < max_ref for ref in packed):
+                rec.node_refs = array('l', packed)  # 64 bits on Linux / macOS
+                del doc['node_refs']
+
+        rec.address = ABSENT
+        if isinstance(doc.get('address'), dict):
+            rec.address = pack_dict(doc.pop('address'), intern_values = True)
+
+        rec.tags = pack_dict(doc)
+        return rec
+
+    def point(self):
+        ''' GeoJSON point of shape_element() for the lat / lon fields, ABSENT
+        if they are not both floats. '''
+        if isinstance(self.lat, float) and isinstance(self.lon, float):
+            return {'type': 'Point', 'coordinates': [self.lon, self.lat]}
+        return ABSENT
+
+    def to_document(self):
+        ''' Returns the document the Record was built from. '''
+        doc = unpack_value(self.tags)
+        for name in ('id', 'type', 'visible', 'lat', 'lon'):
+            value = getattr(self, name)
+            if value is not ABSENT:
+                doc[name] = unpack_number(value) if name == 'id' else value
+        if self.version is not ABSENT:
+            doc['created'] = {'version': unpack_number(self.version),
+                              'changeset': unpack_number(self.changeset),
+                              'timestamp': self.timestamp, 'user': self.user,
+                              'uid': unpack_number(self.uid)}
+        if self.loc is not ABSENT:
+            doc['loc'] = self.point()
+        if self.node_refs is not ABSENT:
+            doc['node_refs'] = [str(ref) for ref in self.node_refs]
+        if self.address is not ABSENT:
+            doc['address'] = unpack_value(self.address)
+        return doc
+
+    def __repr__(self):
+        return 'Record({0!r})'.format(self.to_document())
+
+def iter_records(file_in, reference, **kwargs):
+    ''' Same as iter_documents() in clean_and_save_to_json (keyword arguments
+    are passed to it), but yields Records. '''
+    from clean_and_save_to_json import PostcodeCityResolver, iter_documents
+    if not isinstance(reference, PostcodeCityResolver):
+        reference = PostcodeCityResolver(reference)
+    for doc in iter_documents(file_in, reference, **kwargs):
+        yield Record.from_document(doc)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+''' Applying an osmChange file to a converted JSON file
+(apply_change_file()) gives the same documents as converting the changed
+OSM file from scratch, way geometries included.
+'''
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import xml.etree.cElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import benchmark
+import clean_and_save_to_json as cleaning
+
+try:
+    import numpy
+except ImportError:  # Needed by NodeIndex
+    numpy = None
+
+
+@unittest.skipUnless(numpy, 'numpy is required for way geometries')
+class ChangeFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.osm_file = os.path.join(self.dir, 'synthetic.osm')
+        benchmark.generate_osm(self.osm_file, 200000)
+        reference_file = os.path.join(self.dir, 'laposte.csv')
+        benchmark.generate_reference(reference_file, fillers = 100)
+        self.reference = cleaning.parse_reference_file(reference_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def convert(self, osm_file):
+        cleaning.process_map(osm_file, self.reference, sample_size = 0,
+                             node_index = cleaning.NodeIndex())
+        return cleaning.output_path(osm_file)
+
+    def read(self, json_file):
+        with open(json_file) as f:
+            return sorted(json.dumps(json.loads(line), sort_keys = True)
+                          for line in f)
+
+    def test_changes_match_full_conversion(self):
+        tree = ET.parse(self.osm_file)
+        root = tree.getroot()
+        nodes = dict((el.get('id'), el) for el in root.findall('node'))
+        ways = root.findall('way')
+        refs = [nd.get('ref') for nd in ways[0].findall('nd')]
+        modified, created, deleted = [], [], []
+
+        moved = nodes[refs[0]]  # A node of the first way moves
+        moved.set('lat', '48.8000000')
+        moved.set('lon', '2.1000000')
+        modified.append(moved)
+        ET.SubElement(ways[1], 'tag', {'k': 'name', 'v': 'Rue Neuve'})
+        modified.append(ways[1])  # Same nodes, new tag
+        removed = nodes[ways[2].findall('nd')[-1].get('ref')]
+        root.remove(removed)
+        deleted.append(removed)
+        new_way = ET.Element('way', dict(ways[3].attrib, id = '1'))
+        for nd in ways[3].findall('nd') + ways[4].findall('nd'):
+            ET.SubElement(new_way, 'nd', nd.attrib)
+        root.insert(list(root).index(ways[-1]) + 1, new_way)
+        created.append(new_way)
+        changed_file = os.path.join(self.dir, 'changed.osm')
+        tree.write(changed_file)
+
+        change_file = os.path.join(self.dir, 'changes.osc')
+        change = ET.Element('osmChange', {'version': '0.6'})
+        for action, elements in (('modify', modified), ('create', created),
+                                 ('delete', deleted)):
+            ET.SubElement(change, action).extend(elements)
+        ET.ElementTree(change).write(change_file)
+
+        json_file = self.convert(self.osm_file)
+        counts = cleaning.apply_change_file(change_file, self.reference,
+                                            json_file, mongodb = False)
+        self.assertEqual(self.read(json_file),
+                         self.read(self.convert(changed_file)))
+        self.assertTrue(counts['json']['relocated'] >= 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
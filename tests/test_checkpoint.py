@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+''' Resuming a checkpointed conversion (process_map(checkpoint_every = ...)).
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import benchmark
+import clean_and_save_to_json as cleaning
+
+
+class Interrupted(Exception):
+    pass
+
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.osm_file = os.path.join(self.dir, 'synthetic.osm')
+        benchmark.generate_osm(self.osm_file, 1 << 20)
+        reference_file = os.path.join(self.dir, 'laposte.csv')
+        benchmark.generate_reference(reference_file, fillers = 100)
+        self.reference = cleaning.parse_reference_file(reference_file)
+        self.json_file = cleaning.output_path(self.osm_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def convert(self, **kwargs):
+        cleaning.process_map(self.osm_file, self.reference, sample_size = 0,
+                             **kwargs)
+        with open(self.json_file) as f:
+            return f.read()
+
+    def interrupt_after(self, checkpoints, **kwargs):
+        ''' Runs a conversion that fails once checkpoints checkpoints have
+        been saved, as a crash would. '''
+        save_checkpoint = cleaning.save_checkpoint
+        saved = []
+        def failing_save(checkpoint_file, state):
+            save_checkpoint(checkpoint_file, state)
+            saved.append(state)
+            if len(saved) == checkpoints:
+                raise Interrupted()
+        cleaning.save_checkpoint = failing_save
+        try:
+            self.assertRaises(Interrupted, self.convert, **kwargs)
+        finally:
+            cleaning.save_checkpoint = save_checkpoint
+
+    def test_resume_with_same_segment_size(self):
+        expected = self.convert()
+        self.interrupt_after(3, checkpoint_every = 100000)
+        self.assertEqual(self.convert(checkpoint_every = 100000,
+                                      resume = True), expected)
+        self.assertFalse(os.path.exists(self.json_file + '.ckpt'))
+
+    def test_resume_with_other_segment_size(self):
+        expected = self.convert()
+        self.interrupt_after(3, checkpoint_every = 100000)
+        self.assertEqual(self.convert(checkpoint_every = 70000,
+                                      resume = True), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
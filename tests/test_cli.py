@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+''' Command line of clean_and_save_to_json.py (parse_args()), and importing
+the module without side effects.
+'''
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import clean_and_save_to_json as cleaning
+
+
+class ParseArgsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.osm_file = os.path.join(self.dir, 'extract.osm')
+        open(self.osm_file, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def parse(self, *argv):
+        return cleaning.parse_args(['--input', self.osm_file] + list(argv))
+
+    def assertUsageError(self, *argv):
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            self.assertRaises(SystemExit, self.parse, *argv)
+        finally:
+            sys.stderr = stderr
+
+    def test_json_only(self):
+        update = ('--stages', 'update', '--changes', 'changes.osc')
+        self.assertUsageError(*update + ('--json-only',))  # No JSON yet
+        args = self.parse('--stages', 'convert,update', '--changes', 
+                          'changes.osc', '--json-only')
+        self.assertEqual(args.stages, ['convert', 'update'])
+        self.assertTrue(self.parse('--json-only').json_only)
+        open(cleaning.output_path(self.osm_file), 'w').close()
+        self.assertTrue(self.parse(*update + ('--json-only',)).json_only)
+        self.assertUsageError(*update + ('--json-only', '--compression', 
+                                         'gzip'))
+
+    def test_checkpoints(self):
+        self.assertUsageError('--resume')
+        self.assertTrue(self.parse('--checkpoint-every', '1000', 
+                                   '--resume').resume)
+        self.assertUsageError('--checkpoint-every', '1000', '--processes', 
+                              '2')
+        self.assertUsageError('--checkpoint-every', '1000', '--compression',
+                              'gzip')
+
+    def test_stages(self):
+        self.assertUsageError('--stages', 'convert,clean')
+        self.assertUsageError('--stages', 'update')  # No --changes
+
+
+class ImportTest(unittest.TestCase):
+    def test_random_state(self):
+        ''' Importing the module doesn't reseed the random module. '''
+        output = subprocess.check_output([sys.executable, '-c', 
+            'import random; random.seed(1); expected = random.random(); '
+            'random.seed(1); import clean_and_save_to_json; '
+            'print random.random() == expected'], 
+            cwd = os.path.join(os.path.dirname(__file__) or '.', '..'))
+        self.assertEqual(output.strip(), 'True')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+''' Columnar export of the cleaned documents, and the aggregation pipelines
+run on it (columnar.py).
+'''
+
+import copy
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+
+import benchmark
+import clean_and_save_to_json as cleaning
+import columnar
+import queries
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+created = {'version': '1', 'changeset': '1', 'timestamp':
+           '2016-01-01T00:00:00Z', 'user': 'a', 'uid': '1'}
+point = {'id': '1', 'type': 'node', 'visible': None, 'created': created,
+         'lat': 48.8, 'lon': 2.1, 'location': 'underground',
+         'loc': {'type': 'Point', 'coordinates': [2.1, 48.8]}}
+tagged = {'id': '2', 'type': 'way', 'visible': None, 'created': created,
+          'lat': None, 'lon': None, 'node_refs': ['1'], 'loc': 'B2'}
+# Way without geometry, tagged loc=B2
+
+
+class WriterTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def export(self, use_parquet):
+        path = os.path.join(self.dir, 'export')
+        with columnar.ColumnarWriter(path, use_parquet = use_parquet) as w:
+            w.write(point)
+            w.write(tagged)
+        return columnar.open_columns(path)
+
+    def check_points(self, use_parquet):
+        collection = self.export(use_parquet)
+        lon, lat = collection.coordinates('loc')
+        self.assertEqual(lon[0], 2.1)
+        self.assertEqual(lat[0], 48.8)
+        self.assertTrue(np.isnan(lon[1]) and np.isnan(lat[1]))
+
+    def test_loc_tag_npz(self):
+        self.check_points(False)
+
+    @unittest.skipUnless(columnar.pyarrow_installed, 'pyarrow is not installed')
+    def test_loc_tag_parquet(self):
+        self.check_points(True)
+
+
+def box_query(pipeline):
+    ''' Returns pipeline with its $geoWithin conditions replaced by the
+    bounding box of their polygon, for mongomock which has no geospatial
+    queries. The Château area is a longitude / latitude rectangle: its great
+    circle edges are within a meter of the box. '''
+    pipeline = copy.deepcopy(pipeline)
+    for stage in pipeline:
+        for query in stage.get('$match', {}), stage.get('$facet', {}):
+            for key, condition in query.items():
+                if isinstance(condition, list):  # $facet branch
+                    query[key] = box_query(condition)
+                elif isinstance(condition, dict) and '$geoWithin' in condition:
+                    ring = condition.pop('$geoWithin')['$geometry'][
+                        'coordinates'][0]
+                    del query[key]
+                    for i, path in enumerate(('.coordinates.0',
+                                              '.coordinates.1')):
+                        values = [point[i] for point in ring]
+                        query[key + path] = {'$gte': min(values),
+                                             '$lte': max(values)}
+    return pipeline
+
+def tie_break(pipeline):
+    ''' Returns pipeline with _id added to the keys of its $sort stages
+    followed by a $limit, so that the documents kept among ties don't depend
+    on the engine. '''
+    pipeline = copy.deepcopy(pipeline)
+    if any('$limit' in stage for stage in pipeline):
+        for stage in pipeline:
+            if '$sort' in stage and '_id' not in stage['$sort']:
+                stage['$sort'] = OrderedDict(stage['$sort'].items() +
+                                             [('_id', 1)])
+    return pipeline
+
+def canonical(results):
+    return sorted(json.dumps(doc, sort_keys = True) for doc in results)
+
+
+@unittest.skipUnless(mongomock, 'mongomock is required')
+class PipelineTest(unittest.TestCase):
+    ''' The report pipelines of queries.py give the same results on the
+    columnar export as on MongoDB (mongomock), alone and in $facet batches.
+    '''
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        osm_file = os.path.join(cls.dir, 'synthetic.osm')
+        benchmark.generate_osm(osm_file, 1 << 20)
+        reference_file = os.path.join(cls.dir, 'laposte.csv')
+        benchmark.generate_reference(reference_file, fillers = 100)
+        reference = cleaning.PostcodeCityResolver(
+            cleaning.parse_reference_file(reference_file))
+        documents = list(cleaning.iter_documents(
+            osm_file, reference, node_index = cleaning.NodeIndex()))
+        created = documents[0]['created']
+        for i, (lon, lat, kind) in enumerate([(2.1, 48.81, 'statue'),
+                                              (2.11, 48.82, 'statue'),
+                                              (2.12, 48.82, 'fountain'),
+                                              (2.12, 48.8, 'statue'),
+                                              (2.2, 48.81, 'statue')]):
+            # Artworks are rare in the synthetic data
+            documents.append({'id': str(10 ** 9 + i), 'type': 'node',
+                              'visible': 'true', 'created': created,
+                              'lat': lat, 'lon': lon, 'tourism': 'artwork',
+                              'artwork_type': kind, 'loc': {
+                                  'type': 'Point', 'coordinates': [lon, lat]}})
+        path = os.path.join(cls.dir, 'export')
+        with columnar.ColumnarWriter(path, use_parquet = False) as writer:
+            for doc in documents:
+                writer.write(doc)
+        cls.columns = columnar.open_columns(path)
+        cls.mongodb = mongomock.MongoClient().OpenStreetMap.Versailles
+        cls.mongodb.insert_many(documents)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def run_both(self, pipeline):
+        return (self.columns.aggregate(pipeline),
+                list(self.mongodb.aggregate(box_query(pipeline))))
+
+    def assertSameResults(self, name, pipeline, columns, mongodb):
+        if any('$limit' in stage for stage in pipeline):
+            self.assertEqual(columns, mongodb, name)
+        else:  # Order of $group results, and of ties, is not defined
+            self.assertEqual(canonical(columns), canonical(mongodb), name)
+
+    def report_queries(self):
+        pipelines = OrderedDict((name, tie_break(pipeline)) for name, pipeline
+                                in queries.report_queries.items())
+        pipelines['cities_by_user'] = queries.cities_by_user_query(
+            ['user1', 'user2', 'user3'])
+        return pipelines
+
+    def test_report_queries(self):
+        for name, pipeline in self.report_queries().items():
+            columns, mongodb = self.run_both(pipeline)
+            self.assertTrue(mongodb, name)  # Something to compare
+            self.assertSameResults(name, pipeline, columns, mongodb)
+
+    def test_facets(self):
+        pipelines = self.report_queries()
+        batches = queries.facet_pipelines(pipelines)
+        self.assertTrue(1 < len(batches) < len(pipelines))
+        for batch in batches:
+            (columns,), (mongodb,) = self.run_both(batch)
+            self.assertEqual(sorted(columns), sorted(mongodb))
+            for name in mongodb:
+                self.assertSameResults(name, pipelines[name], columns[name],
+                                       mongodb[name])
+
+    def test_convex_polygon(self):
+        ''' A triangle, on known points. '''
+        triangle = {'type': 'Polygon', 'coordinates': [[
+            [2.1, 48.8], [2.14, 48.8], [2.1, 48.84], [2.1, 48.8]]]}
+        pipeline = [{'$match': {'loc': {'$geoWithin':
+                                        {'$geometry': triangle}}}},
+                    {'$project': {'_id': 0, 'id': 1}}]
+        path = os.path.join(self.dir, 'points')
+        with columnar.ColumnarWriter(path, use_parquet = False) as writer:
+            for i, (lon, lat) in enumerate([(2.11, 48.81), (2.13, 48.83),
+                                            (2.12, 48.805), (2.09, 48.81),
+                                            (2.119, 48.819)]):
+                writer.write({'id': str(i), 'loc': {'type': 'Point',
+                                                    'coordinates': [lon, lat]}})
+            writer.write({'id': '5'})  # No point
+        points = columnar.open_columns(path)
+        self.assertEqual(points.aggregate(pipeline),
+                         [{'id': '0'}, {'id': '2'}, {'id': '4'}])
+        square = {'type': 'Polygon', 'coordinates': [[
+            [2.1, 48.8], [2.14, 48.8], [2.12, 48.81], [2.1, 48.84],
+            [2.1, 48.8]]]}  # Not convex
+        self.assertRaises(ValueError, points.aggregate,
+                          [{'$match': {'loc': {'$geoWithin':
+                                               {'$geometry': square}}}},
+                           {'$count': 'n'}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+''' Way geometries resolved from the node index by iter_documents(), for
+elements carrying "location" or "loc" tags.
+'''
+
+import os
+import sys
+import unittest
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import clean_and_save_to_json as cleaning
+
+try:
+    import numpy
+except ImportError:  # Needed by NodeIndex
+    numpy = None
+
+osm = '''<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+ <node id="1" lat="48.8000000" lon="2.1000000" version="1" changeset="1"
+  timestamp="2016-01-01T00:00:00Z" user="a" uid="1">
+  <tag k="location" v="underground"/>
+ </node>
+ <node id="2" lat="48.8020000" lon="2.1040000" version="1" changeset="1"
+  timestamp="2016-01-01T00:00:00Z" user="a" uid="1"/>
+ <way id="3" version="1" changeset="1" timestamp="2016-01-01T00:00:00Z"
+  user="a" uid="1">
+  <nd ref="1"/>
+  <nd ref="2"/>
+  <tag k="location" v="underground"/>
+  <tag k="loc" v="B2"/>
+ </way>
+ <way id="4" version="1" changeset="1" timestamp="2016-01-01T00:00:00Z"
+  user="a" uid="1">
+  <nd ref="2"/>
+  <nd ref="1"/>
+ </way>
+</osm>
+'''
+
+
+@unittest.skipUnless(numpy, 'numpy is required for way geometries')
+class LocationTagTest(unittest.TestCase):
+    def test_location_tags(self):
+        docs = list(cleaning.iter_documents(
+            StringIO(osm), cleaning.PostcodeCityResolver({}),
+            node_index = cleaning.NodeIndex()))
+        node, _, way, other = docs
+        self.assertEqual(node['location'], 'underground')
+        self.assertEqual(node['loc'], {'type': 'Point',
+                                       'coordinates': [2.1, 48.8]})
+        self.assertEqual(way['location'], 'underground')
+        self.assertEqual(way['loc']['type'], 'Point')
+        self.assertCoordinates(way['loc']['coordinates'], [2.102, 48.801])
+        self.assertCoordinates(way['bbox'], [2.1, 48.8, 2.104, 48.802])
+        self.assertEqual(other['loc'], way['loc'])
+
+    def assertCoordinates(self, first, second):
+        ''' Node coordinates are stored as float32 by NodeIndex. '''
+        self.assertEqual(len(first), len(second))
+        for a, b in zip(first, second):
+            self.assertAlmostEqual(a, b, places = 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
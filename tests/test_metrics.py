@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+''' Instrumentation of the conversion (metrics.py), in one process or merged
+from the workers of process_map_parallel().
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import benchmark
+import clean_and_save_to_json as cleaning
+from metrics import Metrics
+
+
+class ParallelMetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.osm_file = os.path.join(self.dir, 'synthetic.osm')
+        self.counts = benchmark.generate_osm(self.osm_file, 1 << 20)
+        reference_file = os.path.join(self.dir, 'laposte.csv')
+        benchmark.generate_reference(reference_file, fillers = 100)
+        self.reference = cleaning.parse_reference_file(reference_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_workers_are_merged(self):
+        sequential = Metrics()
+        cleaning.process_map(self.osm_file, self.reference, sample_size = 0,
+                             metrics = sequential)
+        parallel = Metrics()
+        count = cleaning.process_map_parallel(self.osm_file, self.reference, 
+                                              2, shard_size = 200000,
+                                              metrics = parallel)
+        report = parallel.report()
+        self.assertEqual(count, self.counts['node'] + self.counts['way'])
+        self.assertEqual(report['documents'], count)
+        self.assertEqual(report['counters'], sequential.report()['counters'])
+        self.assertEqual(report['counters'], {'node': self.counts['node'],
+                                              'way': self.counts['way']})
+        for stage in ('parse', 'shape_element', 'postcodes_cities', 
+                      'json_write', 'merge_parts'):
+            self.assertTrue(report['stages'][stage]['wall_seconds'] > 0, 
+                            stage)
+        self.assertEqual(report['stages']['json_write']['calls'], count)
+        lookups = report['caches']['postcodes_cities']['lookups']
+        self.assertEqual(lookups, 
+                         sequential.report()['caches']['postcodes_cities']
+                         ['lookups'])
+        self.assertTrue(report['worker_peak_rss_mb'] > 0)
+        self.assertEqual(sequential.report()['worker_peak_rss_mb'], None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+''' Loading the cleaned documents into MongoDB (load_map() and
+load_to_mongodb()), against an in-memory mongomock server.
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import benchmark
+import clean_and_save_to_json as cleaning
+
+try:
+    import mongomock
+    import pymongo
+except ImportError:
+    mongomock = None
+
+
+class Interrupted(Exception):
+    pass
+
+
+@unittest.skipUnless(mongomock, 'mongomock and pymongo are required')
+class LoadTest(unittest.TestCase):
+    def setUp(self):
+        self.client = mongomock.MongoClient()
+        self.MongoClient = pymongo.MongoClient
+        pymongo.MongoClient = lambda *args, **kwargs: self.client
+        self.db = self.client['OpenStreetMap']
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        pymongo.MongoClient = self.MongoClient
+        shutil.rmtree(self.dir)
+
+    def documents(self, n, error = None):
+        ''' Yields n documents, then raises error if given. '''
+        for i in range(n):
+            yield {'id': str(i), 'type': 'node', 'lat': 48.8, 'lon': 2.1,
+                   'loc': {'type': 'Point', 'coordinates': [2.1, 48.8]}}
+        if error is not None:
+            raise error
+
+    def version(self):
+        stamp = self.db.versions.find_one({'_id': 'Versailles'})
+        return stamp and stamp['version']
+
+    def test_load_map(self):
+        osm_file = os.path.join(self.dir, 'synthetic.osm')
+        counts = benchmark.generate_osm(osm_file, 200000)
+        inserted = cleaning.load_map(osm_file, {}, batch_size = 100,
+                                     verbose = False)
+        self.assertEqual(inserted, counts['node'] + counts['way'])
+        self.assertEqual(self.db.Versailles.count_documents({}), inserted)
+        self.assertEqual(self.db.Versailles.count_documents({'type': 'way'}),
+                         counts['way'])
+        self.assertEqual(self.db.Versailles.index_information()['loc_2dsphere']
+                         ['key'], [('loc', '2dsphere')])
+        self.assertTrue(self.version())
+
+    def test_reload(self):
+        cleaning.load_to_mongodb(self.documents(2500), verbose = False)
+        version = self.version()
+        self.assertEqual(cleaning.load_to_mongodb(self.documents(10), 
+                                                  drop = True, 
+                                                  geo_index = False,
+                                                  verbose = False), 10)
+        self.assertEqual(self.db.Versailles.count_documents({}), 10)
+        self.assertNotIn('loc_2dsphere', self.db.Versailles.index_information())
+        self.assertNotEqual(self.version(), version)
+
+    def test_failed_load(self):
+        self.assertRaises(Interrupted, cleaning.load_to_mongodb,
+                          self.documents(1500, Interrupted()), 
+                          batch_size = 1000, verbose = False)
+        # The first batch was inserted: the data changed
+        self.assertEqual(self.db.Versailles.count_documents({}), 1000)
+        self.assertTrue(self.version())
+        self.assertNotIn('loc_2dsphere', self.db.Versailles.index_information())
+
+    def test_failed_stamp(self):
+        ''' The error of the load is reported, not the one of the stamp. '''
+        def failing_replace(*args, **kwargs):
+            raise pymongo.errors.PyMongoError('stamp failed')
+        self.db.versions.replace_one = failing_replace
+        self.assertRaises(Interrupted, cleaning.load_to_mongodb,
+                          self.documents(10, Interrupted()), verbose = False)
+        self.assertRaises(pymongo.errors.PyMongoError, 
+                          cleaning.load_to_mongodb, self.documents(10), 
+                          verbose = False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+''' OSM PBF input (osm_pbf.py): the elements, documents and JSON file converted
+from a PBF file are those of the equivalent XML file, with both decoders and
+with the blocks processed by worker processes or not.
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import benchmark
+import clean_and_save_to_json as cleaning
+import osm_pbf
+from metrics import Metrics
+
+try:
+    import numpy
+except ImportError:  # Needed by NodeIndex
+    numpy = None
+
+osm = '''<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" generator="test">
+ <bounds minlat="48.76" minlon="2.02" maxlat="48.91" maxlon="2.17"/>
+ <node id="1" lat="48.8049000" lon="2.1204000" version="3" changeset="10"
+  timestamp="2016-05-01T12:30:00Z" user="Andr\xc3\xa9" uid="7" visible="true">
+  <tag k="name" v="Ch\xc3\xa2teau de Versailles"/>
+  <tag k="addr:postcode" v="78000"/>
+  <tag k="addr:city" v="Versailles"/>
+  <tag k="addr:street" v="allee de la Reine"/>
+ </node>
+ <node id="2" lat="-33.8688197" lon="-151.2092955"/>
+ <node id="3" lat="48.8012345" lon="2.1000001" version="1" changeset="11"
+  timestamp="2016-05-02T08:00:00Z" user="b" uid="8" visible="false">
+  <tag k="lat" v="x"/>
+  <tag k="a.b" v="dropped"/>
+ </node>
+ <way id="10" version="2" changeset="12" timestamp="2016-05-03T09:00:00Z"
+  user="c" uid="9">
+  <nd ref="1"/>
+  <nd ref="3"/>
+  <nd ref="2"/>
+  <tag k="highway" v="residential"/>
+  <tag k="addr:street" v=" rue de la Paix "/>
+ </way>
+ <way id="11">
+  <nd ref="3"/>
+  <nd ref="1"/>
+ </way>
+ <relation id="20" version="1" changeset="13"
+  timestamp="2016-05-04T10:00:00Z" user="c" uid="9">
+  <member type="node" ref="1" role="stop"/>
+  <member type="way" ref="10" role=""/>
+  <tag k="type" v="route"/>
+ </relation>
+</osm>
+'''
+
+def signature(elements):
+    ''' Comparable form of the elements: tag and attributes, the <bounds>
+    coordinates as floats (PBF files store numbers), without the <osm> root
+    (whose attributes are not in PBF files). '''
+    return [(e.tag, sorted((k, float(v) if e.tag == 'bounds' else v)
+                           for k, v in e.attrib.items()))
+            for e in elements if e.tag != 'osm']
+
+def decoders():
+    ''' The decoders to test: by hand, and with the protobuf library if it is
+    installed with its compiled implementation. '''
+    return ['python'] + (['protobuf'] if osm_pbf.compiled_classes() else [])
+
+
+class PbfTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.osm_file = os.path.join(self.dir, 'test.osm')
+        with open(self.osm_file, 'w') as f:
+            f.write(osm)
+        self.pbf_file = self.osm_file + '.pbf'
+        osm_pbf.xml_to_pbf(self.osm_file, self.pbf_file, block_size = 1)
+        self.synthetic_file = os.path.join(self.dir, 'synthetic.osm')
+        benchmark.generate_osm(self.synthetic_file, 1 << 20)
+        osm_pbf.xml_to_pbf(self.synthetic_file, self.synthetic_file + '.pbf')
+        reference_file = os.path.join(self.dir, 'laposte.csv')
+        benchmark.generate_reference(reference_file, fillers = 100)
+        self.reference = cleaning.PostcodeCityResolver(
+            cleaning.parse_reference_file(reference_file))
+
+    def tearDown(self):
+        osm_pbf.decoder = None
+        shutil.rmtree(self.dir)
+
+    def documents(self, file_in, **kwargs):
+        node_index = cleaning.NodeIndex() if numpy else None
+        return list(cleaning.iter_documents(file_in, self.reference,
+                                            node_index = node_index, **kwargs))
+
+    def test_elements(self):
+        for osm_file in (self.osm_file, self.synthetic_file):
+            expected = signature(cleaning.iter_elements(osm_file))
+            for decoder in decoders():
+                osm_pbf.decoder = decoder
+                self.assertEqual(signature(cleaning.iter_elements(
+                    osm_file + '.pbf')), expected, decoder)
+
+    def test_documents(self):
+        for osm_file in (self.osm_file, self.synthetic_file):
+            expected = self.documents(osm_file)
+            for decoder in decoders():
+                osm_pbf.decoder = decoder
+                self.assertEqual(self.documents(osm_file + '.pbf'), expected,
+                                 decoder)
+        node, _, hidden = self.documents(self.osm_file)[:3]
+        self.assertEqual(node['created']['user'], u'Andr\xe9')
+        self.assertEqual(node['address']['street'], u'All\xe9e de la Reine')
+        self.assertEqual(hidden['visible'], 'false')
+        self.assertEqual(hidden['lat'], 'x')
+
+    def test_documents_with_audits(self):
+        expected = self.documents(self.osm_file)
+        audit = cleaning.TagCounter()
+        self.assertEqual(self.documents(self.pbf_file, audits = [audit]),
+                         expected)
+        self.assertEqual(audit.result()['relation'], 1)
+
+    def test_process_map(self):
+        file_out = cleaning.output_path(self.synthetic_file)
+        cleaning.process_map(self.synthetic_file, self.reference,
+                             sample_size = 0)
+        with open(file_out) as f:
+            expected = f.read()
+        for decoder in decoders():
+            osm_pbf.decoder = decoder
+            os.remove(file_out)
+            cleaning.process_map(self.synthetic_file + '.pbf', self.reference,
+                                 sample_size = 0)
+            with open(file_out) as f:
+                self.assertEqual(f.read(), expected, decoder)
+
+    def test_workers(self):
+        pbf_file = self.synthetic_file + '.pbf'
+        in_process, workers = Metrics(), Metrics()
+        expected = list(cleaning.iter_pbf_documents(pbf_file, self.reference,
+                                                    in_process, processes = 1))
+        self.assertEqual(list(cleaning.iter_pbf_documents(
+            pbf_file, self.reference, workers, processes = 2)), expected)
+        entities = sum(1 for elem in osm_pbf.iter_pbf_elements(pbf_file)
+                       if elem.tag in ('node', 'way', 'relation'))
+        for metrics in (in_process, workers):
+            self.assertEqual(metrics.report()['stages']['shape_element']
+                             ['calls'], entities)
+        self.assertEqual(in_process.report()['worker_peak_rss_mb'], None)
+        self.assertTrue(workers.report()['worker_peak_rss_mb'] > 0)
+        self.assertEqual(signature(osm_pbf.iter_pbf_elements(pbf_file, 2)),
+                         signature(osm_pbf.iter_pbf_elements(pbf_file, 1)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+''' Running the report queries (queries.py).
+'''
+
+import os
+import sys
+import threading
+import time
+import unittest
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import queries
+
+
+class CollectionTest(unittest.TestCase):
+    def setUp(self):
+        self.get_collection = queries.get_collection
+        self.opened = []
+        def slow_open(backend):
+            time.sleep(0.05)  # Connecting takes a while
+            collection = object()
+            self.opened.append(collection)
+            return collection
+        queries.get_collection = slow_open
+        queries.collections.clear()
+
+    def tearDown(self):
+        queries.get_collection = self.get_collection
+        queries.collections.clear()
+
+    def test_opened_once(self):
+        ''' Threads starting at the same time share one collection. '''
+        start = threading.Event()
+        def first_query(_):
+            start.wait()
+            return queries.current_collection()
+        pool = ThreadPool(8)
+        try:
+            result = pool.map_async(first_query, range(8))
+            time.sleep(0.05)
+            start.set()
+            collections = result.get(10)
+        finally:
+            pool.close()
+        self.assertEqual(len(self.opened), 1)
+        self.assertEqual(collections, self.opened * 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
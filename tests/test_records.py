@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+''' Record.from_document(doc).to_document() == doc (records.py).
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import benchmark
+import clean_and_save_to_json as cleaning
+from records import Record, iter_records
+
+created = {'version': '2', 'changeset': '17206049', 'timestamp':
+           '2013-08-03T16:43:42Z', 'user': 'linuxUser16', 'uid': '1219059'}
+point = {'type': 'Point', 'coordinates': [2.1, 48.8]}
+
+documents = [
+    {'id': '1', 'type': 'node', 'visible': 'true', 'created': created,
+     'lat': 48.8, 'lon': 2.1, 'loc': point, 'amenity': 'bench'},
+    # Ids and numbers that are not decimal strings
+    {'id': 7, 'type': 'node', 'created': dict(created, uid = 1219059),
+     'lat': 48.8, 'lon': 2.1},
+    {'id': '007', 'type': 'way', 'created': dict(created, version = '02'),
+     'lat': None, 'lon': None, 'node_refs': ['1', '007']},
+    {'id': ' 8', 'type': 'way', 'node_refs': ['1', str(1 << 63)]},
+    {'id': u'9', 'type': u'way', 'created': dict(created, user = u'Zoé'),
+     'node_refs': [u'1', u'2'], 'name': u'Allée des Pins'},
+    # Tag strings where the schema has other fields, and unknown fields
+    {'id': '10', 'type': 'node', 'lat': 48.8, 'lon': 2.1,
+     'location': 'underground', 'loc': 'B2', 'tags': {'a': 'b'},
+     'address': {'city': 'Versailles', 'postcode': '78000'},
+     'created': 'yesterday', 'node_refs': 'none', 'extra': [1, {'x': 2}]},
+    {'id': '11', 'type': 'node', 'lat': 48.8, 'lon': 2.1,
+     'loc': {'type': 'Point', 'coordinates': [2.1, 48.81]}},  # Not derived
+    {'id': '12', 'type': 'way', 'created': dict(created, extra = '1'),
+     'address': 'unknown', 'fixme': None},
+    {},
+]
+
+def typed(value):
+    ''' value with the type of every scalar, which == ignores (1 == 1.0).
+    str and unicode are not told apart: decimal strings come back as str. '''
+    if isinstance(value, dict):
+        return dict((typed(k), typed(v)) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        return type(value), [typed(v) for v in value]
+    elif isinstance(value, basestring):
+        return basestring, value
+    return type(value), value
+
+
+class RoundTripTest(unittest.TestCase):
+    def assertRoundTrip(self, doc):
+        original = repr(doc)
+        copy = Record.from_document(doc).to_document()
+        self.assertEqual(copy, doc)
+        self.assertEqual(typed(copy), typed(doc))
+        self.assertEqual(repr(doc), original)  # doc is not modified
+
+    def test_documents(self):
+        for doc in documents:
+            self.assertRoundTrip(doc)
+
+    def test_shaped_documents(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            osm_file = os.path.join(tmp_dir, 'synthetic.osm')
+            benchmark.generate_osm(osm_file, 500000)
+            reference_file = os.path.join(tmp_dir, 'laposte.csv')
+            benchmark.generate_reference(reference_file, fillers = 100)
+            reference = cleaning.parse_reference_file(reference_file)
+            docs = cleaning.iter_documents(
+                osm_file, cleaning.PostcodeCityResolver(reference),
+                node_index = cleaning.NodeIndex())
+            records = iter_records(osm_file, reference,
+                                   node_index = cleaning.NodeIndex())
+            n = 0
+            for n, (doc, record) in enumerate(zip(docs, records), 1):
+                self.assertRoundTrip(doc)
+                self.assertEqual(typed(record.to_document()), typed(doc))
+            self.assertTrue(n > 1000)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()